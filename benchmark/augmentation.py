@@ -0,0 +1,86 @@
+"""
+Benchmark of the per-patch latency of the flip and scale augmentation, with nilearn resample_to_img on images and with
+scipy affine_transform on arrays, and of the augmentation of whole batches (flip, scale and permutation) with one
+worker task per patch and in one process with augment_batch.
+
+Usage: python -m benchmark.augmentation
+"""
+import argparse
+import time
+
+import numpy as np
+from nilearn.image import resample_to_img
+
+from patches_comparaison.generator_jdot import batch_augment_data, multi_proc_augment_data
+from unet3d.augment import distort_data, distort_image, get_image, random_flip_dimensions, random_scale_factor
+
+
+def nilearn_distort(data, truth, affine, flip_axis=None, scale_factor=None):
+    data_list = [resample_to_img(distort_image(get_image(channel, affine), flip_axis=flip_axis,
+                                               scale_factor=scale_factor), get_image(channel, affine),
+                                 interpolation="continuous").get_data() for channel in data]
+    truth_image = get_image(truth, affine)
+    distorted_truth = resample_to_img(distort_image(truth_image, flip_axis=flip_axis, scale_factor=scale_factor),
+                                      truth_image, interpolation="nearest").get_data()
+    return np.asarray(data_list), distorted_truth
+
+
+def time_augmentation(function, patches, transforms):
+    start = time.time()
+    for (data, truth), (flip_axis, scale_factor) in zip(patches, transforms):
+        function(data, truth, np.diag(np.ones(4)), flip_axis=flip_axis, scale_factor=scale_factor)
+    return (time.time() - start) / len(patches) * 1000
+
+
+def time_batch_augmentation(x, y, scale_deviation, n_batches, number_of_threads):
+    affine_list = [np.diag(np.ones(4))] * len(x)
+    index_list = [(0, np.zeros(3, dtype=int))] * len(x)
+    start = time.time()
+    for _ in range(n_batches):
+        multi_proc_augment_data((x, y), affine_list, index_list, number_of_threads=number_of_threads,
+                                patch_shape=x.shape[-3:], augment=True, augment_flip=True,
+                                augment_distortion_factor=scale_deviation, permute=True)
+    pool_latency = (time.time() - start) / n_batches * 1000
+    start = time.time()
+    for _ in range(n_batches):
+        batch_augment_data((x, y), affine_list, augment=True, augment_flip=True,
+                           augment_distortion_factor=scale_deviation, permute=True)
+    return pool_latency, (time.time() - start) / n_batches * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n_channels", default=2, type=int, help="Number of modalities")
+    parser.add_argument("-patch_sizes", default=[16, 32], type=int, nargs="+", help="Sizes of the cubic patches")
+    parser.add_argument("-n_patches", default=100, type=int, help="Number of patches augmented per patch size")
+    parser.add_argument("-scale_deviation", default=0.25, type=float, help="Standard deviation of the scale factors")
+    parser.add_argument("-batch_size", default=64, type=int, help="Number of patches of the augmented batches")
+    parser.add_argument("-n_batches", default=5, type=int, help="Number of batches augmented per patch size")
+    parser.add_argument("-number_of_threads", default=64, type=int,
+                        help="Number of processes of multi_proc_augment_data")
+    args = parser.parse_args()
+
+    random_state = np.random.RandomState(0)
+    for patch_size in args.patch_sizes:
+        patch_shape = (patch_size,) * 3
+        patches = [(random_state.rand(args.n_channels, *patch_shape).astype(np.float32),
+                    (random_state.rand(*patch_shape) > 0.9).astype(np.uint8)) for _ in range(args.n_patches)]
+        transforms = [(random_flip_dimensions(3), random_scale_factor(3, std=args.scale_deviation))
+                      for _ in range(args.n_patches)]
+        nilearn_latency = time_augmentation(nilearn_distort, patches, transforms)
+        scipy_latency = time_augmentation(distort_data, patches, transforms)
+        print(str(patch_size) + "^3 patches: nilearn " + str(round(nilearn_latency, 2)) + "ms, scipy "
+              + str(round(scipy_latency, 2)) + "ms per patch (x" + str(round(nilearn_latency / scipy_latency, 1))
+              + ")")
+        x = random_state.rand(args.batch_size, args.n_channels, *patch_shape).astype(np.float32)
+        y = (random_state.rand(args.batch_size, 1, *patch_shape) > 0.9).astype(np.uint8)
+        for scale_deviation in (None, args.scale_deviation):
+            pool_latency, batch_latency = time_batch_augmentation(x, y, scale_deviation, args.n_batches,
+                                                                  args.number_of_threads)
+            print("  batch of " + str(args.batch_size) + (", scaled" if scale_deviation else ", flip and permutation")
+                  + ": worker pool " + str(round(pool_latency, 1)) + "ms, augment_batch "
+                  + str(round(batch_latency, 1)) + "ms (x" + str(round(pool_latency / batch_latency, 1)) + ")")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Benchmark of the JDOT cost matrix: two scipy cdist calls in float64 (previous implementation) against CostMatrix.
+
+Usage: python -m benchmark.cost_matrix
+"""
+import argparse
+import time
+
+import numpy as np
+from scipy.spatial.distance import cdist
+
+from patches_comparaison.cost_matrix import CostMatrix
+
+
+def cdist_cost(source_features, target_features, source_truth, target_prediction, alpha, beta, distance):
+    n = len(source_features)
+    C0 = cdist(source_features.reshape(n, -1), target_features.reshape(n, -1), metric="sqeuclidean")
+    C1 = cdist(source_truth.reshape(n, -1), target_prediction.reshape(n, -1), metric=distance)
+    return alpha * C0 + beta * C1
+
+
+def time_steps(function, n_steps, *args, **kwargs):
+    start = time.time()
+    for _ in range(n_steps):
+        result = function(*args, **kwargs)
+    return (time.time() - start) / n_steps, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-batch_sizes", default="10,64,256", type=str, help="Batch sizes to time")
+    parser.add_argument("-patch_size", default=16, type=int, help="Size of the cubic patches")
+    parser.add_argument("-n_channels", default=4, type=int, help="Number of modalities")
+    parser.add_argument("-distance", default="dice", type=str, help="Distance between the labels")
+    parser.add_argument("-block_size", default=0, type=int, help="Block size of CostMatrix (0 for no blocks)")
+    parser.add_argument("-n_steps", default=5, type=int, help="Number of steps to average")
+    args = parser.parse_args()
+
+    patch_shape = (args.patch_size,) * 3
+    alpha, beta = 0.001, 0.0001
+    random_state = np.random.RandomState(0)
+    cost_matrix = CostMatrix(float32=True, block_size=args.block_size or None)
+    for batch_size in [int(batch_size) for batch_size in args.batch_sizes.split(",")]:
+        features = random_state.rand(2, batch_size, args.n_channels, *patch_shape).astype(np.float32)
+        truth = (random_state.rand(batch_size, 1, *patch_shape) > 0.9).astype(np.float32)
+        prediction = random_state.rand(batch_size, 1, *patch_shape).astype(np.float32)
+        cdist_time, expected = time_steps(cdist_cost, args.n_steps, features[0], features[1], truth, prediction,
+                                          alpha, beta, args.distance)
+        gemm_time, cost = time_steps(cost_matrix.jdot_cost, args.n_steps, features[0], features[1], truth,
+                                     prediction, alpha, beta, distance=args.distance)
+        print("Batch size " + str(batch_size) + ": cdist " + str(round(cdist_time * 1000, 2)) + "ms, CostMatrix "
+              + str(round(gemm_time * 1000, 2)) + "ms, speedup " + str(round(cdist_time / gemm_time, 1))
+              + "x, max relative error " + str(np.max(np.abs(cost - expected)) / np.max(np.abs(expected))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Benchmark of the compression of the weights exchanged by the federated training (federated/transport.py).
+
+codec mode: a sender trains from the weights held by the receiver and sends its update with each codec, round after
+round (like a center sending its local update). Reports the bytes per round and the error of the weights held by the
+receiver after the rounds, with and without error feedback.
+training mode: runs federated/training.py with each codec (needs the data sets and Keras) and reports the bytes per
+round and the validation dice (source and target with JDOT) of the rounds, from rounds.csv.
+
+Usage: python -m benchmark.federated_transport [-mode training]
+"""
+import argparse
+import os
+import copy
+
+import numpy as np
+
+from federated.transport import CODECS, DeltaEncoder, serialize, deserialize, apply_delta, load_weights
+
+
+def get_unet_shapes(n_base_filters, depth, n_channels):
+    '''
+    Shapes of the convolution kernels and biases of a 3D U-Net, close to those of isensee2017_model.
+    '''
+    shapes = []
+    n_filters = [n_base_filters * 2 ** level for level in range(depth)]
+    for level, filters in enumerate(n_filters):
+        n_inputs = n_channels if level == 0 else n_filters[level - 1]
+        shapes += [(3, 3, 3, n_inputs, filters), (filters,), (3, 3, 3, filters, filters), (filters,)]
+    for level in reversed(range(depth - 1)):
+        filters = n_filters[level]
+        shapes += [(3, 3, 3, n_filters[level + 1], filters), (filters,), (3, 3, 3, 2 * filters, filters), (filters,),
+                   (1, 1, 1, filters, filters), (filters,)]
+    return shapes + [(1, 1, 1, n_base_filters, 1), (1,)]
+
+
+def get_updates(initial_weights, n_rounds, random_state):
+    '''
+    Local updates of a simulated training: heavy tailed and of decreasing size.
+    '''
+    for round_index in range(n_rounds):
+        step = 0.01 / np.sqrt(round_index + 1)
+        yield [(step * random_state.laplace(size=array.shape) * array.std()).astype(np.float32)
+               for array in initial_weights]
+
+
+def run_codec(initial_weights, n_rounds, codec, fraction, error_feedback):
+    '''
+    Each round, the sender trains from the weights held by the receiver and sends its update.
+    :return: The mean size of the payloads, and the error of the weights held by the receiver relative to the sum of
+    the updates
+    '''
+    encoder = DeltaEncoder(codec, fraction=fraction, error_feedback=error_feedback)
+    held = [np.array(array) for array in initial_weights]
+    weights = [np.array(array) for array in initial_weights]
+    n_bytes = []
+    for updates in get_updates(initial_weights, n_rounds, np.random.RandomState(1)):
+        weights = [array + update for array, update in zip(weights, updates)]
+        local_weights = [array + update for array, update in zip(held, updates)]
+        payload = encoder.encode(local_weights, held)
+        held = apply_delta(held, deserialize(payload))
+        n_bytes.append(len(payload))
+    error = np.sqrt(sum(np.sum(np.square(a - b)) for a, b in zip(held, weights)))
+    change = np.sqrt(sum(np.sum(np.square(a - b)) for a, b in zip(weights, initial_weights)))
+    return np.mean(n_bytes), error / change
+
+
+def codec_benchmark(args):
+    if args.weights:
+        initial_weights = load_weights(args.weights)
+    else:
+        random_state = np.random.RandomState(0)
+        initial_weights = [(random_state.randn(*shape) * 0.05).astype(np.float32)
+                           for shape in get_unet_shapes(args.n_base_filters, args.depth, args.n_channels)]
+    n_values = sum(array.size for array in initial_weights)
+    print(len(initial_weights), "tensors,", n_values, "values, full weights:", len(serialize(initial_weights)),
+          "bytes")
+    for codec in CODECS:
+        for error_feedback in (True, False):
+            if codec == "none" and not error_feedback:
+                continue
+            bytes_per_round, error = run_codec(initial_weights, args.rounds, codec, args.fraction, error_feedback)
+            name = codec if codec == "none" else codec + (" with" if error_feedback else " without") + " error feedback"
+            print(name + ": "
+                  + str(int(bytes_per_round)) + " bytes per round, relative error of the held weights after "
+                  + str(args.rounds) + " rounds: " + str(round(error, 5)))
+
+
+def training_benchmark(args):
+    import config
+    from federated.training import FederatedTraining
+
+    base_config = config.Config(rev=args.rev)
+    for codec in CODECS:
+        codec_config = copy.copy(base_config)
+        codec_config.federated_codec = codec
+        codec_config.federated_topk = args.fraction
+        codec_config.federated_rounds = args.rounds
+        codec_config.federated_dir = os.path.join(base_config.federated_dir, "benchmark_" + codec)
+        training = FederatedTraining(codec_config)
+        training.main(overwrite_data=False)
+        rounds = np.genfromtxt(training.log_file, delimiter=",", names=True, ndmin=1)
+        print(codec + ": " + str(int(np.mean(rounds["bytes_sent"] + rounds["bytes_received"]))) + " bytes per round")
+        for row in rounds:
+            print("    round", int(row["round"]) + 1, "validation dice", row["validation_dice"], "source",
+                  row["validation_dice_source"], "target", row["validation_dice_target"])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-mode", default="codec", type=str, help="codec or training")
+    parser.add_argument("-rounds", default=20, type=int, help="Number of rounds")
+    parser.add_argument("-fraction", default=0.01, type=float, help="Fraction of the values sent by the topk codec")
+    parser.add_argument("-weights", default=None, type=str,
+                        help="Weights (.npz written by federated.transport.save_weights) used instead of random ones")
+    parser.add_argument("-n_base_filters", default=16, type=int, help="Filters of the first level of the U-Net")
+    parser.add_argument("-depth", default=5, type=int, help="Number of levels of the U-Net")
+    parser.add_argument("-n_channels", default=2, type=int, help="Number of modalities")
+    parser.add_argument("-rev", default=0, type=int, help="Revision of the configuration of the training mode")
+    args = parser.parse_args()
+
+    if args.mode == "training":
+        training_benchmark(args)
+    else:
+        codec_benchmark(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Benchmark of random patch reads from data files written with different chunk layouts and compressions.
+
+Usage: python -m benchmark.hdf5_layout
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from unet3d.data import add_data_to_storage, create_data_file, open_data_file, get_data_layout
+from unet3d.utils.patches import get_patch_from_storage
+
+LAYOUTS = (("default chunks, blosc 5", None, "blosc", 5),
+           ("16^3 chunks, blosc:lz4 5", (16, 16, 16), "blosc:lz4", 5),
+           ("32^3 chunks, blosc:lz4 5", (32, 32, 32), "blosc:lz4", 5),
+           ("16^3 chunks, blosc:zstd 5", (16, 16, 16), "blosc:zstd", 5),
+           ("16^3 chunks, none", (16, 16, 16), "none", 0))
+
+
+def create_synthetic_data_file(path, n_samples, n_channels, image_shape, chunk_shape, complib, complevel):
+    data_file, data_storage, truth_storage, affine_storage = create_data_file(path, n_channels, n_samples, image_shape,
+                                                                              chunk_shape=chunk_shape, complib=complib,
+                                                                              complevel=complevel)
+    random_state = np.random.RandomState(0)
+    for index in range(n_samples):
+        # Smooth images with a zero background compress like brain MRI rather than like noise
+        data = np.cumsum(random_state.rand(n_channels, *image_shape), axis=-1).astype(np.float32)
+        data[..., :image_shape[0] // 8, :, :] = 0
+        add_data_to_storage(data_storage, truth_storage, affine_storage,
+                            np.concatenate([data, data[:1] > 0.9 * data.max()], axis=0),
+                            affine=np.diag(np.ones(4)), n_channels=n_channels, truth_dtype=np.uint8)
+    data_file.close()
+
+
+def time_reads(data_file, n_reads, patch_shape):
+    random_state = np.random.RandomState(1)
+    image_shape = np.asarray(data_file.root.data.shape[-3:])
+    subjects = random_state.randint(data_file.root.data.shape[0], size=n_reads)
+    corners = [random_state.randint(image_shape - np.asarray(patch_shape) + 1) for _ in range(n_reads)]
+    start = time.time()
+    for subject, corner in zip(subjects, corners):
+        get_patch_from_storage(data_file.root.data, subject, patch_shape, corner)
+        get_patch_from_storage(data_file.root.truth, subject, patch_shape, corner)
+    return n_reads / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n_samples", default=4, type=int, help="Number of subjects in the data files")
+    parser.add_argument("-n_channels", default=2, type=int, help="Number of modalities")
+    parser.add_argument("-image_size", default=128, type=int, help="Size of the cubic images")
+    parser.add_argument("-patch_size", default=16, type=int, help="Size of the cubic patches read")
+    parser.add_argument("-n_reads", default=500, type=int, help="Number of random patches read per layout")
+    args = parser.parse_args()
+
+    image_shape = (args.image_size,) * 3
+    patch_shape = (args.patch_size,) * 3
+    for name, chunk_shape, complib, complevel in LAYOUTS:
+        path = os.path.abspath("./temporary_layout_benchmark.h5")
+        create_synthetic_data_file(path, args.n_samples, args.n_channels, image_shape, chunk_shape, complib,
+                                   complevel)
+        data_file = open_data_file(path)
+        layout = get_data_layout(data_file)
+        patches_per_second = time_reads(data_file, args.n_reads, patch_shape)
+        data_file.close()
+        print(name + ": chunks " + str(layout["chunk_shape"]) + ", " + str(round(os.path.getsize(path) / 2 ** 20, 1))
+              + "MB, " + str(round(patches_per_second, 1)) + " patches/s")
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
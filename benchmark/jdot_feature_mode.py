@@ -0,0 +1,55 @@
+"""
+Benchmark of the outputs used for the JDOT coupling: the additional forward pass ("predict") against the outputs
+cached from the training steps ("stale" and "encoder"). Each mode trains the same model from the same seed on the
+data files of the configuration; the time per epoch, the validation Dice on the target and the number of couplings
+computed from the cache are reported.
+
+Usage: python -m benchmark.jdot_feature_mode -rev 100 -epochs 5
+"""
+import argparse
+import os
+
+import numpy as np
+
+import config
+from patches_comparaison import train_jdot
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-rev", default=100, type=int, help="Revision of the first mode, the next ones follow")
+    parser.add_argument("-source", default="08", type=str, help="Source center")
+    parser.add_argument("-target", default="01", type=str, help="Target center")
+    parser.add_argument("-epochs", default=5, type=int, help="Number of epochs per mode")
+    parser.add_argument("-batch_size", default=10, type=int, help="Number of patches per domain and batch")
+    parser.add_argument("-OT_depth", default=5, type=int, help="Depth of the representation used by the coupling")
+    parser.add_argument("-max_age", default=1, type=int, help="jdot_activation_max_age, in epochs")
+    parser.add_argument("-seed", default=0, type=int, help="Seed of the batch selection")
+    args = parser.parse_args()
+
+    results = dict()
+    for index, mode in enumerate(("predict", "stale", "encoder")):
+        conf = config.Config(test=False, rev=args.rev + index, batch_size=args.batch_size, epochs=args.epochs,
+                             source_center=args.source, target_center=args.target, bool_train_jdot=True,
+                             OT_depth=args.OT_depth)
+        conf.jdot_feature_mode = mode
+        conf.jdot_activation_max_age = args.max_age
+        conf.seed = args.seed
+        conf.overwrite_data = False
+        train_jdot.Train_JDOT(conf).main(overwrite_data=False, overwrite_model=True)
+        epoch_times = np.atleast_1d(np.loadtxt(os.path.join(conf.save_dir, "time.csv"), delimiter=","))
+        validation = np.atleast_2d(np.loadtxt(os.path.join(conf.save_dir, "validation.csv"), delimiter=","))
+        age_path = os.path.join(conf.save_dir, "activation_age.csv")
+        n_cached = len(np.atleast_2d(np.loadtxt(age_path, delimiter=","))) if os.path.exists(age_path) else 0
+        # The cache is empty during the first epoch, which is left out of the time. The last column of the history is
+        # the Dice score on the target
+        results[mode] = np.mean(epoch_times[1:] if len(epoch_times) > 1 else epoch_times), validation[-1][-1], n_cached
+
+    epoch_time = results["predict"][0]
+    for mode, (mode_time, dice, n_cached) in results.items():
+        print(mode + ": " + str(round(mode_time, 1)) + " s/epoch (x" + str(round(epoch_time / mode_time, 2))
+              + "), target validation Dice " + str(round(dice, 4)) + ", " + str(n_cached) + " couplings from the cache")
+
+
+if __name__ == "__main__":
+    main()
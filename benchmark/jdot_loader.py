@@ -0,0 +1,75 @@
+"""
+Benchmark of the JDOT batch loading: a pool of workers created for each batch (previous behaviour) against the
+long-lived PatchLoader.
+
+Usage: python -m benchmark.jdot_loader
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from unet3d.data import add_data_to_storage, create_data_file, open_data_file
+from patches_comparaison.generator_jdot import create_patch_index_list, get_batch_jdot
+from patches_comparaison.patch_loader import PatchLoader
+
+
+def create_synthetic_data_file(path, n_samples, n_channels, image_shape):
+    data_file, data_storage, truth_storage, affine_storage = create_data_file(path, n_channels, n_samples,
+                                                                              image_shape)
+    for index in range(n_samples):
+        data = np.random.rand(n_channels, *image_shape).astype(np.float32)
+        add_data_to_storage(data_storage, truth_storage, affine_storage,
+                            np.concatenate([data, data[:1] > 0.9], axis=0), affine=np.diag(np.ones(4)),
+                            n_channels=n_channels, truth_dtype=np.uint8)
+    data_file.close()
+
+
+def time_batches(data_file, index_list, n_batches, batch_size, patch_shape, number_of_threads, loader=None):
+    start = time.time()
+    for _ in range(n_batches):
+        # the pool per batch pops the selected indices, each domain gets its own list
+        selected_source, selected_target = [[index_list[i] for i in np.random.choice(len(index_list), batch_size,
+                                                                                     replace=False)] for _ in range(2)]
+        get_batch_jdot(selected_source, selected_target, data_file, data_file, batch_size, 1, None, None, augment=True,
+                       patch_shape=patch_shape, skip_blank=False, permute=True, number_of_threads=number_of_threads,
+                       loader=loader)
+    return n_batches / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-image_size", default=64, type=int, help="Size of the cubic volumes")
+    parser.add_argument("-patch_size", default=16, type=int, help="Size of the cubic patches")
+    parser.add_argument("-n_samples", default=4, type=int, help="Number of volumes in the synthetic data file")
+    parser.add_argument("-batch_size", default=32, type=int, help="Number of patches per domain and batch")
+    parser.add_argument("-n_batches", default=10, type=int, help="Number of batches to time")
+    parser.add_argument("-number_of_threads", default=8, type=int, help="Number of workers")
+    parser.add_argument("-data_file", default="./benchmark_jdot_loader.h5", type=str, help="Temporary data file")
+    args = parser.parse_args()
+
+    image_shape = (args.image_size,) * 3
+    patch_shape = (args.patch_size,) * 3
+    create_synthetic_data_file(args.data_file, args.n_samples, 4, image_shape)
+    data_file = open_data_file(args.data_file)
+    index_list = create_patch_index_list(range(args.n_samples), image_shape, patch_shape, patch_overlap=0)
+    try:
+        pool_rate = time_batches(data_file, index_list, args.n_batches, args.batch_size, patch_shape,
+                                 args.number_of_threads)
+        loader = PatchLoader({"source": args.data_file, "target": args.data_file}, 4, patch_shape,
+                             max_batch_size=2 * args.batch_size, number_of_threads=args.number_of_threads)
+        try:
+            loader_rate = time_batches(data_file, index_list, args.n_batches, args.batch_size, patch_shape,
+                                       args.number_of_threads, loader=loader)
+        finally:
+            loader.close()
+    finally:
+        data_file.close()
+        os.remove(args.data_file)
+    print("Pool per batch:", round(pool_rate, 2), "batches/s")
+    print("PatchLoader:", round(loader_rate, 2), "batches/s, speedup", round(loader_rate / pool_rate, 1), "x")
+
+
+if __name__ == "__main__":
+    main()
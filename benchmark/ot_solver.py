@@ -0,0 +1,43 @@
+"""
+Benchmark of the OT solvers used to compute the JDOT coupling, for several batch sizes.
+
+Usage: python -m benchmark.ot_solver
+"""
+import argparse
+import time
+
+import numpy as np
+import ot
+
+from patches_comparaison.ot_solver import OTSolver, OT_SOLVERS
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-batch_sizes", default="10,64,256,512", type=str, help="Batch sizes to time")
+    parser.add_argument("-dimension", default=4096, type=int, help="Dimension of the representations")
+    parser.add_argument("-n_steps", default=10, type=int, help="Number of steps (solves) per solver")
+    parser.add_argument("-reg", default=0.01, type=float, help="Entropic regularization")
+    parser.add_argument("-float32", default="False", type=str, help="Solve in float32")
+    args = parser.parse_args()
+
+    random_state = np.random.RandomState(0)
+    for batch_size in [int(batch_size) for batch_size in args.batch_sizes.split(",")]:
+        print("Batch size:", batch_size)
+        source = random_state.rand(batch_size, args.dimension)
+        # Consecutive batches come from the same distributions: the costs are perturbations of each other
+        costs = [ot.dist(source + 0.01 * random_state.randn(*source.shape),
+                         source + 0.5 + 0.01 * random_state.randn(*source.shape)) for _ in range(args.n_steps)]
+        for method in OT_SOLVERS:
+            for warm_start in ([False] if method == "emd" else [False, True]):
+                solver = OTSolver(method, reg=args.reg, warm_start=warm_start, float32=args.float32 == "True")
+                start = time.time()
+                for cost in costs:
+                    solver.solve(cost)
+                step_time = (time.time() - start) / args.n_steps
+                print("  " + method + (" (warm start)" if warm_start else "") + ":",
+                      str(round(step_time * 1000, 2)) + "ms per step")
+
+
+if __name__ == "__main__":
+    main()
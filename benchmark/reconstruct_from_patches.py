@@ -0,0 +1,86 @@
+"""
+Benchmark of the patch stitching: masked reconstruction (previous implementation) against the accumulator.
+
+Usage: python -m benchmark.reconstruct_from_patches
+"""
+import argparse
+import time
+
+import numpy as np
+
+from unet3d.utils.patches import compute_patch_indices, get_patch_from_3d_data, reconstruct_from_patches
+
+
+def masked_reconstruct_from_patches(patches, patch_indices, data_shape, default_value=0):
+    """
+    Previous implementation of reconstruct_from_patches, kept as a reference: every patch allocates a full volume mask
+    and a full volume copy of the patch.
+    """
+    data = np.ones(data_shape) * default_value
+    image_shape = data_shape[-3:]
+    count = np.zeros(data_shape, dtype=int)
+    for patch, index in zip(patches, patch_indices):
+        index = np.copy(index)
+        image_patch_shape = patch.shape[-3:]
+        if np.any(index < 0):
+            fix_patch = np.asarray((index < 0) * np.abs(index), dtype=int)
+            patch = patch[..., fix_patch[0]:, fix_patch[1]:, fix_patch[2]:]
+            index[index < 0] = 0
+        if np.any((index + image_patch_shape) >= image_shape):
+            fix_patch = np.asarray(image_patch_shape - (((index + image_patch_shape) >= image_shape)
+                                                        * ((index + image_patch_shape) - image_shape)), dtype=int)
+            patch = patch[..., :fix_patch[0], :fix_patch[1], :fix_patch[2]]
+        patch_index = np.zeros(data_shape, dtype=bool)
+        patch_index[...,
+                    index[0]:index[0]+patch.shape[-3],
+                    index[1]:index[1]+patch.shape[-2],
+                    index[2]:index[2]+patch.shape[-1]] = True
+        patch_data = np.zeros(data_shape)
+        patch_data[patch_index] = patch.flatten()
+
+        new_data_index = np.logical_and(patch_index, np.logical_not(count > 0))
+        data[new_data_index] = patch_data[new_data_index]
+
+        averaged_data_index = np.logical_and(patch_index, count > 0)
+        if np.any(averaged_data_index):
+            data[averaged_data_index] = (data[averaged_data_index] * count[averaged_data_index]
+                                         + patch_data[averaged_data_index]) / (count[averaged_data_index] + 1)
+        count[patch_index] += 1
+    return data
+
+
+def time_function(function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    return time.time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-image_size", default=128, type=int, help="Size of the cubic volume")
+    parser.add_argument("-patch_size", default=16, type=int, help="Size of the cubic patches")
+    parser.add_argument("-overlaps", default="0,0.25,0.5", type=str, help="Overlaps as fractions of the patch size")
+    parser.add_argument("-skip_masked", default="False", type=str, help="Only time the accumulator")
+    args = parser.parse_args()
+
+    image_shape = (args.image_size,) * 3
+    patch_shape = (args.patch_size,) * 3
+    data = np.random.rand(*image_shape)
+    print("Volume:", image_shape, "Patch:", patch_shape)
+    for overlap in [float(overlap) for overlap in args.overlaps.split(",")]:
+        patch_overlap = int(overlap * args.patch_size)
+        indices = compute_patch_indices(image_shape, patch_shape, patch_overlap)
+        patches = [get_patch_from_3d_data(data, patch_shape, index) for index in indices]
+        accumulated_time, accumulated = time_function(reconstruct_from_patches, patches, indices, image_shape)
+        result = "Overlap " + str(overlap) + " (" + str(len(indices)) + " patches): accumulator " \
+                 + str(round(accumulated_time, 3)) + "s"
+        if args.skip_masked != "True":
+            masked_time, masked = time_function(masked_reconstruct_from_patches, patches, indices, image_shape)
+            result += ", masked " + str(round(masked_time, 3)) + "s, speedup " \
+                      + str(round(masked_time / accumulated_time, 1)) + "x, identical: " \
+                      + str(bool(np.array_equal(masked, accumulated)))
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark of the prediction throughput for each level of test-time augmentation: the permutations of a batch stacked
+in one model.predict call, against one model.predict call per patch and per permutation (previous behaviour).
+
+Usage: python -m benchmark.test_time_augmentation
+"""
+import argparse
+import time
+
+import numpy as np
+
+from unet3d.augment import permute_data, reverse_permute_data
+from unet3d.model import unet_model_3d
+from unet3d.prediction import get_test_time_permutation_keys, predict
+
+
+def predict_one_by_one(model, data, permutation_keys):
+    predictions = list()
+    for sample in data:
+        predictions.append(np.mean([reverse_permute_data(model.predict(permute_data(sample, key)[np.newaxis])[0], key)
+                                    for key in permutation_keys], axis=0))
+    return np.asarray(predictions)
+
+
+def time_prediction(function, n_batches):
+    start = time.time()
+    for _ in range(n_batches):
+        function()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n_channels", default=2, type=int, help="Number of modalities")
+    parser.add_argument("-patch_size", default=16, type=int, help="Size of the cubic patches")
+    parser.add_argument("-batch_size", default=10, type=int, help="Number of patches predicted together")
+    parser.add_argument("-n_batches", default=3, type=int, help="Number of batches predicted per level")
+    parser.add_argument("-max_samples", default=None, type=int,
+                        help="Maximum number of permuted patches per model.predict call")
+    args = parser.parse_args()
+
+    model = unet_model_3d((args.n_channels,) + (args.patch_size,) * 3, depth=3, n_base_filters=8)
+    data = np.random.rand(args.batch_size, args.n_channels, *(args.patch_size,) * 3).astype(np.float32)
+    n_patches = args.batch_size * args.n_batches
+    # The first call builds the prediction function of the model
+    model.predict(data)
+    elapsed = time_prediction(lambda: predict(model, data), args.n_batches)
+    print("no test-time augmentation: " + str(round(n_patches / elapsed, 1)) + " patches/s")
+    for permute in ("flip", "all"):
+        permutation_keys = get_test_time_permutation_keys(permute)
+        stacked = time_prediction(lambda: predict(model, data, permute=permute, max_samples=args.max_samples),
+                                  args.n_batches)
+        one_by_one = time_prediction(lambda: predict_one_by_one(model, data, permutation_keys), args.n_batches)
+        print(permute + " (" + str(len(permutation_keys)) + " permutations): stacked "
+              + str(round(n_patches / stacked, 1)) + " patches/s, one call per permutation "
+              + str(round(n_patches / one_by_one, 1)) + " patches/s (x" + str(round(one_by_one / stacked, 1)) + ")")
+
+
+if __name__ == "__main__":
+    main()
@@ -40,7 +40,18 @@ class Config:
         self.target_center = target_center
 
         self.number_of_threads = 64 # Number of threads used when loading the data
+        self.persistent_loader = True  # If True, the loading workers (at most one per CPU) are created once instead of for every batch.
+        self.batch_augmentation = True  # If True, the batches in memory are augmented in the training process, the patches sharing a transform together, instead of one worker task per patch.
         self.load_all_data = False  # Parameter to load all the data directly in memory. Set it to false if you don't have much ram available.
+        self.prefetch_depth = 0  # Number of batches loaded in the background while the model is trained. 0 loads each batch when it is needed.
+        self.seed = None  # Seed of the selection (and augmentation) of the batches. None for a different order at each run.
+        self.patch_cache = False  # If True (and load_all_data is False), the patches are extracted once to memory-mapped files in Data/generated_data/patch_cache and the batches are read from them.
+        self.chunk_shape = None  # Spatial shape of the hdf5 chunks of the written data files, e.g. (16, 16, 16), so that reading a patch only decompresses the chunks it intersects. None lets PyTables choose.
+        self.complib = "blosc"  # Compression of the written data files: blosc, blosc:lz4, blosc:zstd, zlib... or none
+        self.complevel = 5  # Compression level of the written data files (0 to 9)
+        self.ingestion_processes = None  # Number of processes reading the NIfTI images when writing the data files. None for one per CPU.
+        self.normalization = "subject"  # Statistics of the intensity normalization of the data files: subject, dataset (all the subjects of the file) or center
+        self.normalization_server = None  # Directory through which the source and target centers share their intensity statistics (see federated/normalization.py) to normalize their data files with the pooled statistics. None keeps the local normalization.
 
         self.labels=(1)
         self.n_labels=1 # Number of labels JDOT never was tested with more than one parameter.
@@ -73,6 +84,22 @@ class Config:
         self.alpha_factor = alpha_factor
         self.depth_jdot = OT_depth # 5 is the middle layer (with the smallest representation) 9 is the deepest layer
         self.jdot_distance = distance #Distance used for the computation of gamma (sqeuclidean or dice)
+        self.jdot_feature_mode = "predict"  # Outputs used for gamma: predict (additional forward pass), stale (cached from the last training step on the patches) or encoder (encoder pass + cached segmentation)
+        self.jdot_activation_max_age = 1  # Maximum number of epochs since the cached outputs of a patch were computed for them to be used in stale or encoder mode (older ones are recomputed), 1 uses the outputs of the previous epoch. None uses them whatever their age
+        self.jdot_global_coupling = False  # If True, the target patches of each batch are drawn from an approximate coupling between all the source and target patches (needs load_all_data or patch_cache)
+        self.global_coupling_every = 0  # Number of steps between two computations of the global coupling. 0 computes it once per epoch
+        self.global_coupling_k = 10  # Number of target patches kept in the coupling of each source patch
+        self.global_coupling_reg = 0.05  # Entropic regularization of the global coupling
+        self.target_sketch_size = None  # If not None (with jdot_global_coupling), the global coupling is computed against a k-means sketch of the target embeddings with this number of clusters, sent through sketch_dir instead of the embeddings (see federated/sketch.py)
+        self.target_sketch_projection = None  # Dimension of the random projection of the embeddings before the sketch. None keeps them
+        self.sketch_codec = "float16"  # Compression of the centroids of the sketch: none, float16, int8 or topk
+        self.ot_solver = "emd"  # Solver of gamma: emd (exact), sinkhorn, sinkhorn_log, sinkhorn_stabilized or sinkhorn_unbalanced
+        self.ot_reg = 0.01  # Entropic regularization of the sinkhorn solvers (the cost is normalized by its maximum)
+        self.ot_reg_m = 1.0  # Marginal relaxation of sinkhorn_unbalanced
+        self.ot_warm_start = True  # If True, the sinkhorn solvers start from the dual potentials of the previous batch
+        self.ot_float32 = False  # If True, gamma is computed in float32
+        self.cost_float32 = True  # If True, the cost matrix of gamma is computed in float32
+        self.cost_block_size = None  # If not None, the cost matrix is computed by blocks of this number of source samples
 
         '''
         If augmentation is set to true, both flip and permutation transforms are taken into account.
@@ -88,12 +115,24 @@ class Config:
         self.ceil = intensity_ceil #Intensity ceil to select the patches
         print(self.ceil)
         self.save_image = False
+        self.test_time_augmentation = False  # Predictions averaged at evaluation: False, "flip" (8 flips of the axes) or "all" (48 symmetries of the cube, the patches must be cubes)
+        self.prediction_batch_size = None  # Number of patches per model.predict call at evaluation, pooled across the test subjects. None fits prediction_memory_budget.
+        self.prediction_memory_budget = 2 ** 30  # Memory (in bytes) of the inputs, layer outputs and predictions of one evaluation batch, when prediction_batch_size is None
 
-        self.overwrite_data = True # If True, will previous files. If False, will use previously written files.
+        self.overwrite_data = True # If True, the data files are updated: the subjects whose input files changed are written again (see unet3d.data.update_data_file). If False, will use previously written files.
         self.change_validation = True # If true, a new validation split will be created with the force list passed in the parameters. Otherwise if an already saved validation split exists, it will be loaded
         self.split_list = split_list # Tuple of tuples, first level is for source/target, second level is for training/validation
 
         self.overwrite_model = True
+
+        self.federated = False  # If True, main.py trains the model with federated/training.py instead of Train_JDOT
+        self.federated_centers = ["01", "07", "08"]  # Centers of the federated training, each one trains on its own data file in its own process
+        self.federated_rounds = 10  # Number of communication rounds of the federated training
+        self.federated_local_epochs = 1  # Epochs of local training of each center per round
+        self.federated_processes = 1  # Number of centers trained at the same time
+        self.federated_mu = 0.  # Weight of the FedProx proximal term keeping the local weights close to the global ones. 0 for FedAvg
+        self.federated_codec = "none"  # Compression of the weight differences exchanged after the first round: none (float32), float16, int8 or topk (see federated/transport.py)
+        self.federated_topk = 0.01  # Fraction of the values of each weight tensor sent by the topk codec
         self.load_base_model = load_model
 
 
@@ -121,6 +160,9 @@ class Config:
         self.training_file_target = os.path.abspath("Data/generated_data/"+self.data_set+"_isensee_training_ids_center_"+str(self.target_center)+".pkl")
         self.validation_file_target = os.path.abspath("Data/generated_data/"+self.data_set+"_isensee_validation_ids_center_"+str(self.target_center)+".pkl")
 
+        self.sketch_dir = os.path.abspath("Data/generated_data/sketches_rev" + str(self.rev))  # Directory standing in for the channel through which the target site sends the sketch of its embeddings
+        self.federated_dir = os.path.abspath("Data/generated_data/federated_rev" + str(self.rev))  # Directory through which the coordinator and the centers exchange the weights, with the log of the rounds
+
         # The directories where the results will be saved.
         self.save_dir =  os.path.abspath("results/prediction/rev_" + str(self.rev))
         self.prediction_dir = os.path.abspath("results/prediction/rev_" + str(self.rev) + "/prediction_" + self.data_set)
@@ -0,0 +1,17 @@
+import numpy as np
+
+
+def federated_average(weights, counts):
+    '''
+    FedAvg: average of the weights of the centers, weighted by the number of patches each center trained on.
+    :param weights: List with the list of weight arrays of each center (as returned by model.get_weights()).
+    :param counts: Number of training patches of each center.
+    :return: List of the averaged weight arrays
+    '''
+    counts = np.asarray(counts, dtype=np.float64)
+    if counts.sum() == 0:
+        counts = np.ones(len(weights))
+    fractions = counts / counts.sum()
+    return [np.sum([center_weights[index] * fraction for center_weights, fraction in zip(weights, fractions)],
+                   axis=0).astype(weights[0][index].dtype)
+            for index in range(len(weights[0]))]
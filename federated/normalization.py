@@ -0,0 +1,277 @@
+"""
+Harmonized intensity normalization of several centers that do not share their images.
+Each center summarizes its own data file with sufficient statistics: the number of voxels, the mean and the sum of
+squared deviations of each modality (ChannelMoments), its extrema and a histogram. Only these summaries go through
+the server, here a directory shared by the centers. The server pools them and every center normalizes its data file
+with the pooled statistics, as if the images of all the centers were in a single dataset.
+"""
+import os
+import glob
+import json
+import hashlib
+
+import numpy as np
+
+from unet3d.data import open_data_file
+from unet3d.normalize import (ChannelMoments, get_slabs, get_normalization, get_normalization_parameters,
+                              apply_normalization)
+
+
+class NormalizationServer:
+    """
+    File based stand-in for the server. Each center publishes its summary as center_<name>.json, the pooled summary is
+    aggregate.json. The aggregation is incremental: a new center is merged into the previous aggregate, the summaries
+    of the other centers are only read again when one of them was published anew.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.aggregate_path = os.path.join(directory, "aggregate.json")
+
+    def get_summary_path(self, center):
+        return os.path.join(self.directory, "center_" + str(center) + ".json")
+
+    def publish(self, center, summary):
+        summary = dict(summary, center=str(center))
+        summary["digest"] = get_digest(summary)
+        path = self.get_summary_path(center)
+        # The same summary is not written again
+        if not os.path.exists(path) or load_json(path)["digest"] != summary["digest"]:
+            save_json(summary, path)
+        return summary
+
+    def load_summaries(self):
+        summaries = [load_json(path) for path in glob.glob(os.path.join(self.directory, "center_*.json"))]
+        return {summary["center"]: summary for summary in summaries}
+
+    def aggregate(self):
+        '''
+        :return: Pooled summary of all the published centers, with the digest of each merged summary in "centers".
+        '''
+        summaries = self.load_summaries()
+        aggregate = load_json(self.aggregate_path) if os.path.exists(self.aggregate_path) else None
+        if aggregate is None or any(center not in summaries or summaries[center]["digest"] != digest
+                                    for center, digest in aggregate["centers"].items()):
+            aggregate = None
+        new_centers = sorted(center for center in summaries if aggregate is None or center not in aggregate["centers"])
+        for center in new_centers:
+            centers = dict(aggregate["centers"]) if aggregate else dict()
+            centers[center] = summaries[center]["digest"]
+            aggregate = merge_summaries(aggregate, summaries[center]) if aggregate else dict(summaries[center])
+            aggregate["centers"] = centers
+        if aggregate is None:
+            raise ValueError("No center has published its statistics in " + self.directory + ".")
+        if new_centers:
+            aggregate.pop("center", None)
+            aggregate.pop("digest", None)
+            save_json(aggregate, self.aggregate_path)
+        return aggregate
+
+
+def get_digest(summary):
+    return hashlib.sha1(json.dumps(summary, sort_keys=True).encode()).hexdigest()
+
+
+def load_json(path):
+    with open(path, "r") as opened_file:
+        return json.load(opened_file)
+
+
+def save_json(obj, path):
+    # A center reading the directory never sees a partially written file
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as opened_file:
+        json.dump(obj, opened_file)
+    os.replace(temporary_path, path)
+
+
+def read_raw_slab(data_storage, index, slab, parameters):
+    '''
+    Reads a slab of a subject, without the normalization applied by normalize_data_storage if any.
+    '''
+    data = np.asarray(data_storage[index, :, slab], dtype=np.float64)
+    if parameters is None:
+        return data
+    shape = (-1, 1, 1, 1)
+    return (data - parameters["offset"][index].reshape(shape)) / parameters["scale"][index].reshape(shape)
+
+
+def get_center_summary(data_storage, n_bins=256):
+    '''
+    Sufficient statistics of the raw intensities of all the subjects of a data file. The histogram of each modality
+    spans the range of the center, which is only known after a first pass, so the histograms are filled in a second
+    pass.
+    :param data_storage: Data array of the data file of the center.
+    :param n_bins: Number of bins of the histograms.
+    :return: Dictionary with the statistics (see ChannelMoments.get_statistics), the histogram of each modality and
+    its range.
+    '''
+    parameters = get_normalization_parameters(data_storage)
+    n_channels = data_storage.shape[1]
+    moments = ChannelMoments(n_channels)
+    for index in range(data_storage.shape[0]):
+        for slab in get_slabs(data_storage):
+            moments.update(read_raw_slab(data_storage, index, slab, parameters))
+    value_range = [get_histogram_range(low, high) for low, high in zip(moments.min, moments.max)]
+    histogram = np.zeros((n_channels, n_bins))
+    for index in range(data_storage.shape[0]):
+        for slab in get_slabs(data_storage):
+            data = read_raw_slab(data_storage, index, slab, parameters)
+            for channel in range(n_channels):
+                histogram[channel] += np.histogram(data[channel], bins=n_bins, range=value_range[channel])[0]
+    return {"statistics": moments.get_statistics(), "histogram": histogram.tolist(), "range": value_range}
+
+
+def get_data_file_summary(path, n_bins=256):
+    '''
+    Summary of a data file (see get_center_summary), saved in the attributes of its data storage. The raw intensities
+    read back from a normalized data file change with the rounding of each normalization: the summary is computed once
+    per data file, so that the published digest and the pooled statistics stay the same from one run to the next.
+    :param path: Path of the data file.
+    '''
+    data_file = open_data_file(path)
+    try:
+        summary = load_saved_summary(data_file.root.data, n_bins)
+    finally:
+        data_file.close()
+    if summary is None:
+        data_file = open_data_file(path, readwrite="a")
+        try:
+            summary = get_center_summary(data_file.root.data, n_bins=n_bins)
+            data_file.root.data.attrs.center_summary = json.dumps(summary)
+        finally:
+            data_file.close()
+    return summary
+
+
+def load_saved_summary(data_storage, n_bins):
+    if "center_summary" not in data_storage.attrs:
+        return None
+    summary = json.loads(data_storage.attrs.center_summary)
+    return summary if len(summary["histogram"][0]) == n_bins else None
+
+
+def get_histogram_range(low, high):
+    return [float(low), float(high) if high > low else float(low) + 1]
+
+
+def resample_histogram(histogram, value_range, edges):
+    '''
+    Counts of a histogram over other bin edges, assuming the voxels are uniformly spread in each bin.
+    '''
+    histogram = np.asarray(histogram, dtype=np.float64)
+    cumulative = np.concatenate([[0], np.cumsum(histogram)])
+    return np.diff(np.interp(edges, np.linspace(value_range[0], value_range[1], len(histogram) + 1), cumulative))
+
+
+def merge_summaries(first, second):
+    '''
+    Summary of the union of the voxels of two summaries. The histograms are resampled over the union of their ranges,
+    with the number of bins of the first one.
+    '''
+    moments = ChannelMoments.from_statistics(first["statistics"]).merge(
+        ChannelMoments.from_statistics(second["statistics"]))
+    n_bins = len(first["histogram"][0])
+    value_range, histogram = [], []
+    for channel in range(len(first["histogram"])):
+        channel_range = get_histogram_range(min(first["range"][channel][0], second["range"][channel][0]),
+                                            max(first["range"][channel][1], second["range"][channel][1]))
+        edges = np.linspace(channel_range[0], channel_range[1], n_bins + 1)
+        histogram.append((resample_histogram(first["histogram"][channel], first["range"][channel], edges)
+                          + resample_histogram(second["histogram"][channel], second["range"][channel], edges)).tolist())
+        value_range.append(channel_range)
+    return {"statistics": moments.get_statistics(), "histogram": histogram, "range": value_range}
+
+
+def get_histogram_percentiles(summary, percentiles):
+    '''
+    :param percentiles: Percentiles between 0 and 100.
+    :return: Array of shape (n_channels, len(percentiles)) with the percentiles of each modality.
+    '''
+    values = []
+    for histogram, value_range in zip(summary["histogram"], summary["range"]):
+        cumulative = np.concatenate([[0], np.cumsum(histogram)])
+        edges = np.linspace(value_range[0], value_range[1], len(histogram) + 1)
+        values.append(np.interp(np.asarray(percentiles) / 100. * cumulative[-1], cumulative, edges))
+    return np.asarray(values)
+
+
+def get_harmonized_statistics(aggregate, percentiles=None):
+    '''
+    Statistics of the harmonized normalization, see unet3d.normalize.get_normalization.
+    :param aggregate: Pooled summary returned by NormalizationServer.aggregate.
+    :param percentiles: (low, high) percentiles of the pooled histograms used instead of the extrema to rescale the
+    intensities, e.g. (0.5, 99.5) to be robust to outliers. The intensities beyond them fall outside [0, 1].
+    '''
+    statistics = dict(aggregate["statistics"])
+    if percentiles is not None:
+        bounds = get_histogram_percentiles(aggregate, percentiles)
+        statistics["min"], statistics["max"] = bounds[:, 0].tolist(), bounds[:, 1].tolist()
+    return statistics
+
+
+def harmonize_data_storage(data_storage, statistics):
+    '''
+    Normalizes all the subjects of a data file with the pooled statistics, in place and in a single pass. A previous
+    normalization (local or with other pooled statistics) is undone in the same pass. The digest of the statistics is
+    saved in the attributes of the storage: the data file is left untouched when it was already normalized with them.
+    '''
+    if is_harmonized(data_storage, statistics):
+        return data_storage
+    parameters = get_normalization_parameters(data_storage)
+    n_subjects = data_storage.shape[0]
+    scale, offset = get_normalization(statistics)
+    for index in range(n_subjects):
+        if parameters is None:
+            apply_normalization(data_storage, index, scale, offset)
+        else:
+            previous_scale, previous_offset = parameters["scale"][index], parameters["offset"][index]
+            apply_normalization(data_storage, index, scale / previous_scale,
+                                offset - previous_offset * scale / previous_scale)
+    data_storage.attrs.normalization = json.dumps({"mode": "federated", "groups": ["federated"] * n_subjects,
+                                                   "statistics": {"federated": statistics}})
+    data_storage.attrs.normalization_scale = np.tile(scale, (n_subjects, 1))
+    data_storage.attrs.normalization_offset = np.tile(offset, (n_subjects, 1))
+    data_storage.attrs.normalization_digest = get_digest(statistics)
+    return data_storage
+
+
+def is_harmonized(data_storage, statistics):
+    parameters = get_normalization_parameters(data_storage)
+    return parameters is not None and parameters["mode"] == "federated" \
+        and "normalization_digest" in data_storage.attrs \
+        and data_storage.attrs.normalization_digest == get_digest(statistics)
+
+
+def harmonize_data_file(path, statistics):
+    '''
+    Normalizes a data file with the pooled statistics, see harmonize_data_storage. The data file is only opened for
+    writing if it was not normalized with them yet, so that it is not modified.
+    '''
+    data_file = open_data_file(path)
+    try:
+        if is_harmonized(data_file.root.data, statistics):
+            return
+    finally:
+        data_file.close()
+    data_file = open_data_file(path, readwrite="a")
+    try:
+        harmonize_data_storage(data_file.root.data, statistics)
+    finally:
+        data_file.close()
+
+
+def harmonize_centers(server, data_files):
+    '''
+    Each center publishes the summary of its data file on the server, then normalizes it with the pooled statistics.
+    No center reads the images of another one.
+    :param server: NormalizationServer shared by the centers.
+    :param data_files: Path of the data file of each center, by center name.
+    :return: The pooled statistics, to normalize other data files of the centers (e.g. the testing data file).
+    '''
+    for center, path in data_files.items():
+        server.publish(center, get_data_file_summary(path))
+    statistics = get_harmonized_statistics(server.aggregate())
+    for path in data_files.values():
+        harmonize_data_file(path, statistics)
+    return statistics
@@ -0,0 +1,172 @@
+"""
+Optimal transport against a sketch of the target embeddings, so that the embeddings of the target patches never leave
+the target site. The target site clusters the embeddings of its patches (k-means, after an optional random projection
+that both sites generate from the same seed) and only sends the centroids and the weight of each cluster. The source
+site solves the OT problem between its embeddings and the weighted centroids, and asks the target site for patches
+of the clusters coupled with its batches.
+"""
+import os
+import time
+import struct
+
+import numpy as np
+import ot
+from scipy import sparse
+
+from patches_comparaison.global_coupling import get_nearest_neighbours
+from patches_comparaison.ot_solver import OTSolver
+from federated.transport import serialize, deserialize, save_payload, load_payload
+
+
+def project(embeddings, projection_dim=None, seed=0):
+    '''
+    Gaussian random projection, generated from the seed so that both sites project the same way.
+    '''
+    embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+    if not projection_dim:
+        return embeddings
+    matrix = np.random.RandomState(seed).randn(embeddings.shape[1], projection_dim) / np.sqrt(projection_dim)
+    return np.dot(embeddings, matrix.astype(np.float32))
+
+
+def kmeans(samples, k, n_iter=20, random_state=None):
+    '''
+    Lloyd's algorithm with a k-means++ initialization.
+    :return: The centroids (at most k, the empty clusters are removed) and the cluster of each sample
+    '''
+    random_state = random_state or np.random.RandomState(0)
+    k = min(k, len(samples))
+    centroids = [samples[random_state.randint(len(samples))]]
+    distances = np.sum(np.square(samples - centroids[0]), axis=1)
+    for _ in range(1, k):
+        probabilities = distances / distances.sum() if distances.sum() > 0 else None
+        centroids.append(samples[random_state.choice(len(samples), p=probabilities)])
+        distances = np.minimum(distances, np.sum(np.square(samples - centroids[-1]), axis=1))
+    centroids = np.asarray(centroids, dtype=np.float32)
+    assignment = None
+    for _ in range(n_iter):
+        new_assignment = get_nearest_neighbours(samples, centroids, 1)[0][:, 0]
+        if assignment is not None and np.array_equal(new_assignment, assignment):
+            break
+        assignment = new_assignment
+        counts = np.bincount(assignment, minlength=len(centroids))
+        sums = sparse.csr_matrix((np.ones(len(samples)), (assignment, np.arange(len(samples)))),
+                                 shape=(len(centroids), len(samples))).dot(samples)
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, np.newaxis]
+    kept = np.unique(assignment)
+    return centroids[kept], np.searchsorted(kept, assignment)
+
+
+class FeatureSketch:
+    """
+    What the target site sends: the centroids of the clusters of its embeddings, their weights, and the random
+    projection applied to the embeddings.
+    """
+    def __init__(self, centroids, weights, projection_dim=None, seed=0):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.projection_dim = projection_dim
+        self.seed = seed
+
+    def to_bytes(self, codec="none"):
+        '''
+        :param codec: Compression of the centroids, see federated.transport.CODECS.
+        '''
+        centroids = serialize([self.centroids], codec=codec)
+        description = serialize([self.weights.astype(np.float32),
+                                 np.asarray([self.projection_dim or 0], dtype=np.float32)])
+        return struct.pack("<IQ", len(centroids), self.seed) + centroids + description
+
+    @classmethod
+    def from_bytes(cls, payload):
+        size, seed = struct.unpack_from("<IQ", payload, 0)
+        start = struct.calcsize("<IQ")
+        centroids, = deserialize(payload[start:start + size])
+        weights, projection_dim = deserialize(payload[start + size:])
+        return cls(centroids, weights / weights.sum(), projection_dim=int(projection_dim[0]) or None, seed=seed)
+
+
+class TargetSketch:
+    """
+    Sketch of the embeddings of the patches of the target site. The cluster of each patch stays on the target site.
+    """
+    def __init__(self, embeddings, size=64, projection_dim=None, seed=0, n_iter=20):
+        '''
+        :param embeddings: Embeddings of the target patches, shape (n_patches, d).
+        :param size: Number of clusters.
+        :param projection_dim: Dimension of the random projection of the embeddings, None to keep them.
+        :param seed: Seed of the projection and of the clustering.
+        '''
+        centroids, assignment = kmeans(project(embeddings, projection_dim, seed), size, n_iter=n_iter,
+                                       random_state=np.random.RandomState(seed))
+        self.members = [np.flatnonzero(assignment == cluster) for cluster in range(len(centroids))]
+        self.sketch = FeatureSketch(centroids, np.bincount(assignment) / float(len(assignment)),
+                                    projection_dim=projection_dim, seed=seed)
+
+    def sample_members(self, clusters, random_state):
+        '''
+        :return: A patch of each of the requested clusters
+        '''
+        return np.asarray([self.members[cluster][random_state.randint(len(self.members[cluster]))]
+                           for cluster in clusters], dtype=np.int64)
+
+
+class SketchCoupling:
+    """
+    Optimal transport plan between the source patches and the clusters of a sketch of the target patches. It has the
+    interface of GlobalCoupling: the target patches of a batch are drawn from the clusters coupled with its source
+    patches, by the target site.
+    """
+    def __init__(self, source_embeddings, sketch, sample_members, solver=None):
+        '''
+        :param source_embeddings: Embeddings of the source patches, shape (n_patches, d).
+        :param sketch: FeatureSketch received from the target site.
+        :param sample_members: Function returning a target patch of each requested cluster (see
+        TargetSketch.sample_members), the request sent to the target site.
+        :param solver: OTSolver, exact by default.
+        '''
+        source = project(source_embeddings, sketch.projection_dim, sketch.seed)
+        cost = ot.dist(source, sketch.centroids)
+        self.plan = (solver or OTSolver("emd")).solve(cost, b=sketch.weights)
+        self.sample_members = sample_members
+
+    def sample_clusters(self, source_positions, random_state):
+        clusters = np.empty(len(source_positions), dtype=np.int64)
+        for i, position in enumerate(source_positions):
+            weights = np.maximum(self.plan[position], 0)
+            clusters[i] = random_state.choice(len(weights), p=weights / weights.sum())
+        return clusters
+
+    def sample_targets(self, source_positions, random_state):
+        return self.sample_members(self.sample_clusters(source_positions, random_state), random_state)
+
+
+class SketchChannel:
+    """
+    Local directory standing in for the channel between the sites.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, name):
+        return os.path.join(self.directory, str(name) + ".sketch")
+
+    def send(self, name, sketch, codec="none"):
+        '''
+        :return: Number of bytes sent
+        '''
+        return save_payload(self.get_path(name), sketch.to_bytes(codec=codec))
+
+    def receive(self, name, timeout=None, poll_interval=1.):
+        '''
+        Waits for the sketch if it was not sent yet.
+        :param timeout: Maximum waiting time in seconds, None to wait indefinitely.
+        '''
+        start = time.time()
+        while not os.path.exists(self.get_path(name)):
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError("No sketch " + str(name) + " was received in " + self.directory + ".")
+            time.sleep(poll_interval)
+        return FeatureSketch.from_bytes(load_payload(self.get_path(name)))
@@ -0,0 +1,323 @@
+"""
+Federated training of the segmentation model, with every center simulated by a process on the same machine. The
+processes of the centers are not daemonic, so that they can start the workers of their own data loading.
+At each round the coordinator writes the global weights in a directory shared with the centers. Each center loads
+them, trains a few local epochs on its own data file (train_model_on_source, or the JDOT step with the target data
+file) and writes its weights back. The coordinator averages them, weighted by the number of training patches of each
+center (FedAvg). With config.federated_mu > 0, the local objective has the FedProx proximal term
+mu / 2 * ||w - w_global||^2.
+After the first round, the weights go through the directory as compressed differences with the weights the other side
+already holds (config.federated_codec, see federated.transport). The copy of the global weights of each center and
+the compression errors of its updates are kept in its own directory, the round directories only hold what is sent.
+"""
+import os
+import copy
+import time
+import shutil
+import queue
+import traceback
+import multiprocessing
+
+import numpy as np
+from keras import backend as K
+
+from unet3d.data import update_data_file, open_data_file
+from unet3d.model import isensee2017_model
+from unet3d.prediction import predict_validation_cases
+from unet3d.utils import pickle_load
+from patches_comparaison.JDOT import JDOT
+from patches_comparaison.train_jdot import Train_JDOT, get_center_name
+from training_testing import create_test
+from federated.aggregation import federated_average
+from federated.transport import (DeltaEncoder, save_weights, load_weights, save_payload, load_payload, serialize,
+                                 deserialize, apply_delta)
+from federated.normalization import NormalizationServer, harmonize_centers
+
+
+class FederatedTraining:
+    """
+    Coordinator of the federated training. The self.config object contains all information on the configuration
+    (cf config.py), the centers are config.federated_centers.
+    """
+    def __init__(self, conf):
+        self.config = conf
+        self.directory = conf.federated_dir
+        self.log_file = os.path.join(self.directory, "rounds.csv")
+        # Global weights as held by the centers, and compression of the differences sent to them
+        self.shared_weights = None
+        self.encoder = DeltaEncoder(conf.federated_codec, fraction=conf.federated_topk, error_feedback=False)
+
+    def main(self, overwrite_data=True):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.write_data_files(overwrite_data)
+        weights = self.get_initial_weights()
+        with open(self.log_file, "w") as log_file:
+            log_file.write("round,seconds,bytes_sent,bytes_received,patches,validation_dice,validation_dice_source,"
+                           "validation_dice_target\n")
+        for round_index in range(self.config.federated_rounds):
+            weights = self.train_round(round_index, weights)
+        model = self.build_model()
+        model.set_weights(weights)
+        model.save(self.config.model_file)
+        self.evaluate_model(model)
+
+    def evaluate_model(self, model):
+        '''
+        Predicts the testing subjects with the global model, like JDOT.evaluate_model, for training_testing/evaluate.py.
+        '''
+        test = create_test.Test(self.config)
+        test.main(overwrite_data=self.config.overwrite_data)
+        data_file = open_data_file(self.config.data_file)
+        try:
+            predict_validation_cases(model, data_file, pickle_load(self.config.validation_file),
+                                     self.config.training_modalities, output_label_map=True,
+                                     output_dir=self.config.prediction_dir, labels=self.config.labels,
+                                     overlap=self.config.validation_patch_overlap,
+                                     permute=self.config.test_time_augmentation, save_image=self.config.save_image,
+                                     batch_size=self.config.prediction_batch_size,
+                                     memory_budget=self.config.prediction_memory_budget)
+        finally:
+            data_file.close()
+
+    def get_center_config(self, center):
+        '''
+        Configuration of the local training of a center: its data file is the source, its splits, models and
+        histories are its own.
+        '''
+        center_config = copy.copy(self.config)
+        center_config.source_center = center
+        center_config.source_data_file = get_center_data_file(self.config, get_center_name(center))
+        center_config.target_data_file = get_center_data_file(self.config, get_center_name(self.config.target_center))
+        center_config.training_file_source = os.path.abspath("Data/generated_data/" + self.config.data_set
+                                                              + "_isensee_training_ids_center_" + str(center) + ".pkl")
+        center_config.validation_file_source = os.path.abspath("Data/generated_data/" + self.config.data_set
+                                                                + "_isensee_validation_ids_center_" + str(center)
+                                                                + ".pkl")
+        center_config.save_dir = os.path.join(self.directory, "center_" + str(center))
+        center_config.model_file = os.path.join(center_config.save_dir, "model.h5")
+        center_config.load_base_model = False
+        center_config.callback = False
+        return center_config
+
+    def write_data_files(self, overwrite_data=True):
+        '''
+        Writes the data file of each center and of the target center of JDOT, and normalizes them with pooled
+        statistics if config.normalization_server is set.
+        '''
+        centers = list(self.config.federated_centers)
+        target_center = get_center_name(self.config.target_center)
+        if target_center not in centers:
+            centers.append(target_center)
+        for center in centers:
+            center_config = self.get_center_config(center)
+            if os.path.exists(center_config.source_data_file) and not overwrite_data:
+                continue
+            data_files, _, subject_ids, _ = Train_JDOT(center_config).fetch_training_data_files(return_subject_ids=True)
+            update_data_file(data_files, center_config.source_data_file, image_shape=self.config.image_shape,
+                             subject_ids=subject_ids, chunk_shape=self.config.chunk_shape,
+                             complib=self.config.complib, complevel=self.config.complevel,
+                             n_processes=self.config.ingestion_processes,
+                             normalization=self.config.normalization)
+        if self.config.normalization_server:
+            harmonize_centers(NormalizationServer(self.config.normalization_server),
+                              {center: get_center_data_file(self.config, center) for center in centers})
+
+    def build_model(self):
+        model, _ = build_model(self.config)
+        return model
+
+    def get_initial_weights(self):
+        model = self.build_model()
+        if self.config.load_base_model:
+            print("Loading trained model")
+            model.load_weights(os.path.abspath("Data/saved_models/model_center_" + str(self.config.source_center))
+                               + ".h5")
+        weights = model.get_weights()
+        K.clear_session()
+        return weights
+
+    def train_round(self, round_index, weights, train_function=None):
+        '''
+        One communication round: the centers train from the global weights, then their weights are averaged.
+        :param train_function: Local training of a center, run in its own process (default: train_center).
+        :return: The new global weights
+        '''
+        start = time.time()
+        round_dir = os.path.join(self.directory, "round_" + str(round_index))
+        if not os.path.exists(round_dir):
+            os.makedirs(round_dir)
+        global_file = os.path.join(round_dir, "global.bin")
+        if self.shared_weights is None:
+            # The centers do not hold any weights yet
+            payload = serialize(weights)
+            self.shared_weights = [np.array(array) for array in weights]
+        else:
+            payload = self.encoder.encode(weights, self.shared_weights)
+            self.shared_weights = apply_delta(self.shared_weights, deserialize(payload))
+        global_size = save_payload(global_file, payload)
+        tasks = [(self.get_center_config(center), global_file, os.path.join(round_dir, "center_" + str(center) + ".bin"),
+                  round_index == 0) for center in self.config.federated_centers]
+        results = run_in_processes(train_function or train_center, tasks, self.config.federated_processes)
+        counts = [result["n_patches"] for result in results]
+        weights = federated_average([apply_delta(self.shared_weights, deserialize(load_payload(result["update_file"])))
+                                     for result in results], counts)
+        seconds = time.time() - start
+        bytes_sent = global_size * len(tasks)
+        bytes_received = sum(result["bytes"] for result in results)
+        # Validation scores of the local models, weighted like their weights
+        dice = np.average([result["dice"] for result in results], axis=0, weights=np.asarray(counts) + 1e-12)
+        print("Round", round_index + 1, "/", self.config.federated_rounds, ":", round(seconds, 2), "s,",
+              bytes_sent, "bytes sent,", bytes_received, "bytes received,", sum(counts), "patches,",
+              "validation dice", dice[0])
+        with open(self.log_file, "a") as log_file:
+            log_file.write(",".join([str(round_index), str(seconds), str(bytes_sent), str(bytes_received),
+                                     str(sum(counts))] + [str(value) for value in dice]) + "\n")
+        # Only the weights of the last round are kept
+        previous_dir = os.path.join(self.directory, "round_" + str(round_index - 1))
+        if os.path.exists(previous_dir):
+            shutil.rmtree(previous_dir)
+        return weights
+
+
+def get_center_data_file(config, center):
+    '''
+    :param center: Name of the center, e.g. "07" (see get_center_name).
+    '''
+    return os.path.abspath("Data/generated_data/" + config.data_set + "_data_center_" + center + ".h5")
+
+
+def run_in_processes(function, tasks, n_processes):
+    '''
+    Runs function(task) for each task in a new spawned process, with at most n_processes at the same time. Unlike the
+    workers of a multiprocessing Pool, the processes are not daemonic and can start their own workers.
+    :return: The results, in the order of the tasks
+    '''
+    context = multiprocessing.get_context("spawn")
+    results_queue = context.Queue()
+    pending = list(enumerate(tasks))
+    running = dict()
+    results = [None] * len(tasks)
+    try:
+        while pending or running:
+            while pending and len(running) < n_processes:
+                index, task = pending.pop(0)
+                running[index] = context.Process(target=run_task, args=(function, index, task, results_queue))
+                running[index].start()
+            try:
+                index, result, error = results_queue.get(timeout=1)
+            except queue.Empty:
+                # A process killed before sending its result
+                for index, process in running.items():
+                    if process.exitcode not in (None, 0):
+                        raise RuntimeError("The process of task " + str(index) + " exited with code "
+                                           + str(process.exitcode))
+                continue
+            running.pop(index).join()
+            if error is not None:
+                raise RuntimeError("Task " + str(index) + " failed:\n" + error)
+            results[index] = result
+    finally:
+        for process in running.values():
+            process.terminate()
+            process.join()
+    return results
+
+
+def run_task(function, index, task, results_queue):
+    try:
+        results_queue.put((index, function(task), None))
+    except Exception:
+        results_queue.put((index, None, traceback.format_exc()))
+
+
+def build_model(config):
+    model, context_output_name = isensee2017_model(input_shape=config.input_shape, n_labels=config.n_labels,
+                                                   initial_learning_rate=config.initial_learning_rate,
+                                                   n_base_filters=config.n_base_filters,
+                                                   loss_function=config.loss_function,
+                                                   shortcut=config.shortcut,
+                                                   depth=config.depth,
+                                                   compile=False)
+    if not config.depth_jdot:
+        context_output_name = []
+    return model, context_output_name
+
+
+def add_proximal_term(model, global_weights, mu):
+    '''
+    Adds mu / 2 * ||w - w_global||^2 to the losses of the layers, so that it is part of the loss of any model compiled
+    from them (JDOT.compile_model builds a new model when depth_jdot is set).
+    '''
+    global_values = dict(zip([weight.name for weight in model.weights], global_weights))
+    for layer in model.layers:
+        if layer.trainable_weights:
+            layer.add_loss(mu / 2. * K.sum([K.sum(K.square(weight - K.constant(global_values[weight.name])))
+                                            for weight in layer.trainable_weights]))
+
+
+def train_center(task):
+    '''
+    Local training of a center, run in its own process.
+    :param task: (center configuration, file of the global weights (payload), file where the local weights are written,
+    True at the first round, when the full global weights are sent)
+    :return: Dictionary with the file of the local weights, its size in bytes, the number of training patches, the
+    validation dice scores (dice, source dice, target dice, nan when not computed) and the duration of the local
+    training
+    '''
+    config, global_file, update_file, first_round = task
+    start = time.time()
+    if not os.path.exists(config.save_dir):
+        os.makedirs(config.save_dir)
+    held_file = os.path.join(config.save_dir, "global.npz")
+    residual_file = os.path.join(config.save_dir, "residual.npz")
+    if first_round:
+        global_weights = deserialize(load_payload(global_file))
+        # Nothing is kept from a previous federated training
+        for previous_file in (residual_file, os.path.join(config.save_dir, "validation.csv")):
+            if os.path.exists(previous_file):
+                os.remove(previous_file)
+    else:
+        global_weights = apply_delta(load_weights(held_file), deserialize(load_payload(global_file)))
+    save_weights(held_file, global_weights)
+    source_data = open_data_file(get_center_data_file(config, get_center_name(config.source_center)))
+    target_data = open_data_file(get_center_data_file(config, get_center_name(config.target_center)))
+    model, context_output_name = build_model(config)
+    model.set_weights(global_weights)
+    if config.federated_mu > 0:
+        add_proximal_term(model, global_weights, config.federated_mu)
+    jd = JDOT(model, config=config, source_data=source_data, target_data=target_data,
+              context_output_name=context_output_name)
+    jd.compile_model()
+    try:
+        if config.train_jdot:
+            jd.train_model(config.federated_local_epochs)
+        else:
+            jd.train_model_on_source(config.federated_local_epochs)
+    finally:
+        jd.close()
+        source_data.close()
+        target_data.close()
+    # model shares its layers with jd.model, which has more outputs when depth_jdot is set
+    encoder = DeltaEncoder(config.federated_codec, fraction=config.federated_topk,
+                           residual=load_weights(residual_file) if os.path.exists(residual_file) else None)
+    n_bytes = save_payload(update_file, encoder.encode(model.get_weights(), global_weights))
+    save_weights(residual_file, encoder.residual)
+    return {"update_file": update_file, "bytes": n_bytes, "n_patches": len(jd.complete_source_training_list),
+            "dice": get_validation_dice(config), "seconds": time.time() - start}
+
+
+def get_validation_dice(config):
+    '''
+    :return: Dice, source dice and target dice of the last validation of the local training (see
+    JDOT.save_hist_and_model), nan when they were not computed
+    '''
+    dice = [np.nan] * 3
+    validation_file = os.path.join(config.save_dir, "validation.csv")
+    if os.path.exists(validation_file):
+        last_validation = np.loadtxt(validation_file, delimiter=",", ndmin=2)[-1]
+        if config.train_jdot:
+            dice = list(last_validation[-3:])
+        else:
+            dice[0] = last_validation[-1]
+    return dice
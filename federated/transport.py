@@ -0,0 +1,161 @@
+"""
+Transport of the weights between the coordinator and the centers. The full weights are sent once, then each side
+only sends the difference with the weights the other side already holds, compressed:
+    - none: float32
+    - float16
+    - int8: symmetric quantization with one scale per tensor
+    - topk: the largest differences of each tensor (a fraction of them), with their indices
+When the reference of the differences is not what the receiver holds, e.g. a center sending its local update from
+the global weights of the round, the error of the compression is kept by the sender and added to its next difference
+(error feedback), so that no part of the update is lost, only delayed. The payloads are serialized in a compact binary format (see serialize).
+Any loop built on model.get_weights() and model.set_weights() can use DeltaEncoder and apply_delta.
+"""
+import os
+import struct
+
+import numpy as np
+
+CODECS = ("none", "float16", "int8", "topk")
+MAGIC = b"FDWT"
+HEADER = struct.Struct("<4sBBI")  # magic, version, codec, number of tensors
+VERSION = 1
+
+
+def save_weights(path, weights):
+    '''
+    Writes the weight arrays of a model where the coordinator or a center will read them.
+    :return: Size of the written file in bytes
+    '''
+    # The reader never sees a partially written file
+    temporary_path = path + ".tmp.npz"
+    np.savez(temporary_path, *weights)
+    os.replace(temporary_path, path)
+    return os.path.getsize(path)
+
+
+def load_weights(path):
+    with np.load(path) as weights_file:
+        return [weights_file["arr_" + str(index)] for index in range(len(weights_file.files))]
+
+
+def save_payload(path, payload):
+    '''
+    :return: Size of the written file in bytes
+    '''
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as opened_file:
+        opened_file.write(payload)
+    os.replace(temporary_path, path)
+    return len(payload)
+
+
+def load_payload(path):
+    with open(path, "rb") as opened_file:
+        return opened_file.read()
+
+
+def encode_tensor(tensor, codec, fraction):
+    values = np.asarray(tensor, dtype=np.float32).ravel()
+    header = struct.pack("<B" + "I" * tensor.ndim, tensor.ndim, *tensor.shape)
+    if codec == "none":
+        return header + values.tobytes()
+    if codec == "float16":
+        return header + values.astype(np.float16).tobytes()
+    if codec == "int8":
+        maximum = float(np.abs(values).max()) if values.size else 0.
+        scale = maximum / 127 if maximum > 0 else 1.
+        quantized = np.clip(np.rint(values / scale), -127, 127).astype(np.int8)
+        return header + struct.pack("<f", scale) + quantized.tobytes()
+    k = min(values.size, max(1, int(np.ceil(fraction * values.size)))) if values.size else 0
+    indices = np.sort(np.argpartition(np.abs(values), values.size - k)[values.size - k:]) if k else np.zeros(0)
+    return header + struct.pack("<I", k) + indices.astype(np.uint32).tobytes() + values[indices].tobytes()
+
+
+def decode_tensor(payload, offset, codec):
+    '''
+    :return: The decoded tensor and the offset of the next one in the payload
+    '''
+    ndim, = struct.unpack_from("<B", payload, offset)
+    shape = struct.unpack_from("<" + "I" * ndim, payload, offset + 1)
+    offset += 1 + 4 * ndim
+    size = int(np.prod(shape))
+    if codec == "none":
+        tensor = np.frombuffer(payload, dtype=np.float32, count=size, offset=offset)
+        offset += 4 * size
+    elif codec == "float16":
+        tensor = np.frombuffer(payload, dtype=np.float16, count=size, offset=offset).astype(np.float32)
+        offset += 2 * size
+    elif codec == "int8":
+        scale, = struct.unpack_from("<f", payload, offset)
+        tensor = np.frombuffer(payload, dtype=np.int8, count=size, offset=offset + 4).astype(np.float32) * scale
+        offset += 4 + size
+    else:
+        k, = struct.unpack_from("<I", payload, offset)
+        indices = np.frombuffer(payload, dtype=np.uint32, count=k, offset=offset + 4)
+        tensor = np.zeros(size, dtype=np.float32)
+        tensor[indices] = np.frombuffer(payload, dtype=np.float32, count=k, offset=offset + 4 + 4 * k)
+        offset += 4 + 8 * k
+    return tensor.reshape(shape).copy(), offset
+
+
+def serialize(tensors, codec="none", fraction=0.01):
+    '''
+    :param tensors: List of arrays, e.g. weights or differences of weights.
+    :param codec: Compression of the tensors, see CODECS.
+    :param fraction: Fraction of the values of each tensor sent by the topk codec.
+    :return: bytes
+    '''
+    if codec not in CODECS:
+        raise ValueError("Unknown codec " + str(codec) + ", choose one of " + ", ".join(CODECS) + ".")
+    return HEADER.pack(MAGIC, VERSION, CODECS.index(codec), len(tensors)) + \
+        b"".join(encode_tensor(tensor, codec, fraction) for tensor in tensors)
+
+
+def deserialize(payload):
+    '''
+    :return: List of float32 arrays
+    '''
+    magic, version, codec, n_tensors = HEADER.unpack_from(payload, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("The payload is not a version " + str(VERSION) + " weight payload.")
+    tensors, offset = [], HEADER.size
+    for _ in range(n_tensors):
+        tensor, offset = decode_tensor(payload, offset, CODECS[codec])
+        tensors.append(tensor)
+    return tensors
+
+
+def apply_delta(reference, deltas):
+    return [(np.asarray(weights, dtype=np.float32) + delta).astype(np.asarray(weights).dtype)
+            for weights, delta in zip(reference, deltas)]
+
+
+class DeltaEncoder:
+    """
+    Compresses the difference between weights and reference weights the receiver also holds.
+    """
+    def __init__(self, codec="int8", fraction=0.01, residual=None, error_feedback=True):
+        '''
+        :param codec: See CODECS.
+        :param fraction: Fraction of the values of each tensor sent by the topk codec.
+        :param residual: Compression error not sent yet, e.g. restored from a previous round.
+        :param error_feedback: If True, the compression error is added to the next difference. Without it when the
+        reference is always the last weights decoded by the receiver: the difference already contains the error.
+        '''
+        self.codec = codec
+        self.fraction = fraction
+        self.residual = residual
+        self.error_feedback = error_feedback
+
+    def encode(self, weights, reference):
+        '''
+        :return: The payload to send. The receiver gets the weights sent with apply_delta(reference, deserialize(payload)).
+        '''
+        deltas = [np.asarray(weights_array, dtype=np.float32) - np.asarray(reference_array, dtype=np.float32)
+                  for weights_array, reference_array in zip(weights, reference)]
+        if self.residual is not None:
+            deltas = [delta + residual for delta, residual in zip(deltas, self.residual)]
+        payload = serialize(deltas, codec=self.codec, fraction=self.fraction)
+        if self.error_feedback:
+            self.residual = [delta - decoded for delta, decoded in zip(deltas, deserialize(payload))]
+        return payload
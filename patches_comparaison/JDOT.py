@@ -1,11 +1,19 @@
 from keras import backend as K
 from keras import Model
 from keras.callbacks import LambdaCallback
-from patches_comparaison.generator_jdot import get_batch_jdot, multi_proc_augment_data, get_patches_index_list
+from patches_comparaison.generator_jdot import get_batch_jdot, multi_proc_augment_data, batch_augment_data, get_patches_index_list, convert_data
+from patches_comparaison.patch_cache import PatchCache
+from patches_comparaison.patch_loader import PatchLoader
+from patches_comparaison.prefetch import BatchPrefetcher
+from patches_comparaison.ot_solver import OTSolver
+from patches_comparaison.cost_matrix import CostMatrix
+from patches_comparaison.activation_cache import ActivationCache
+from patches_comparaison.global_coupling import GlobalCoupling, pool_patches
+from federated.sketch import TargetSketch, SketchCoupling, SketchChannel
 from scipy.spatial.distance import cdist, cosine, euclidean, dice
 from unet3d.utils import pickle_load
 import tables
-from unet3d.prediction import run_validation_case
+from unet3d.prediction import predict_validation_cases
 import os
 import numpy as np
 from numpy import all
@@ -15,6 +23,7 @@ from keras.models import load_model
 import time
 import random
 import sys
+import warnings
 from copy import copy
 from multiprocessing import Pool
 
@@ -58,6 +67,9 @@ class JDOT():
         self.lr_decay = lr_decay
         #
         self.ot_method = ot_method
+        self.ot_solver = OTSolver(self.config.ot_solver, reg=self.config.ot_reg, reg_m=self.config.ot_reg_m,
+                                  warm_start=self.config.ot_warm_start, float32=self.config.ot_float32)
+        self.cost_matrix = CostMatrix(float32=self.config.cost_float32, block_size=self.config.cost_block_size)
 
         self.train_batch = ()
         self.validation_batch = ()
@@ -81,11 +93,39 @@ class JDOT():
         self.affine_target_training = None
         self.affine_target_validation = None
 
+        self.source_training_cache = None
+        self.source_validation_cache = None
+        self.target_training_cache = None
+        self.target_validation_cache = None
+
+        self.patch_loader = None
+
+        # The batches are selected (and augmented) by the prefetching thread: with a seed their order is reproducible.
+        # The selection state and the global coupling are only changed by the training loop while that thread is stopped.
+        # The augmentation and the seeds of the loading workers are drawn from self.rng as well, the global random
+        # state is left untouched.
+        self.rng = np.random.RandomState(self.config.seed)
+
         self.t = 0
         self.count = 0
 
         self.prediction = []
 
+        # Used when self.config.jdot_feature_mode is "stale" or "encoder"
+        self.train_and_predict_function = None
+        self.encoder = None
+        self.source_activations = None
+        self.target_activations = None
+        self.batch_positions = None
+        self.epoch_times = []
+        # Current epoch, and the mean and maximum age (in epochs) of the cached outputs used for each gamma computed
+        # from the caches
+        self.epoch = 0
+        self.activation_ages = []
+
+        # Used when self.config.jdot_global_coupling is True
+        self.global_coupling = None
+
         self.target_pred = K.zeros(shape=(self.batch_size, 1, self.config.patch_shape[0],self.config.patch_shape[1],self.config.patch_shape[2]))
         self.source_truth = K.zeros(shape=(self.batch_size, 1, self.config.patch_shape[0],self.config.patch_shape[1],self.config.patch_shape[2]))
 
@@ -319,7 +359,8 @@ class JDOT():
             - Compute the callbacks
             - Multiply the value of alpha by alpha-factor (not used in practice)
             While all the training set was not used for training:
-                - Select a batch of source and target patches that were not seen before and load them
+                - Select a batch of source and target patches that were not seen before and load them (in a background
+                thread, while the previous batch is used)
                 - Get the predictions (deep-layer activation + output) of the network with the selected batch
                 - Compute and change gamma with the predictions
                  - Train the network
@@ -340,9 +381,14 @@ class JDOT():
         if self.config.load_all_data:
             self.load_all_data(copy(self.complete_source_training_list), copy(self.complete_target_training_list),
                                copy(self.complete_source_validation_list), copy(self.complete_target_validation_list))
+        elif self.config.patch_cache:
+            self.open_patch_caches()
+        self.open_activation_caches()
         count = 0
         for i in range(n_iteration):
             start_epoch = time.time()
+            self.epoch = i
+            n_cached_batches = len(self.activation_ages)
 
             if self.config.callback:
                 early_stop = self.callback(val_l)
@@ -359,34 +405,56 @@ class JDOT():
                 K.set_value(self.jdot_alpha, K.get_value(self.jdot_alpha)*self.config.alpha_factor)
                 print("Changing jdot's alpha to :", K.get_value(self.jdot_alpha))
 
-            while not self.epoch_complete:
-                selected_source, selected_target = self.select_indices_training()
-                if len(selected_source) < self.batch_size or len(selected_target) < self.batch_size:
-                    break
-                if self.config.load_all_data:
-                    self.load_training_batch_from_all_data(selected_source, selected_target)
-                else:
-                    self.load_batch(selected_source, selected_target)
-
-                intermediate_output = [self.get_prediction()] if not self.config.depth_jdot else self.get_prediction()
-                self.prediction = intermediate_output[-1] #The output segmentation map
-
-                K.set_value(self.target_pred, self.prediction[self.batch_size:,:])
-                K.set_value(self.source_truth, self.train_batch[1][:self.batch_size, :])
-
-                K.set_value(self.gamma, self.compute_gamma(self.prediction))
-                epoch_hist = self.train_on_batch(epoch_hist)
-
-            while not self.validation_complete:
-                selected_source, selected_target = self.select_indices_validation()
-                if self.config.load_all_data:
-                    self.load_validation_batch_from_all_data(selected_source, selected_target)
-                else:
-                    self.load_validation_batch(selected_source, selected_target)
-                epoch_val = self.test_on_batch(epoch_val)
+            if self.config.jdot_global_coupling and (self.config.global_coupling_every == 0 or self.global_coupling is None):
+                self.update_global_coupling()
+
+            # The next batches are loaded in the background while the current one is used. The background thread
+            # selects the batches from the global coupling: it is stopped at each update of the coupling, and the
+            # batches of the epoch are resumed by a new prefetcher once the coupling is updated.
+            batches = self.get_batches()
+            more_batches = True
+            while more_batches:
+                max_batches = None
+                if self.config.jdot_global_coupling and self.config.global_coupling_every > 0:
+                    max_batches = self.config.global_coupling_every - count % self.config.global_coupling_every
+                prefetcher = BatchPrefetcher(batches, depth=self.config.prefetch_depth, max_batches=max_batches)
+                n_batches = 0
+                try:
+                    for batch, positions in prefetcher:
+                        self.set_batch(batch, positions=positions)
+                        count += 1
+                        n_batches += 1
+
+                        intermediate_output = self.get_jdot_outputs()
+                        self.prediction = intermediate_output[-1] #The output segmentation map
+
+                        K.set_value(self.target_pred, self.prediction[self.batch_size:,:])
+                        K.set_value(self.source_truth, self.train_batch[1][:self.batch_size, :])
+
+                        K.set_value(self.gamma, self.compute_gamma(self.prediction))
+                        epoch_hist = self.train_on_batch(epoch_hist)
+                finally:
+                    prefetcher.close()
+                self.print_loading_overlap(prefetcher)
+                more_batches = max_batches is not None and n_batches == max_batches
+                if more_batches:
+                    self.update_global_coupling()
+
+            prefetcher = self.get_prefetcher(validation=True)
+            try:
+                for batch, _ in prefetcher:
+                    self.set_batch(batch, validation=True)
+                    epoch_val = self.test_on_batch(epoch_val)
+            finally:
+                prefetcher.close()
 
             end_epoch = time.time()
             time_epoch = end_epoch - start_epoch
+            self.epoch_times.append(time_epoch)
+            print("\nTime for the epoch:", round(time_epoch, 2), "s")
+            if len(self.activation_ages) > n_cached_batches:
+                print("Age of the cached outputs used for gamma: mean", round(np.mean(self.activation_ages[n_cached_batches:], axis=0)[0], 2),
+                      "max", np.max(self.activation_ages[n_cached_batches:], axis=0)[1], "epochs")
             epoch_remaining = n_iteration - (i+1)
 
             mean_epoch = np.mean(epoch_hist, axis=0)
@@ -419,6 +487,8 @@ class JDOT():
         if self.config.load_all_data:
             self.load_all_data(copy(self.complete_source_training_list), copy(self.complete_target_training_list),
                                copy(self.complete_source_validation_list), copy(self.complete_target_validation_list), target=False)
+        elif self.config.patch_cache:
+            self.open_patch_caches(target=False)
 
         for i in range(n_iteration):
             start_epoch = time.time()
@@ -431,26 +501,25 @@ class JDOT():
             print("=============")
             print("Epoch:", i + 1, "/", n_iteration)
 
-            while not self.epoch_complete:
-                selected_source, selected_target = self.select_indices_training()
-                if len(selected_source) < self.batch_size or len(selected_target) < self.batch_size:
-                    break
-                if self.config.load_all_data:
-                    self.load_training_batch_from_all_data(selected_source, selected_target, target=False)
-                else:
-                    self.load_batch(selected_source, selected_target, target=False)
-                intermediate_output = [self.get_prediction()] if not self.config.depth_jdot else self.get_prediction()
-                self.prediction = intermediate_output[-1]  # The output segmentation map
-
-                epoch_hist = self.train_on_batch(epoch_hist)
-
-            while not self.validation_complete:
-                selected_source, selected_target = self.select_indices_validation()
-                if self.config.load_all_data:
-                    self.load_validation_batch_from_all_data(selected_source, selected_target, target=False)
-                else:
-                    self.load_validation_batch(selected_source, selected_target, target=False)
-                epoch_val = self.test_on_batch(epoch_val)
+            prefetcher = self.get_prefetcher(target=False)
+            try:
+                for batch, _ in prefetcher:
+                    self.set_batch(batch, target=False)
+                    intermediate_output = [self.get_prediction()] if not self.config.depth_jdot else self.get_prediction()
+                    self.prediction = intermediate_output[-1]  # The output segmentation map
+
+                    epoch_hist = self.train_on_batch(epoch_hist)
+            finally:
+                prefetcher.close()
+            self.print_loading_overlap(prefetcher)
+
+            prefetcher = self.get_prefetcher(target=False, validation=True)
+            try:
+                for batch, _ in prefetcher:
+                    self.set_batch(batch, target=False, validation=True)
+                    epoch_val = self.test_on_batch(epoch_val)
+            finally:
+                prefetcher.close()
 
             end_epoch = time.time()
             time_epoch = end_epoch - start_epoch
@@ -533,9 +602,33 @@ class JDOT():
             validation = validation,
             source_center = self.config.source_center,
             target_center = self.config.target_center,
-            all = all)
+            all = all,
+            loader = self.get_patch_loader())
         return batch, affine_list_source, affine_list_target
 
+    def get_patch_loader(self):
+        '''
+        The workers loading the patches are created once per JDOT instance, when the first batch is loaded.
+        :return: The PatchLoader, or None if self.config.persistent_loader is False.
+        '''
+        if self.patch_loader is None and self.config.persistent_loader:
+            data_files = {"source": self.source_data.filename}
+            if self.target_data is not None:
+                data_files["target"] = self.target_data.filename
+            self.patch_loader = PatchLoader(data_files, len(self.config.training_modalities), self.config.patch_shape,
+                                            max_batch_size=2*self.batch_size,
+                                            number_of_threads=self.config.number_of_threads, rng=self.rng)
+        return self.patch_loader
+
+    def close(self):
+        '''
+        Stop the workers loading the patches.
+        :return:
+        '''
+        if self.patch_loader is not None:
+            self.patch_loader.close()
+            self.patch_loader = None
+
     def get_patch_indexes(self, target = True):
         '''
         Compute the list of patches we wan't to use for the training.
@@ -561,10 +654,11 @@ class JDOT():
                                split_list = self.config.split_list,
                                ceil=self.config.ceil)
 
-        self.source_training_list = copy(self.complete_source_training_list)
-        self.source_validation_list = copy(self.complete_source_validation_list)
-        self.target_training_list = copy(self.complete_target_training_list)
-        self.target_validation_list = copy(self.complete_target_validation_list)
+        # The patches are selected through permutations of their positions in the complete lists
+        self.source_training_list = self.rng.permutation(len(self.complete_source_training_list))
+        self.source_validation_list = self.rng.permutation(len(self.complete_source_validation_list))
+        self.target_training_list = self.rng.permutation(len(self.complete_target_training_list))
+        self.target_validation_list = self.rng.permutation(len(self.complete_target_validation_list))
         print("Source training: ", len(self.complete_source_training_list))
         print("Source validation", len(self.complete_source_validation_list))
         print("Target training", len(self.complete_target_training_list))
@@ -572,22 +666,22 @@ class JDOT():
 
     def select_indices_training(self):
         '''
-        Shuffle the source and target training list
-        Pop #batch_size# samples.
-        If there is not enough patches in source or target training list mark the epoch as complete and reset both of them with the complete lists
-        :return: The selected source and target samples
+        Take #batch_size# positions from the shuffled source and target training permutations.
+        If there is not enough patches left in source or target training permutation mark the epoch as complete and draw new permutations.
+        :return: The positions of the selected source and target samples in the complete lists
         '''
-        random.shuffle(self.source_training_list)
-        random.shuffle(self.target_training_list)
-        selected_source = []
-        selected_target = []
-        while len(selected_source) < self.batch_size and len(self.source_training_list) > 0 and len(self.target_training_list) > 0:
-            selected_source += [self.source_training_list.pop()]
-            selected_target += [self.target_training_list.pop()]
+        if self.global_coupling is not None:
+            # The target patches are drawn from the global coupling of the source patches
+            n_source = max(len(self.source_training_list) - self.batch_size, 0)
+            selected_source, self.source_training_list = self.source_training_list[n_source:], self.source_training_list[:n_source]
+            selected_target = self.global_coupling.sample_targets(selected_source, self.rng)
+        else:
+            selected_source, self.source_training_list, selected_target, self.target_training_list = \
+                self.split_positions(self.source_training_list, self.target_training_list)
 
         if len(self.source_training_list) < self.batch_size or len(self.target_training_list) < self.batch_size:
-            self.source_training_list = copy(self.complete_source_training_list)
-            self.target_training_list = copy(self.complete_target_training_list)
+            self.source_training_list = self.rng.permutation(len(self.complete_source_training_list))
+            self.target_training_list = self.rng.permutation(len(self.complete_target_training_list))
             self.epoch_complete = True
 
         return selected_source, selected_target
@@ -597,139 +691,141 @@ class JDOT():
         Same as before for validation.
         :return:
         '''
-        random.shuffle(self.source_validation_list)
-        random.shuffle(self.target_validation_list)
-        selected_source = []
-        selected_target = []
-        while len(selected_source) < self.batch_size and len(self.source_validation_list) > 0 and len(self.target_validation_list) > 0:
-            selected_source += [self.source_validation_list.pop()]
-            selected_target += [self.target_validation_list.pop()]
+        selected_source, self.source_validation_list, selected_target, self.target_validation_list = \
+            self.split_positions(self.source_validation_list, self.target_validation_list)
         if len(self.source_validation_list) < self.batch_size or len(self.target_validation_list) < self.batch_size:
-            self.source_validation_list = copy(self.complete_source_validation_list)
-            self.target_validation_list = copy(self.complete_target_validation_list)
+            self.source_validation_list = self.rng.permutation(len(self.complete_source_validation_list))
+            self.target_validation_list = self.rng.permutation(len(self.complete_target_validation_list))
             self.validation_complete = True
             
         return selected_source, selected_target
 
-    def load_batch(self, selected_source, selected_target, target = True):
+    def split_positions(self, source_positions, target_positions):
         '''
-        Load the batch of patches from their indices when self.config.load_all_data == False.
-        :param selected_source: List of selected patches for the source center
-        :param selected_target: List of selected patches for the target center
-        :param target:
-        :return:
+        Split the last #batch_size# positions (as many for source and target) from the remaining positions.
+        :return: selected source positions, remaining source positions, selected target positions, remaining target positions
         '''
-        start = time.time()
-        self.train_batch, _, _ = self.get_batch(selected_source, selected_target, target=target)
-        end = time.time()
-        t = "\rTime for loading: " + str(end - start)
-        sys.stdout.write(t)
-        sys.stdout.flush()
-        if target:
-            K.set_value(self.batch_source, self.train_batch[0][:self.batch_size])
-            K.set_value(self.batch_target, self.train_batch[0][self.batch_size:])
+        n = min(self.batch_size, len(source_positions), len(target_positions))
+        n_source = len(source_positions) - n
+        n_target = len(target_positions) - n
+        return source_positions[n_source:], source_positions[:n_source], target_positions[n_target:], target_positions[:n_target]
 
+    def get_batches(self, target = True, validation = False):
+        '''
+        Generator of the batches of an epoch (or of the whole validation set), run in the background by the
+        BatchPrefetcher. The batches are only prepared here, they are set in the model by set_batch.
+        :param target:
+        :param validation:
+        :return: Generator of (batch, (source positions, target positions))
+        '''
+        if validation:
+            while not self.validation_complete:
+                selected_source, selected_target = self.select_indices_validation()
+                yield self.prepare_batch(selected_source, selected_target, target=target, validation=True), \
+                      (selected_source, selected_target)
+        else:
+            while not self.epoch_complete:
+                selected_source, selected_target = self.select_indices_training()
+                if len(selected_source) < self.batch_size or len(selected_target) < self.batch_size:
+                    break
+                yield self.prepare_batch(selected_source, selected_target, target=target), (selected_source, selected_target)
 
-    def load_validation_batch(self, selected_source, selected_target, target = True):
-        start = time.time()
-        self.val_batch, _, _ = self.get_batch(selected_source, selected_target, target=target)
-        end = time.time()
-        t = "\rTime for loading: " + str(end - start)
-        sys.stdout.write(t)
-        sys.stdout.flush()
-        if target:
-            K.set_value(self.batch_source, self.val_batch[0][:self.batch_size])
-            K.set_value(self.batch_target, self.val_batch[0][self.batch_size:])
+    def get_prefetcher(self, target = True, validation = False):
+        return BatchPrefetcher(self.get_batches(target=target, validation=validation),
+                               depth=self.config.prefetch_depth)
 
+    def prepare_batch(self, selected_source, selected_target, target = True, validation = False):
+        '''
+        Load the batch of patches from their indices, from the data in memory, the patch caches or the data files.
+        :param selected_source: Positions of the selected patches in the complete source list
+        :param selected_target: Positions of the selected patches in the complete target list
+        :param target:
+        :param validation:
+        :return: The batch (x, y)
+        '''
+        if self.config.load_all_data:
+            return self.get_batch_from_all_data(selected_source, selected_target, target=target, validation=validation)
+        elif self.config.patch_cache:
+            return self.get_batch_from_cache(selected_source, selected_target, target=target, validation=validation)
+        selected_source, selected_target = self.get_selected_patches(selected_source, selected_target, validation)
+        batch, _, _ = self.get_batch(selected_source, selected_target, target=target)
+        return batch
+
+    def augment_batch(self, batch, affine_list, selected_source, selected_target, target = True, validation = False):
+        '''
+        Augment a batch already in memory, in this process if self.config.batch_augmentation is True, otherwise with
+        one worker task per patch.
+        :return: The augmented batch (x, y)
+        '''
+        if self.config.batch_augmentation:
+            return batch_augment_data(batch, affine_list, augment=self.config.augment, augment_flip=self.config.flip,
+                                      augment_distortion_factor=self.config.distort,
+                                      skip_blank=self.config.skip_blank, permute=self.config.permute, rng=self.rng)
+        selected_source, selected_target = self.get_selected_patches(selected_source, selected_target, validation)
+        index_list = selected_source + selected_target if target else selected_source
+        # The workers would drop the patches made blank by the augmentation, which breaks the split between the source
+        # and target patches of the batch: they are kept (the patch lists are already selected with skip_blank)
+        return multi_proc_augment_data(batch, affine_list, index_list, patch_shape= self.config.patch_shape, augment=self.config.augment,
+                                       augment_flip=self.config.flip, augment_distortion_factor=self.config.distort, skip_blank=False,
+                                       permute=self.config.permute, loader=self.get_patch_loader())
+
+    def get_selected_patches(self, selected_source, selected_target, validation = False):
+        '''
+        :return: The (subject, patch corner) indices of the selected source and target positions
+        '''
+        if validation:
+            complete_source_list, complete_target_list = self.complete_source_validation_list, self.complete_target_validation_list
+        else:
+            complete_source_list, complete_target_list = self.complete_source_training_list, self.complete_target_training_list
+        return [complete_source_list[i] for i in selected_source], [complete_target_list[i] for i in selected_target]
 
-    def load_training_batch_from_all_data(self, selected_source, selected_target, target = True):
+    def set_batch(self, batch, target = True, validation = False, positions = None):
         '''
-        Function to load the batch from the data loaded in memory.
-        We iterate through all the patches in self.complete_source_training_list and fetch the indices of the selected patches.
-        Based on these indices, we get the corresponding image patches from the previously loaded patches.
-        :param selected_source:
-        :param selected_target:
+        Use the batch for the next training (or validation) step. Must be called from the thread running the model.
+        :param batch:
         :param target:
+        :param validation:
+        :param positions: Positions of the source and target patches of the training batch in the complete lists.
         :return:
         '''
-        index_source = []
-        index_target = []
-        start = time.time()
-        for i, index in enumerate(copy(self.complete_source_training_list)):
-            for j in selected_source:
-                if index[0] == j[0] and (index[1] == j[1]).all():
-                    index_source += [i]
-        if target:
-            for i, index in enumerate(copy(self.complete_target_training_list)):
-                for j in selected_target:
-                    if index[0] == j[0] and (index[1] == j[1]).all():
-                        index_target += [i]
-        selected_index = index_source + [i + len(self.complete_source_training_list) for i in index_target]
-        self.train_batch = (np.array([self.training_data[0][i] for i in selected_index]), np.array([self.training_data[1][i] for i in selected_index]))
-        affine_list = [self.affine_source_training[i] for i in index_source]
-        affine_list += [self.affine_target_training[i] for i in index_target]
-        if target:
-            index_list = selected_source + selected_target
+        if validation:
+            self.val_batch = batch
         else:
-            index_list = selected_source
-        if self.config.augment:
-            self.train_batch = multi_proc_augment_data(self.train_batch, affine_list, index_list, patch_shape= self.config.patch_shape, augment=self.config.augment,
-                                    augment_flip=self.config.flip, augment_distortion_factor=self.config.distort, skip_blank=self.config.skip_blank,
-                                    permute=self.config.permute)
+            self.train_batch = batch
+            self.batch_positions = positions
         if target:
-            K.set_value(self.batch_source, self.train_batch[0][:self.batch_size])
-            K.set_value(self.batch_target, self.train_batch[0][self.batch_size:])
-
-        end = time.time()
+            K.set_value(self.batch_source, batch[0][:self.batch_size])
+            K.set_value(self.batch_target, batch[0][self.batch_size:])
 
-        t = "\rTime for loading: " + str(end - start)
-        sys.stdout.write(t)
-        sys.stdout.flush()
+    def print_loading_overlap(self, prefetcher):
+        print("\nLoading overlap:", str(round(prefetcher.get_overlap_ratio() * 100, 2)) + "%",
+              "(loading:", str(round(prefetcher.loading_time, 2)) + "s,",
+              "waiting:", str(round(prefetcher.waiting_time, 2)) + "s)")
 
-    def load_validation_batch_from_all_data(self, selected_source, selected_target, target = True):
+    def get_batch_from_all_data(self, selected_source, selected_target, target = True, validation = False):
         '''
-        Same as before for the validation data.
-        :param selected_source:
-        :param selected_target:
+        Function to load the batch from the data loaded in memory.
+        The patches are loaded in memory in the order of the complete lists (source then target), so the selected
+        positions directly index the loaded patches.
+        :param selected_source: Positions of the selected patches in the complete source list
+        :param selected_target: Positions of the selected patches in the complete target list
         :param target:
-        :return:
+        :param validation: If True, the patches are taken from the validation data.
+        :return: The batch (x, y)
         '''
-        index_source = []
-        index_target = []
-        start = time.time()
-        for i, index in enumerate(copy(self.complete_source_validation_list)):
-            for j in selected_source:
-                if index[0] == j[0] and (index[1] == j[1]).all():
-                    index_source += [i]
-        if target:
-
-            for i, index in enumerate(copy(self.complete_target_validation_list)):
-                for j in selected_target:
-                    if index[0] == j[0] and (index[1] == j[1]).all():
-                        index_target += [i]
-        selected_index = index_source + [i + len(self.complete_source_validation_list) for i in index_target]
-        self.val_batch = (np.array([self.validation_data[0][i] for i in selected_index]), np.array([self.validation_data[1][i] for i in selected_index]))
-        affine_list = [self.affine_source_validation[i] for i in index_source]
-        affine_list += [self.affine_target_validation[i] for i in index_target]
-        if target:
-            index_list = selected_source + selected_target
+        if validation:
+            data, affine_source, affine_target = self.validation_data, self.affine_source_validation, self.affine_target_validation
         else:
-            index_list = selected_source
-        if self.config.augment:
-            self.val_batch = multi_proc_augment_data(self.validation_batch, affine_list, index_list, patch_shape= self.config.patch_shape, augment=self.config.augment,
-                                    augment_flip=self.config.flip, augment_distortion_factor=self.config.distort, skip_blank=self.config.skip_blank,
-                                    permute=self.config.permute)
-
+            data, affine_source, affine_target = self.training_data, self.affine_source_training, self.affine_target_training
+        selected_index = np.asarray(selected_source, dtype=np.int64)
+        affine_list = [affine_source[i] for i in selected_source]
         if target:
-            K.set_value(self.batch_source, self.val_batch[0][:self.batch_size])
-            K.set_value(self.batch_target, self.val_batch[0][self.batch_size:])
-
-        end = time.time()
-
-        t = "\rTime for loading: " + str(end - start)
-        sys.stdout.write(t)
-        sys.stdout.flush()
-
+            selected_index = np.concatenate([selected_index, np.asarray(selected_target, dtype=np.int64) + len(affine_source)])
+            affine_list += [affine_target[i] for i in selected_target]
+        batch = (data[0][selected_index], data[1][selected_index])
+        if self.config.augment:
+            batch = self.augment_batch(batch, affine_list, selected_source, selected_target, target, validation)
+        return batch
 
     def load_all_data(self, training_source, training_target, validation_source, validation_target, target = True):
         '''
@@ -753,6 +849,113 @@ class JDOT():
         hour, minute, seconds = self.compute_time(end - start)
         print("Time for evaluation: ", hour, "hour(s)", minute, "minute(s)", seconds, "second(s)")
 
+    def open_patch_caches(self, target = True):
+        '''
+        Open the memory-mapped patch caches when self.config.patch_cache == True.
+        Each cache is (re)built from the data file the first time it is used or when the data file, the patch shape,
+        the overlap or the selection criterion changed.
+        :param target:
+        :return:
+        '''
+        if self.config.skip_blank:
+            selection = "skip_blank"
+        elif self.config.ceil is not None:
+            selection = "ceil_" + str(self.config.ceil)
+        else:
+            selection = "all"
+        cache_dir = os.path.abspath("Data/generated_data/patch_cache")
+        self.source_training_cache = PatchCache(os.path.join(cache_dir, "training_" + str(self.config.source_center)),
+                                                self.source_data, self.complete_source_training_list,
+                                                self.config.patch_shape, self.config.training_patch_overlap, selection)
+        self.source_validation_cache = PatchCache(os.path.join(cache_dir, "validation_" + str(self.config.source_center)),
+                                                  self.source_data, self.complete_source_validation_list,
+                                                  self.config.patch_shape, self.config.training_patch_overlap, selection)
+        if target:
+            self.target_training_cache = PatchCache(os.path.join(cache_dir, "training_" + str(self.config.target_center)),
+                                                    self.target_data, self.complete_target_training_list,
+                                                    self.config.patch_shape, self.config.training_patch_overlap, selection)
+            self.target_validation_cache = PatchCache(os.path.join(cache_dir, "validation_" + str(self.config.target_center)),
+                                                      self.target_data, self.complete_target_validation_list,
+                                                      self.config.patch_shape, self.config.training_patch_overlap, selection)
+
+    def get_batch_from_cache(self, selected_source, selected_target, target = True, validation = False):
+        '''
+        Load the batch of patches from the patch caches when self.config.patch_cache == True.
+        :param selected_source: Positions of the selected patches in the complete source list
+        :param selected_target: Positions of the selected patches in the complete target list
+        :param target:
+        :param validation: If True, the batch is loaded from the validation caches.
+        :return: The batch (x, y)
+        '''
+        if validation:
+            source_cache, target_cache = self.source_validation_cache, self.target_validation_cache
+        else:
+            source_cache, target_cache = self.source_training_cache, self.target_training_cache
+        # The caches are built in the order of the complete lists: the positions are the same
+        x, y, affine_list = source_cache.get_patches(selected_source)
+        if target:
+            target_x, target_y, target_affine_list = target_cache.get_patches(selected_target)
+            x = np.vstack((x, target_x))
+            y = np.vstack((y, target_y))
+            affine_list += target_affine_list
+        batch = convert_data(x, y, n_labels=self.config.n_labels, labels=self.config.labels)
+        if self.config.augment:
+            batch = self.augment_batch(batch, affine_list, selected_source, selected_target, target, validation)
+        return batch
+
+    def update_global_coupling(self):
+        '''
+        Compute the approximate coupling between all the source and target training patches, from which the training
+        batches are then drawn.
+        :return:
+        '''
+        start = time.time()
+        source_embeddings = self.get_patch_embeddings(target=False)
+        if self.config.target_sketch_size:
+            # The target site only sends a sketch of its embeddings, and draws the target patches of the batches
+            target_sketch = TargetSketch(self.get_patch_embeddings(target=True), size=self.config.target_sketch_size,
+                                         projection_dim=self.config.target_sketch_projection,
+                                         seed=self.config.seed or 0)
+            channel = SketchChannel(self.config.sketch_dir)
+            n_bytes = channel.send("target", target_sketch.sketch, codec=self.config.sketch_codec)
+            print("\nSketch of the target embeddings:", n_bytes, "bytes")
+            self.global_coupling = SketchCoupling(source_embeddings, channel.receive("target"),
+                                                  target_sketch.sample_members,
+                                                  solver=OTSolver(self.config.ot_solver, reg=self.config.ot_reg,
+                                                                  reg_m=self.config.ot_reg_m))
+        else:
+            target_embeddings = self.get_patch_embeddings(target=True)
+            self.global_coupling = GlobalCoupling(source_embeddings, target_embeddings, k=self.config.global_coupling_k,
+                                                  reg=self.config.global_coupling_reg)
+        print("\nTime for the global coupling:", round(time.time() - start, 2), "s")
+
+    def get_patch_embeddings(self, target = False):
+        '''
+        Embeddings of all the training patches of a domain: the representation at the self.config.depth_jdot layer
+        averaged over space, or the patches average pooled to 4x4x4 voxels when depth_jdot is None.
+        The patches are read from the data loaded in memory or from the patch caches.
+        :param target: If True, the target patches are embedded, else the source patches.
+        :return: Array of shape (n_patches, embedding_size)
+        '''
+        if target:
+            n_patches, offset, cache = len(self.complete_target_training_list), len(self.complete_source_training_list), self.target_training_cache
+        else:
+            n_patches, offset, cache = len(self.complete_source_training_list), 0, self.source_training_cache
+        if not self.config.load_all_data and not self.config.patch_cache:
+            raise ValueError("The global coupling needs the patches in memory (load_all_data) or in the patch caches")
+        embeddings = []
+        for start in range(0, n_patches, 2*self.batch_size):
+            positions = np.arange(start, min(start + 2*self.batch_size, n_patches))
+            if self.config.load_all_data:
+                patches = self.training_data[0][positions + offset]
+            else:
+                patches = np.asarray(cache.data[positions])
+            if self.config.depth_jdot:
+                embeddings.append(np.mean(self.get_encoder().predict(patches), axis=(2, 3, 4)))
+            else:
+                embeddings.append(pool_patches(patches))
+        return np.concatenate(embeddings)
+
     def get_prediction(self):
         '''
         Function to get the prediction of the model at a step t.
@@ -762,7 +965,10 @@ class JDOT():
         '''
 
         intermediate_output = self.model.predict(self.train_batch[0])
+        self.set_image_representation(intermediate_output if self.config.depth_jdot else [intermediate_output])
+        return intermediate_output
 
+    def set_image_representation(self, intermediate_output):
         if self.config.depth_jdot == None:
             self.image_representation_source = self.train_batch[0][:self.batch_size, :]
             self.image_representation_target = self.train_batch[0][self.batch_size:, :]
@@ -771,8 +977,99 @@ class JDOT():
             self.image_representation_source = intermediate_output[0][:self.batch_size, :]
             self.image_representation_target = intermediate_output[0][self.batch_size:, :]
 
+    def get_jdot_outputs(self):
+        '''
+        Outputs of the network used to compute gamma, according to self.config.jdot_feature_mode:
+            - "predict": an additional forward pass on the batch (before the training step)
+            - "stale": the outputs computed during the last training step on the same patches
+            - "encoder": the representation computed by the encoder part of the network (up to the self.config.depth_jdot
+            layer) and the segmentation computed during the last training step on the same patches
+        When a patch of the batch was never trained on, or its cached outputs are more than
+        self.config.jdot_activation_max_age epochs old, the additional forward pass is used.
+        :return: The list of the outputs (the last one is the segmentation map)
+        '''
+        mode = self.config.jdot_feature_mode
+        if self.source_activations is not None and self.batch_positions is not None \
+                and self.source_activations.contains(self.batch_positions[0], self.epoch) \
+                and self.target_activations.contains(self.batch_positions[1], self.epoch):
+            ages = np.concatenate([self.source_activations.ages(self.batch_positions[0], self.epoch),
+                                   self.target_activations.ages(self.batch_positions[1], self.epoch)])
+            self.activation_ages.append([np.mean(ages), np.max(ages)])
+            source_outputs = self.source_activations.load(self.batch_positions[0])
+            target_outputs = self.target_activations.load(self.batch_positions[1])
+            intermediate_output = [np.concatenate([source, target]) for source, target in zip(source_outputs, target_outputs)]
+            if mode == "encoder":
+                intermediate_output = [self.get_encoder().predict(self.train_batch[0])] + intermediate_output
+            self.set_image_representation(intermediate_output)
+            return intermediate_output
+        return [self.get_prediction()] if not self.config.depth_jdot else self.get_prediction()
+
+    def get_encoder(self):
+        '''
+        Sub-model computing the representation at the self.config.depth_jdot layer. It shares its weights with the
+        model and is only used for inference.
+        :return:
+        '''
+        if self.encoder is None:
+            self.encoder = Model(inputs=self.model.input, outputs=self.model.get_layer(self.context_output_name[-1]).output)
+        return self.encoder
 
-        return intermediate_output
+    def open_activation_caches(self):
+        '''
+        Create the caches of the outputs of the training steps when self.config.jdot_feature_mode != "predict".
+        :return:
+        '''
+        if self.config.jdot_feature_mode not in ("predict", "stale", "encoder"):
+            raise ValueError("Unknown jdot_feature_mode: {}".format(self.config.jdot_feature_mode))
+        if self.config.jdot_feature_mode == "encoder" and not self.config.depth_jdot:
+            raise ValueError("jdot_feature_mode 'encoder' needs a depth_jdot layer")
+        if self.config.jdot_feature_mode == "predict":
+            return
+        # The outputs are returned by a training function built from private attributes of the keras 2.2 models
+        if not all([hasattr(self.model, name) for name in ("_feed_inputs", "_feed_targets", "_feed_sample_weights",
+                                                           "metrics_tensors", "_standardize_user_data",
+                                                           "_uses_dynamic_learning_phase")]):
+            warnings.warn(RuntimeWarning("jdot_feature_mode '{}' is not supported by this version of keras, the outputs "
+                                         "are computed by an additional forward pass".format(self.config.jdot_feature_mode)))
+            return
+        self.source_activations = ActivationCache(len(self.complete_source_training_list),
+                                                  max_age=self.config.jdot_activation_max_age)
+        self.target_activations = ActivationCache(len(self.complete_target_training_list),
+                                                  max_age=self.config.jdot_activation_max_age)
+
+    def get_train_and_predict_function(self):
+        '''
+        Training function that also returns the outputs of the network, so that the forward pass of the training step
+        gives the activations cached for the next computations of gamma.
+        It is built as the train_function of keras (Model._make_train_function) with the outputs added.
+        :return:
+        '''
+        if self.train_and_predict_function is None:
+            model = self.model
+            inputs = model._feed_inputs + model._feed_targets + model._feed_sample_weights
+            if model._uses_dynamic_learning_phase():
+                inputs += [K.learning_phase()]
+            with K.name_scope('training'):
+                with K.name_scope(model.optimizer.__class__.__name__):
+                    training_updates = model.optimizer.get_updates(params=model._collected_trainable_weights,
+                                                                   loss=model.total_loss)
+                updates = model.updates + training_updates + getattr(model, 'metrics_updates', [])
+                self.train_and_predict_function = K.function(inputs, [model.total_loss] + model.metrics_tensors + model.outputs,
+                                                             updates=updates, name='train_and_predict_function')
+        return self.train_and_predict_function
+
+    def train_and_predict_on_batch(self, x, y):
+        '''
+        Same as self.model.train_on_batch but also returns the outputs of the network (before the update).
+        :return: The losses and metrics, the list of the outputs
+        '''
+        x, y, sample_weights = self.model._standardize_user_data(x, y)
+        ins = x + y + sample_weights
+        if self.model._uses_dynamic_learning_phase():
+            ins += [1.]
+        outputs = self.get_train_and_predict_function()(ins)
+        n_metrics = len(self.model.metrics_names)
+        return outputs[:n_metrics], outputs[n_metrics:]
 
     def train_on_batch(self, hist_l):
         '''
@@ -790,7 +1087,16 @@ class JDOT():
         training_output_list = output_list + [self.train_batch[1]]
 
         # We train the model
-        if self.config.train_jdot:
+        if self.config.train_jdot and self.source_activations is not None:
+            hist, outputs = self.train_and_predict_on_batch(self.train_batch[0], training_output_list)
+            if self.batch_positions is not None and outputs[-1].shape[0] == 2*self.batch_size:
+                # In encoder mode, only the segmentation is needed
+                outputs = outputs[-1:] if self.config.jdot_feature_mode == "encoder" else outputs
+                self.source_activations.store(self.batch_positions[0], [output[:self.batch_size] for output in outputs],
+                                              self.epoch)
+                self.target_activations.store(self.batch_positions[1], [output[self.batch_size:] for output in outputs],
+                                              self.epoch)
+        elif self.config.train_jdot:
             hist = self.model.train_on_batch(self.train_batch[0], training_output_list)
         else:
             hist = self.model.train_on_batch(self.train_batch[0], self.train_batch[1])
@@ -887,6 +1193,12 @@ class JDOT():
             os.makedirs(self.config.save_dir)
         np.savetxt(os.path.join(self.config.save_dir, "validation.csv"), val_l, delimiter=",")
         np.savetxt(os.path.join(self.config.save_dir, "train.csv"), hist_l, delimiter=",")
+        if len(self.epoch_times) > 0:
+            # Duration of each epoch, to compare the jdot_feature_mode
+            np.savetxt(os.path.join(self.config.save_dir, "time.csv"), self.epoch_times, delimiter=",")
+        if len(self.activation_ages) > 0:
+            # Staleness of the cached outputs used for gamma (mean and max age in epochs, one row per batch)
+            np.savetxt(os.path.join(self.config.save_dir, "activation_age.csv"), self.activation_ages, delimiter=",")
 
         self.model.save(self.config.model_file)
 
@@ -921,12 +1233,14 @@ class JDOT():
                                       (self.batch_size, self.config.patch_shape[0]*self.config.patch_shape[1]*self.config.patch_shape[2]))
 
         # Compute the distance between samples and between the source_truth and the target prediction.
-        C0 = cdist(train_vec_source, train_vec_target, metric="sqeuclidean")
-        C1 = cdist(truth_vec_source, pred_vec_target, metric=self.config.jdot_distance)
-        C = K.get_value(self.jdot_alpha)*C0+K.get_value(self.jdot_beta)*C1
-
-        # Computing gamma using the OT library
-        gamma = ot.emd(ot.unif(self.batch_size), ot.unif(self.batch_size), C)
+        # C = alpha*C0 + beta*C1 with C0 the sqeuclidean distance between the samples and C1 the jdot_distance
+        # between the source truth and the target prediction
+        C = self.cost_matrix.jdot_cost(train_vec_source, train_vec_target, truth_vec_source, pred_vec_target,
+                                       K.get_value(self.jdot_alpha), K.get_value(self.jdot_beta),
+                                       distance=self.config.jdot_distance)
+
+        # Computing gamma with the solver chosen in self.config.ot_solver
+        gamma = self.ot_solver.solve(C)
         return gamma
 
     def evaluate_model(self):
@@ -954,6 +1268,7 @@ class JDOT():
                                   output_label_map=True,
                                   overlap=self.config.validation_patch_overlap,
                                   output_dir=self.config.prediction_dir,
+                                  permute=self.config.test_time_augmentation,
                                   save_image=self.config.save_image)
         end = time.time()
         hour, minute, seconds = self.compute_time(end - start)
@@ -963,7 +1278,8 @@ class JDOT():
                              output_label_map=False, output_dir=".", threshold=0.5, overlap=16, permute=False,
                              save_image = False):
         '''
-        For each patient of the testing set we run a validation.
+        For each patient of the testing set we run a validation. The patches of the patients are predicted together in
+        batches of self.config.prediction_batch_size patches (see unet3d.prediction.predict_subjects).
         :param validation_keys_file:
         :param training_modalities:
         :param labels:
@@ -977,18 +1293,12 @@ class JDOT():
         :return:
         '''
         validation_indices = pickle_load(validation_keys_file)
-        model = self.model
         data_file = tables.open_file(hdf5_file, "r")
-        for i, index in enumerate(validation_indices):
-            actual = round(i/len(validation_indices)*100, 2)
-            print("Running validation case: ", actual,"%")
-            if 'subject_ids' in data_file.root:
-                case_directory = os.path.join(output_dir, data_file.root.subject_ids[index].decode('utf-8'))
-            else:
-                case_directory = os.path.join(output_dir, "validation_case_{}".format(index))
-            run_validation_case(data_index=index, output_dir=case_directory, model=model, data_file=data_file,
-                                training_modalities=training_modalities, output_label_map=output_label_map, labels=labels,
-                                threshold=threshold, overlap=overlap, permute=permute, save_image=save_image)
+        predict_validation_cases(self.model, data_file, validation_indices, training_modalities,
+                                 output_label_map=output_label_map, output_dir=output_dir, threshold=threshold,
+                                 labels=labels, overlap=overlap, permute=permute, save_image=save_image,
+                                 batch_size=self.config.prediction_batch_size,
+                                 memory_budget=self.config.prediction_memory_budget)
         data_file.close()
 
     def load_old_model(self, model_file):
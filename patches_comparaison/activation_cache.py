@@ -0,0 +1,60 @@
+import numpy as np
+
+
+class ActivationCache:
+    """
+    Outputs of the network for each patch of a domain, as computed during its last training step.
+    JDOT can compute the coupling of a batch from these (stale) outputs instead of running an additional forward pass.
+    Each output is stored with the epoch that computed it: an output computed more than max_age epochs ago is
+    considered as missing. Each patch is trained on about once per epoch, so the age is bounded in epochs: a bound in
+    training steps would reject most of the outputs when the epochs have more steps than the bound.
+    The arrays are allocated at the first store: with deep representations they can be large
+    (n_patches * size of the representation).
+    """
+    def __init__(self, n_patches, max_age=None):
+        '''
+        :param n_patches: Number of patches of the domain (the positions go from 0 to n_patches - 1).
+        :param max_age: Maximum number of epochs since an output was computed for it to be used. If None, the outputs
+        are used whatever their age.
+        '''
+        self.n_patches = n_patches
+        self.max_age = max_age
+        self.outputs = None
+        self.epochs = np.full(n_patches, -1, dtype=np.int64)
+
+    def store(self, positions, outputs, epoch):
+        '''
+        :param positions: Positions of the patches.
+        :param outputs: List of the outputs of the network for these patches.
+        :param epoch: Epoch that computed the outputs.
+        '''
+        if self.outputs is None:
+            self.outputs = [np.zeros((self.n_patches,) + output.shape[1:], dtype=np.float32) for output in outputs]
+        for cached, output in zip(self.outputs, outputs):
+            cached[positions] = output
+        self.epochs[positions] = epoch
+
+    def ages(self, positions, epoch):
+        '''
+        :return: Number of epochs since the outputs of the patches were computed (-1 if never computed).
+        '''
+        epochs = self.epochs[positions]
+        return np.where(epochs < 0, -1, epoch - epochs)
+
+    def contains(self, positions, epoch):
+        '''
+        :param epoch: Current epoch.
+        :return: True if the outputs of all the patches are cached and at most max_age epochs old.
+        '''
+        if self.outputs is None:
+            return False
+        ages = self.ages(positions, epoch)
+        if np.any(ages < 0):
+            return False
+        return self.max_age is None or bool(np.all(ages <= self.max_age))
+
+    def load(self, positions):
+        '''
+        :return: List of the cached outputs of the patches.
+        '''
+        return [cached[positions] for cached in self.outputs]
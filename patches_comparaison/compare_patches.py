@@ -5,6 +5,7 @@ from scipy.spatial import minkowski_distance
 from unet3d.data import write_data_to_file, open_data_file
 from unet3d.generator import  get_data_from_file, get_validation_split, create_patch_index_list, add_data
 from unet3d.utils.patches import get_patch_from_3d_data
+from unet3d.utils.patch_statistics import PatchIndex, compute_patch_statistics
 from unet3d.utils.utils import pickle_load
 from unet3d.metrics import dice_coef_loss
 import numpy as np
@@ -55,10 +56,21 @@ class Compare_patches:
                 combination_list = pickle.load(f)
 
 
+        if skip_blank:
+            # The patches without lesions are discarded from the patch index, before reading them
+            patch_index = PatchIndex(data_file, patch_shape=self.patch_shape)
+            lesion_a = compute_patch_statistics(data_file, [l[0] for l in combination_list], self.patch_shape,
+                                                patch_index)["lesion_count"] > 0
+            lesion_b = compute_patch_statistics(data_file, [l[1] for l in combination_list], self.patch_shape,
+                                                patch_index)["lesion_count"] > 0
+            patch_index.close()
+
         for j, l in enumerate(combination_list):
             advance = "\rComputing similarity: " + str(j/len(combination_list)*100) + "%"
             sys.stdout.write(advance)
             sys.stdout.flush()
+            if skip_blank and not (lesion_a[j] and lesion_b[j]):
+                continue
             if mode != "one patch":
                 x_a, y_a = get_data_from_file(data_file, l[0], self.patch_shape)
 
@@ -0,0 +1,103 @@
+import numpy as np
+from scipy.spatial.distance import cdist
+
+
+class CostMatrix:
+    """
+    Pairwise cost matrices between the source and target samples of a JDOT batch.
+    The squared euclidean and dice costs are computed from the norms (or sums) of the samples and a single matrix
+    product, instead of a loop over the pairs. The buffers are allocated once and reused at each step.
+    """
+    def __init__(self, float32=True, block_size=None):
+        '''
+        :param float32: If True, the costs are computed in float32.
+        :param block_size: If not None, the costs are computed by blocks of block_size source samples, which bounds
+        the memory used by the temporaries for large batches.
+        '''
+        self.dtype = np.float32 if float32 else np.float64
+        self.block_size = block_size
+        self.buffers = {}
+
+    def get_buffer(self, name, shape):
+        shape = tuple(shape)
+        if name not in self.buffers or self.buffers[name].shape != shape:
+            self.buffers[name] = np.empty(shape, dtype=self.dtype)
+        return self.buffers[name]
+
+    def as_matrix(self, name, samples):
+        '''
+        Copy the samples, flattened to (n_samples, n_features), in a buffer of the cost dtype.
+        '''
+        samples = np.asarray(samples).reshape(len(samples), -1)
+        matrix = self.get_buffer(name, samples.shape)
+        np.copyto(matrix, samples, casting="unsafe")
+        return matrix
+
+    def get_blocks(self, n):
+        block_size = self.block_size or n
+        return [(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+
+    def sqeuclidean(self, x, y, out):
+        '''
+        ||x - y||^2 = ||x||^2 + ||y||^2 - 2 <x, y>
+        '''
+        x_norms = np.einsum("ij,ij->i", x, x)
+        y_norms = np.einsum("ij,ij->i", y, y)
+        for start, stop in self.get_blocks(x.shape[0]):
+            block = out[start:stop]
+            np.dot(x[start:stop], y.T, out=block)
+            block *= -2
+            block += x_norms[start:stop, np.newaxis]
+            block += y_norms[np.newaxis]
+        # Rounding errors can make the distance of close samples slightly negative
+        np.maximum(out, 0, out=out)
+        return out
+
+    def dice(self, x, y, out):
+        '''
+        Dice dissimilarity (same definition as scipy): (sum(x) + sum(y) - 2 <x, y>) / (sum(x) + sum(y)). It is 0 when
+        both samples are empty.
+        '''
+        x_sums = x.sum(axis=1)
+        y_sums = y.sum(axis=1)
+        denominator = self.get_buffer("dice_denominator", out.shape)
+        np.add(x_sums[:, np.newaxis], y_sums[np.newaxis], out=denominator)
+        for start, stop in self.get_blocks(x.shape[0]):
+            block = out[start:stop]
+            np.dot(x[start:stop], y.T, out=block)
+            block *= -2
+            block += denominator[start:stop]
+        np.divide(out, denominator, out=out, where=denominator != 0)
+        out[denominator == 0] = 0
+        return out
+
+    def pairwise(self, x, y, distance, name="cost"):
+        '''
+        :param x: Samples of shape (n_source, ...).
+        :param y: Samples of shape (n_target, ...).
+        :param distance: "sqeuclidean", "dice" or any other metric of scipy's cdist.
+        :param name: Name of the output buffer, two calls with the same name share their output.
+        :return: The cost matrix of shape (n_source, n_target).
+        '''
+        x = self.as_matrix(name + "_x", x)
+        y = self.as_matrix(name + "_y", y)
+        out = self.get_buffer(name, (x.shape[0], y.shape[0]))
+        if distance == "sqeuclidean":
+            return self.sqeuclidean(x, y, out)
+        elif distance == "dice":
+            return self.dice(x, y, out)
+        out[...] = cdist(x, y, metric=distance)
+        return out
+
+    def jdot_cost(self, source_features, target_features, source_truth, target_prediction, alpha, beta,
+                  distance="sqeuclidean"):
+        '''
+        C = alpha * sqeuclidean(source_features, target_features) + beta * distance(source_truth, target_prediction)
+        :return: The JDOT cost matrix, a buffer that is overwritten by the next call.
+        '''
+        cost = self.pairwise(source_features, target_features, "sqeuclidean", name="features")
+        label_cost = self.pairwise(source_truth, target_prediction, distance, name="labels")
+        cost *= alpha
+        label_cost *= beta
+        cost += label_cost
+        return cost
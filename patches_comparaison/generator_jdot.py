@@ -7,8 +7,10 @@ import numpy as np
 import csv
 import sys
 from unet3d.utils import pickle_dump, pickle_load
-from unet3d.utils.patches import compute_patch_indices, get_random_nd_index, get_patch_from_3d_data
-from unet3d.augment import augment_data, random_permutation_x_y
+from unet3d.utils.patches import compute_patch_indices, get_random_nd_index, get_patch_from_storage
+from unet3d.utils.patch_statistics import (PatchIndex, compute_patch_statistics, select_patches_with_ground_truth,
+                                           select_patches_with_intensity_ceil)
+from unet3d.augment import augment_data, augment_batch, random_permutation_x_y
 from multiprocessing.pool import Pool
 from time import time
 import random
@@ -20,7 +22,8 @@ def get_batch_jdot(selected_source, selected_target, source_data_file, target_da
                                            augment_flip=True, augment_distortion_factor=0.25, patch_shape=None,
                                            validation_patch_overlap=0, training_patch_overlap = 0, training_patch_start_offset=None,
                                            validation_batch_size=None, skip_blank=True, permute=False, number_of_threads = 64,
-                                           target = True, validation = False, source_center = ["01"], target_center = ["07"], all = False):
+                                           target = True, validation = False, source_center = ["01"], target_center = ["07"], all = False,
+                                           loader = None):
     """
     Creates the training and validation generators that can be used when training the model.
     :param skip_blank: If True, any blank (all-zero) label images/patches will be skipped by the data generator.
@@ -51,6 +54,8 @@ def get_batch_jdot(selected_source, selected_target, source_data_file, target_da
     :param overwrite: If set to True, previous files will be overwritten. The default mode is false, so that the
     training and validation splits won't be overwritten when rerunning model training.
     :param permute: will randomly permute the data (data must be 3D cube)
+    :param loader: PatchLoader reading the patches with its long-lived workers. If None, a pool of workers is created
+    for each batch.
     :return: Training data generator, validation data generator, number of training steps, number of validation steps
     """
     affine_list_target = None
@@ -74,6 +79,8 @@ def get_batch_jdot(selected_source, selected_target, source_data_file, target_da
                                         permute=permute,
                                         number_of_threads = number_of_threads,
                                         all = all,
+                                        loader = loader,
+                                        file_key = "source",
                                         )
     if target:
         target_x, target_y, affine_list_target = data_generator_jdot_multi_proc(selected_target,
@@ -93,6 +100,8 @@ def get_batch_jdot(selected_source, selected_target, source_data_file, target_da
                                             permute=permute,
                                             number_of_threads = number_of_threads,
                                             all = all,
+                                            loader = loader,
+                                            file_key = "target",
                                             )
 
         x = np.vstack((source_x, target_x))
@@ -144,28 +153,33 @@ def get_patches_index_list(source_data_file, target_data_file, training_keys_fil
 
 
 
+    if skip_blank or ceil != None:
+        source_patch_index = PatchIndex(source_data_file, patch_shape=patch_shape)
+
     if skip_blank:
 
         save_patches_with_gt(source_training_list, source_data_file, patch_shape, training_patch_overlap,
-                             training_patch_start_offset, path=source_training_path, overwrite = change_validation)
+                             training_patch_start_offset, path=source_training_path, overwrite = change_validation,
+                             patch_index=source_patch_index)
 
         source_training_list = load_index_patches_with_gt(source_training_path)
 
         save_patches_with_gt(source_validation_list, source_data_file, patch_shape, training_patch_overlap,
-                             training_patch_start_offset, path=source_validation_path, overwrite = change_validation)
+                             training_patch_start_offset, path=source_validation_path, overwrite = change_validation,
+                             patch_index=source_patch_index)
 
         source_validation_list = load_index_patches_with_gt(source_validation_path)
 
     elif ceil != None:
         save_patches_with_ceil(source_training_list, source_data_file, patch_shape, training_patch_overlap,
                              training_patch_start_offset, path=source_training_path, overwrite = change_validation,
-                               ceil=ceil)
+                               ceil=ceil, patch_index=source_patch_index)
 
         source_training_list = load_index_patches_with_ceil(source_training_path)
 
         save_patches_with_ceil(source_validation_list, source_data_file, patch_shape, training_patch_overlap,
                              training_patch_start_offset, path=source_validation_path, overwrite = change_validation,
-                               ceil=ceil)
+                               ceil=ceil, patch_index=source_patch_index)
 
         source_validation_list = load_index_patches_with_ceil(source_validation_path)
 
@@ -194,24 +208,29 @@ def get_patches_index_list(source_data_file, target_data_file, training_keys_fil
     print("\nList of patients for target training: ", target_training_list)
     print("\nList of patients for target validation: ", target_validation_list)
 
+    if skip_blank or ceil != None:
+        target_patch_index = PatchIndex(target_data_file, patch_shape=patch_shape)
+
     if skip_blank:
         save_patches_with_gt(target_training_list, target_data_file, patch_shape, training_patch_overlap,
-                             training_patch_start_offset, path=target_training_path, overwrite = change_validation)
+                             training_patch_start_offset, path=target_training_path, overwrite = change_validation,
+                             patch_index=target_patch_index)
         target_training_list = load_index_patches_with_gt(target_training_path)
 
         save_patches_with_gt(target_validation_list, target_data_file, patch_shape, training_patch_overlap,
-                             training_patch_start_offset, path=target_validation_path, overwrite = change_validation)
+                             training_patch_start_offset, path=target_validation_path, overwrite = change_validation,
+                             patch_index=target_patch_index)
         target_validation_list = load_index_patches_with_gt(target_validation_path)
 
     elif ceil !=None:
         save_patches_with_ceil(target_training_list, target_data_file, patch_shape, training_patch_overlap,
                              training_patch_start_offset, path=target_training_path, overwrite = change_validation,
-                               ceil=ceil)
+                               ceil=ceil, patch_index=target_patch_index)
         target_training_list = load_index_patches_with_ceil(target_training_path)
 
         save_patches_with_ceil(target_validation_list, target_data_file, patch_shape, training_patch_overlap,
                              training_patch_start_offset, path=target_validation_path, overwrite = change_validation,
-                               ceil=ceil)
+                               ceil=ceil, patch_index=target_patch_index)
         target_validation_list = load_index_patches_with_ceil(target_validation_path)
 
 
@@ -227,6 +246,10 @@ def get_patches_index_list(source_data_file, target_data_file, training_keys_fil
 
         pickle_dump(target_validation_list, target_validation_path)
 
+    if skip_blank or ceil != None:
+        source_patch_index.close()
+        target_patch_index.close()
+
     return source_training_list, source_validation_list, target_training_list, target_validation_list
 
 def get_number_of_steps(n_samples, batch_size):
@@ -272,7 +295,8 @@ def split_a_list(input_list, split=0.8, shuffle_list=True):
 
 def data_generator_jdot_multi_proc(selected, data_file, validation = True, batch_size=1, n_labels=1, labels=None, augment=False, augment_flip=True,
                    augment_distortion_factor=0.25, patch_shape=None, patch_overlap=0, patch_start_offset=None,
-                   shuffle_index_list=True, skip_blank=True, permute=False, number_of_threads = 64, all = False):
+                   shuffle_index_list=True, skip_blank=True, permute=False, number_of_threads = 64, all = False,
+                   loader = None, file_key = "source"):
     '''
     Create a batch for jdot:
     source data: x_list[:batch_size]
@@ -293,15 +317,26 @@ def data_generator_jdot_multi_proc(selected, data_file, validation = True, batch
     :param skip_blank:
     :param permute:
     :param number_of_threads: Parameter to set the max number of threads used for the loading
+    :param loader: PatchLoader with long-lived workers. If None, multi_proc_loop creates its own pools.
+    :param file_key: Key of data_file in the loader ("source" or "target").
     :return:
     '''
     training_x_list = []
     training_y_list = []
-    training_x_list, training_y_list, affine_list  = multi_proc_loop(selected, data_file, training_x_list, training_y_list, batch_size = batch_size,
-                                         stopping_criterion= batch_size, number_of_threads = number_of_threads,
-                                         patch_shape=patch_shape, augment=augment, augment_flip=augment_flip,
-                                         augment_distortion_factor=augment_distortion_factor, skip_blank=skip_blank,
-                                         permute=permute, all = all)
+    if loader is not None:
+        if all:
+            augment = False
+            permute = False
+        training_x_list, training_y_list, affine_list = loader.load(file_key, selected, augment=augment,
+                                                                    augment_flip=augment_flip,
+                                                                    augment_distortion_factor=augment_distortion_factor,
+                                                                    skip_blank=skip_blank, permute=permute)
+    else:
+        training_x_list, training_y_list, affine_list  = multi_proc_loop(selected, data_file, training_x_list, training_y_list, batch_size = batch_size,
+                                             stopping_criterion= batch_size, number_of_threads = number_of_threads,
+                                             patch_shape=patch_shape, augment=augment, augment_flip=augment_flip,
+                                             augment_distortion_factor=augment_distortion_factor, skip_blank=skip_blank,
+                                             permute=permute, all = all)
 
     training_x_list, training_y_list = convert_data(training_x_list, training_y_list, n_labels=n_labels, labels=labels)
 
@@ -335,6 +370,8 @@ def multi_proc_loop(index_list, data_file, x_list, y_list, batch_size = 64, stop
         augment_flip = False
         augment_distortion_factor = None
         permute = False
+        # The indices are popped from the end: reversing the list keeps the loaded patches in the order of the list
+        index_list.reverse()
     initial_len = len(index_list)
     while len(index_list) > 0:
         # Two verifications for the remaining samples to put in the batch.
@@ -378,7 +415,12 @@ def multi_proc_loop(index_list, data_file, x_list, y_list, batch_size = 64, stop
     return x_list, y_list, affine_list
 
 def multi_proc_augment_data(data, affine_list, index_list, number_of_threads = 64,  patch_shape = 16, augment = False, augment_flip = False,
-                    augment_distortion_factor = None, skip_blank = False, permute = False):
+                    augment_distortion_factor = None, skip_blank = False, permute = False, loader = None):
+    if loader is not None:
+        x_list, y_list = loader.augment(data, affine_list, index_list, augment=augment, augment_flip=augment_flip,
+                                        augment_distortion_factor=augment_distortion_factor, skip_blank=skip_blank,
+                                        permute=permute)
+        return convert_data(x_list, y_list)
     images = data[0]
     truth = data[1]
     x_list = []
@@ -412,7 +454,28 @@ def multi_proc_augment_data(data, affine_list, index_list, number_of_threads = 6
     return (x_list, y_list)
 
 
-def save_patches_with_gt(index_list, data_file, patch_shape, patch_overlap, patch_start_offset, path, overwrite):
+def batch_augment_data(data, affine_list, augment=False, augment_flip=False, augment_distortion_factor=None,
+                       skip_blank=False, permute=False, rng=None):
+    '''
+    In-process alternative to multi_proc_augment_data: the whole batch is augmented with augment_batch, the samples
+    sharing the same transform in one call.
+    :param data: Tuple (x, y) of the patches, of shapes (n, n_channels) + patch_shape and (n, 1) + patch_shape.
+    :param affine_list: Affine of each patch.
+    :param rng: numpy RandomState drawing the augmentation (see augment_batch).
+    :return: The augmented batch (x, y), in the layout of convert_data. If skip_blank is True, the patches made blank
+    by the augmentation are replaced by the patches before augmentation: the batch keeps its size and the split between
+    its source and target patches.
+    '''
+    x, y = augment_batch(data[0], data[1], affine_list, augment=augment, flip=augment_flip,
+                         scale_deviation=augment_distortion_factor, permute=permute, rng=rng)
+    if skip_blank:
+        blank = ~np.any(y.reshape(len(y), -1) != 0, axis=1)
+        x[blank], y[blank] = data[0][blank], data[1][blank]
+    return convert_data(x, y)
+
+
+def save_patches_with_gt(index_list, data_file, patch_shape, patch_overlap, patch_start_offset, path, overwrite,
+                         patch_index=None):
     '''
     Save the indices computed in get_patches_with_GT
     :param index_list:
@@ -422,13 +485,14 @@ def save_patches_with_gt(index_list, data_file, patch_shape, patch_overlap, patc
     :param patch_start_offset:
     :param path:
     :param overwrite:
+    :param patch_index: PatchIndex of the data file (optional)
     :return:
     '''
     if not os.path.exists(path) or overwrite:
         print("Creating and saving a file containing the index of patches with GT. This may take a while...")
         index_list = create_patch_index_list(index_list, data_file.root.data.shape[-3:], patch_shape,
                                                       patch_overlap, patch_start_offset)
-        index_list = get_patches_with_ground_truth(index_list, data_file, patch_shape)
+        index_list = get_patches_with_ground_truth(index_list, data_file, patch_shape, patch_index)
         pickle_dump(index_list, path)
 
 def load_index_patches_with_gt(file_name):
@@ -439,7 +503,8 @@ def load_index_patches_with_gt(file_name):
     '''
     return pickle_load(file_name)
 
-def save_patches_with_ceil(index_list, data_file, patch_shape, patch_overlap, patch_start_offset, path, overwrite, ceil):
+def save_patches_with_ceil(index_list, data_file, patch_shape, patch_overlap, patch_start_offset, path, overwrite, ceil,
+                           patch_index=None):
     '''
     Save the indices computed in get_patches_with_intensity_ceil
     :param index_list:
@@ -449,13 +514,14 @@ def save_patches_with_ceil(index_list, data_file, patch_shape, patch_overlap, pa
     :param patch_start_offset:
     :param path:
     :param overwrite:
+    :param patch_index: PatchIndex of the data file (optional)
     :return:
     '''
     if not os.path.exists(path) or overwrite:
         print("Creating and saving a file containing the index of patches with GT. This may take a while...")
         index_list = create_patch_index_list(index_list, data_file.root.data.shape[-3:], patch_shape,
                                                       patch_overlap, patch_start_offset)
-        index_list = get_patches_with_intensity_ceil(index_list, data_file, patch_shape, ceil)
+        index_list = get_patches_with_intensity_ceil(index_list, data_file, patch_shape, ceil, patch_index)
         pickle_dump(index_list, path)
 
 def load_index_patches_with_ceil(file_name):
@@ -467,87 +533,49 @@ def load_index_patches_with_ceil(file_name):
     return pickle_load(file_name)
 
 
-def get_patches_with_ground_truth(index_list, data_file, patch_shape):
+def get_patches_with_ground_truth(index_list, data_file, patch_shape, patch_index=None):
     '''
-    Load all patches from the data file and create a list from the indexes of the patches containing a lesion.
+    Create a list from the indexes of the patches containing a lesion. Each subject is loaded only once and the
+    statistics of all its patches are computed together.
     :param index_list:
     :param data_file:
     :param patch_shape:
+    :param patch_index: PatchIndex of the data file. If None, the statistics are computed from the data file.
     :return:
     '''
-    new_index_list = []
-    initial_length = len(index_list)
-    while len(index_list) > 0: #Go through all the patches
-        advance = "\r Writing indexes with GT :" + str((initial_length - len(index_list))/initial_length*100 )+ "%"
-        sys.stdout.write(advance)
-        sys.stdout.flush()
-        index = index_list.pop()
-        data, truth = get_data_from_file(data_file, index, patch_shape=patch_shape) # Fetch the patch
-        if np.mean(truth) != 0: # Check if the mean of the patch's truth is different from 0 (equivalent to check if at least one voxel represent a lesion)
-            new_index_list += [index]
-    return new_index_list
-
-def get_patches_with_intensity_ceil(index_list, data_file, patch_shape, ceil):
-    new_index_list = []
-    initial_length = len(index_list)
-    patches_lesion = []
-    patches_no_lesion = []
-    n_patches_lesion = 0
-    n_patches_no_lesion = 0
-    tp = 0
-    fn = 0
-    while len(index_list) > 0: #Go through all the patches
-        advance = "\r Writing indexes which intensity is more than "+str(ceil)+" :" + str((initial_length - len(index_list))/initial_length*100 )+ "%"
-        sys.stdout.write(advance)
-        sys.stdout.flush()
-        index = index_list.pop()
-        data, truth = get_data_from_file(data_file, index, patch_shape=patch_shape) # Fetch the patch
-        if np.max(data[0]) > ceil: # Compute the ceil on the first modality in the modality list of config.py
-            new_index_list += [index]
-            if np.mean(truth) > 0:
-                tp += 1
-        else:
-            if np.mean(truth) > 0:
-                fn += 1
-        # data_no_zero = data[0].flatten().tolist()
-        # if 0.0 in data_no_zero:
-        #     data_no_zero=data_no_zero.remove(0.0)
-    #     if  np.mean(truth) == 0:
-    #         patches_no_lesion += [data[0].max()]
-    #         n_patches_no_lesion += 1
-    #     if  np.mean(truth) > 0:
-    #         patches_lesion += [data[0].max()]
-    #         n_patches_lesion += 1
-    #
-    # path = os.path.abspath("./Data/patch_no_lesions.csv")
-    # with open(path, 'a') as myfile:
-    #     wr = csv.writer(myfile)
-    #     wr.writerow(patches_no_lesion)
-    #
-    # path = os.path.abspath("./Data/patch_lesions.csv")
-    # with open(path, 'a') as myfile:
-    #     wr = csv.writer(myfile)
-    #     wr.writerow(patches_lesion)
+    statistics = compute_patch_statistics(data_file, index_list, patch_shape, patch_index)
+    return select_patches_with_ground_truth(index_list, statistics)
 
+def get_patches_with_intensity_ceil(index_list, data_file, patch_shape, ceil, patch_index=None):
+    '''
+    Create a list from the indexes of the patches whose maximum intensity, on the first modality in the modality list
+    of config.py, is more than ceil.
+    :param index_list:
+    :param data_file:
+    :param patch_shape:
+    :param ceil:
+    :param patch_index: PatchIndex of the data file. If None, the statistics are computed from the data file.
+    :return:
+    '''
+    statistics = compute_patch_statistics(data_file, index_list, patch_shape, patch_index)
+    retained = statistics["max"][:, 0] > ceil
+    lesion = statistics["lesion_count"] > 0
+    tp = int(np.sum(retained & lesion))
+    fn = int(np.sum(~retained & lesion))
     print("\n Number of patches with lesions retained: ", tp)
     print("\n Number of patches with lesions not retained: ", fn)
     print("\n Percentage: ", tp/(tp+fn)*100, '%')
-    return new_index_list
+    return select_patches_with_intensity_ceil(index_list, statistics, ceil)
 
 
 def get_number_of_patches(data_file, index_list, patch_shape=None, patch_overlap=0, patch_start_offset=None,
-                          skip_blank=True):
+                          skip_blank=True, patch_index=None):
     if patch_shape:
         index_list = create_patch_index_list(index_list, data_file.root.data.shape[-3:], patch_shape, patch_overlap,
                                              patch_start_offset)
-        count = 0
-        for index in index_list:
-            x_list = list()
-            y_list = list()
-            add_data(x_list, y_list, data_file, index, skip_blank=skip_blank, patch_shape=patch_shape)
-            if len(x_list) > 0:
-                count += 1
-        return count
+        if not skip_blank:
+            return len(index_list)
+        return len(get_patches_with_ground_truth(index_list, data_file, patch_shape, patch_index))
     else:
         return len(index_list)
 
@@ -655,9 +683,9 @@ def add_data_mp(data, truth, affine, index, augment=False, augment_flip=False, a
 def get_data_from_file(data_file, index, patch_shape=None):
     if patch_shape:
         index, patch_index = index
-        data, truth = get_data_from_file(data_file, index, patch_shape=None)
-        x = get_patch_from_3d_data(data, patch_shape, patch_index)
-        y = get_patch_from_3d_data(truth, patch_shape, patch_index)
+        # Only the chunks of the file intersecting the patch are read
+        x = get_patch_from_storage(data_file.root.data, index, patch_shape, patch_index)
+        y = get_patch_from_storage(data_file.root.truth, index, patch_shape, patch_index)[0]
     else:
         x, y = data_file.root.data[index], data_file.root.truth[index, 0]
     return x, y
@@ -0,0 +1,165 @@
+import numpy as np
+from scipy import sparse
+
+
+class GlobalCoupling:
+    """
+    Approximate optimal transport plan between all the source and all the target patches.
+    The dense N x M cost matrix is never built: the support of the plan is restricted to the k nearest neighbours of
+    each source patch among the target patches (and of each target patch among the source patches), found block by
+    block, and the entropic OT problem is solved with a log-domain Sinkhorn on this sparse support.
+    Only the k largest entries of each source row are kept, so the plan takes O((N + M) * k) memory.
+    """
+    def __init__(self, source_embeddings, target_embeddings, k=10, reg=0.05, n_iter=200, stop_threshold=1e-6,
+                 block_size=1024):
+        '''
+        :param source_embeddings: Embeddings of the source patches, shape (N, d).
+        :param target_embeddings: Embeddings of the target patches, shape (M, d).
+        :param k: Number of neighbours in the support of each patch and number of entries kept per source patch.
+        :param reg: Entropic regularization (the costs are normalized by their maximum).
+        :param n_iter: Maximum number of Sinkhorn iterations.
+        :param stop_threshold: Stopping threshold on the violation of the source marginal.
+        :param block_size: Number of patches per block in the neighbour search.
+        '''
+        source_embeddings = np.asarray(source_embeddings, dtype=np.float32)
+        target_embeddings = np.asarray(target_embeddings, dtype=np.float32)
+        n_source, n_target = len(source_embeddings), len(target_embeddings)
+        source_neighbours, source_distances = get_nearest_neighbours(source_embeddings, target_embeddings, k,
+                                                                     block_size)
+        target_neighbours, target_distances = get_nearest_neighbours(target_embeddings, source_embeddings, k,
+                                                                     block_size)
+        rows = np.concatenate([np.repeat(np.arange(n_source), source_neighbours.shape[1]), target_neighbours.ravel()])
+        columns = np.concatenate([source_neighbours.ravel(), np.repeat(np.arange(n_target), target_neighbours.shape[1])])
+        distances = np.concatenate([source_distances.ravel(), target_distances.ravel()])
+        # Pairs found in both directions are only kept once
+        _, unique = np.unique(rows.astype(np.int64) * n_target + columns, return_index=True)
+        cost = sparse.csr_matrix((distances[unique].astype(np.float64), (rows[unique], columns[unique])),
+                                 shape=(n_source, n_target))
+        cost.sort_indices()
+        if cost.data.max() > 0:
+            cost.data /= cost.data.max()
+        plan = sparse_sinkhorn(cost, np.full(n_source, 1. / n_source), np.full(n_target, 1. / n_target), reg,
+                               n_iter=n_iter, stop_threshold=stop_threshold)
+        self.plan = keep_top_k(plan, k)
+
+    def sample_targets(self, source_positions, random_state):
+        '''
+        Draw a target patch for each source patch, with the probabilities of its row of the plan.
+        :param source_positions: Positions of the source patches.
+        :param random_state: numpy RandomState.
+        :return: The positions of the coupled target patches.
+        '''
+        targets = np.empty(len(source_positions), dtype=np.int64)
+        for i, position in enumerate(source_positions):
+            start, stop = self.plan.indptr[position], self.plan.indptr[position + 1]
+            weights = self.plan.data[start:stop]
+            targets[i] = self.plan.indices[start + random_state.choice(stop - start, p=weights / weights.sum())]
+        return targets
+
+
+def get_nearest_neighbours(x, y, k, block_size=1024):
+    '''
+    k nearest neighbours (squared euclidean distance) in y of each sample of x, computed by blocks of x and y so that
+    only block_size x block_size distances are in memory at once.
+    :return: indices of shape (len(x), k) and squared distances of shape (len(x), k), sorted by distance
+    '''
+    k = min(k, len(y))
+    x_norms = np.einsum("ij,ij->i", x, x)
+    y_norms = np.einsum("ij,ij->i", y, y)
+    indices = np.empty((len(x), k), dtype=np.int64)
+    distances = np.empty((len(x), k), dtype=np.float32)
+    for x_start in range(0, len(x), block_size):
+        x_stop = min(x_start + block_size, len(x))
+        n = x_stop - x_start
+        best_distances = np.full((n, k), np.inf, dtype=np.float32)
+        best_indices = np.full((n, k), -1, dtype=np.int64)
+        for y_start in range(0, len(y), block_size):
+            y_stop = min(y_start + block_size, len(y))
+            block = np.dot(x[x_start:x_stop], y[y_start:y_stop].T)
+            block *= -2
+            block += x_norms[x_start:x_stop, np.newaxis]
+            block += y_norms[np.newaxis, y_start:y_stop]
+            # Only the distances smaller than the current k-th neighbour are merged with the best ones found so far
+            rows, columns = np.nonzero(block < best_distances[:, -1:])
+            if len(rows) == 0:
+                continue
+            candidate_rows = np.concatenate([np.repeat(np.arange(n), k), rows])
+            candidate_distances = np.concatenate([best_distances.ravel(), block[rows, columns]])
+            candidate_indices = np.concatenate([best_indices.ravel(), columns + y_start])
+            order = np.lexsort((candidate_distances, candidate_rows))
+            row_sizes = k + np.bincount(rows, minlength=n)
+            row_starts = np.cumsum(row_sizes) - row_sizes
+            rank = np.arange(len(order)) - row_starts[candidate_rows[order]]
+            kept = order[rank < k]
+            best_distances = candidate_distances[kept].reshape(n, k)
+            best_indices = candidate_indices[kept].reshape(n, k)
+        indices[x_start:x_stop] = best_indices
+        # Rounding errors can make the distance of close samples slightly negative
+        distances[x_start:x_stop] = np.maximum(best_distances, 0)
+    return indices, distances
+
+
+def sparse_logsumexp(values, indptr):
+    '''
+    logsumexp of each row of a CSR matrix (rows are assumed non empty).
+    '''
+    starts = indptr[:-1]
+    row_max = np.maximum.reduceat(values, starts)
+    row_of_values = np.repeat(np.arange(len(starts)), np.diff(indptr))
+    return row_max + np.log(np.add.reduceat(np.exp(values - row_max[row_of_values]), starts))
+
+
+def sparse_sinkhorn(cost, a, b, reg, n_iter=200, stop_threshold=1e-6):
+    '''
+    Log-domain Sinkhorn restricted to the non zero entries of a sparse cost matrix.
+    :param cost: CSR cost matrix of shape (N, M), every row and column must have at least one entry.
+    :param a: Source weights.
+    :param b: Target weights.
+    :param reg: Entropic regularization.
+    :return: The plan, a CSR matrix with the same support as cost.
+    '''
+    cost = cost.tocsr()
+    cost_by_column = cost.tocsc()
+    cost_by_column.sort_indices()
+    log_a, log_b = np.log(a), np.log(b)
+    f = np.zeros(cost.shape[0])
+    g = np.zeros(cost.shape[1])
+    for _ in range(n_iter):
+        f = reg * (log_a - sparse_logsumexp((g[cost.indices] - cost.data) / reg, cost.indptr))
+        g = reg * (log_b - sparse_logsumexp((f[cost_by_column.indices] - cost_by_column.data) / reg,
+                                            cost_by_column.indptr))
+        # After the update of g the target marginal is exact, the source marginal gives the error
+        rows = np.repeat(np.arange(cost.shape[0]), np.diff(cost.indptr))
+        plan_values = np.exp((f[rows] + g[cost.indices] - cost.data) / reg)
+        if np.abs(np.add.reduceat(plan_values, cost.indptr[:-1]) - a).sum() < stop_threshold:
+            break
+    rows = np.repeat(np.arange(cost.shape[0]), np.diff(cost.indptr))
+    plan_values = np.exp((f[rows] + g[cost.indices] - cost.data) / reg)
+    return sparse.csr_matrix((plan_values, cost.indices.copy(), cost.indptr.copy()), shape=cost.shape)
+
+
+def keep_top_k(plan, k):
+    '''
+    Keep the k largest entries of each row of a CSR matrix.
+    '''
+    rows = np.repeat(np.arange(plan.shape[0]), np.diff(plan.indptr))
+    # Entries sorted by row, then by decreasing value: the rank of an entry in its row is its offset from the row start
+    order = np.lexsort((-plan.data, rows))
+    rank = np.arange(len(order)) - plan.indptr[rows[order]]
+    kept = order[rank < k]
+    return sparse.csr_matrix((plan.data[kept], (rows[kept], plan.indices[kept])), shape=plan.shape)
+
+
+def pool_patches(patches, size=4):
+    '''
+    Embedding of patches by average pooling to size^3 voxels per channel.
+    :param patches: Array of shape (n, n_channels, x, y, z), each spatial dimension divisible by size.
+    :return: Embeddings of shape (n, n_channels * size^3)
+    '''
+    patches = np.asarray(patches, dtype=np.float32)
+    n, n_channels = patches.shape[:2]
+    shape = []
+    for dim in patches.shape[2:]:
+        shape += [size, dim // size]
+    pooled = patches.reshape((n, n_channels) + tuple(shape)).mean(axis=(3, 5, 7))
+    return pooled.reshape(n, -1)
@@ -0,0 +1,90 @@
+import numpy as np
+import ot
+
+OT_SOLVERS = ("emd", "sinkhorn", "sinkhorn_log", "sinkhorn_stabilized", "sinkhorn_unbalanced")
+
+
+class OTSolver:
+    """
+    Solver of the optimal transport problem between the source and target samples of a JDOT batch.
+    The exact solver (emd) scales cubically with the batch size; the entropic solvers (Sinkhorn) only need matrix
+    vector products and can start from the dual potentials of the previous step, as the batches of consecutive steps
+    are drawn from the same distributions.
+    """
+    def __init__(self, method="emd", reg=0.01, reg_m=1., warm_start=False, float32=False, max_iter=1000,
+                 stop_threshold=1e-6, normalize_cost=True):
+        '''
+        :param method: One of "emd" (exact), "sinkhorn", "sinkhorn_log" (log-domain Sinkhorn), "sinkhorn_stabilized"
+        (Sinkhorn with log-stabilization) or "sinkhorn_unbalanced".
+        :param reg: Entropic regularization.
+        :param reg_m: Marginal relaxation of the unbalanced Sinkhorn.
+        :param warm_start: If True, each Sinkhorn solve starts from the dual potentials of the previous one.
+        :param float32: If True, the cost matrix and the coupling are in float32.
+        :param max_iter: Maximum number of Sinkhorn iterations.
+        :param stop_threshold: Stopping threshold on the marginal violation.
+        :param normalize_cost: If True, the cost matrix is divided by its maximum so that reg does not depend on the
+        scale of the cost.
+        '''
+        if method not in OT_SOLVERS:
+            raise ValueError("Unknown OT solver: {}. Use one of {}".format(method, OT_SOLVERS))
+        self.method = method
+        self.reg = reg
+        self.reg_m = reg_m
+        self.warm_start = warm_start
+        self.dtype = np.float32 if float32 else np.float64
+        self.max_iter = max_iter
+        self.stop_threshold = stop_threshold
+        self.normalize_cost = normalize_cost
+        self.dual = None
+        self.n_iterations = 0  # Number of iterations of the last Sinkhorn solve.
+
+    def solve(self, cost, a=None, b=None):
+        '''
+        :param cost: Cost matrix of shape (n_source, n_target).
+        :param a: Weights of the source samples. Uniform if None.
+        :param b: Weights of the target samples. Uniform if None.
+        :return: The coupling (gamma) of shape (n_source, n_target).
+        '''
+        cost = np.asarray(cost, dtype=self.dtype)
+        a = ot.unif(cost.shape[0]) if a is None else a
+        b = ot.unif(cost.shape[1]) if b is None else b
+        if self.method == "emd":
+            # The network simplex only works in float64
+            return ot.emd(np.asarray(a, np.float64), np.asarray(b, np.float64),
+                          np.asarray(cost, np.float64)).astype(self.dtype)
+
+        a = np.asarray(a, dtype=self.dtype)
+        b = np.asarray(b, dtype=self.dtype)
+        if self.normalize_cost and cost.max() > 0:
+            cost = cost / cost.max()
+        warmstart = self.dual if self.warm_start and self.dual is not None \
+            and self.dual[0].shape == a.shape and self.dual[1].shape == b.shape else None
+
+        if self.method == "sinkhorn_unbalanced":
+            gamma, log = ot.sinkhorn_unbalanced(a, b, cost, self.reg, self.reg_m, method="sinkhorn",
+                                                warmstart=warmstart, numItermax=self.max_iter,
+                                                stopThr=self.stop_threshold, log=True)
+            dual = (log["logu"], log["logv"])
+            self.n_iterations = len(log["err"])
+        else:
+            gamma, log = ot.sinkhorn(a, b, cost, self.reg, method=self.method, warmstart=warmstart,
+                                     numItermax=self.max_iter, stopThr=self.stop_threshold, log=True, warn=False)
+            if self.method == "sinkhorn_stabilized":
+                dual = log["warmstart"]
+                self.n_iterations = log["n_iter"]
+            elif self.method == "sinkhorn_log":
+                dual = (log["log_u"], log["log_v"])
+                self.n_iterations = log["niter"]
+            else:
+                with np.errstate(divide="ignore"):
+                    dual = (np.log(log["u"]), np.log(log["v"]))
+                self.n_iterations = log["niter"]
+        # Potentials that under/overflowed would poison the next solve
+        self.dual = dual if np.all(np.isfinite(dual[0])) and np.all(np.isfinite(dual[1])) else None
+        return np.asarray(gamma, dtype=self.dtype)
+
+    def reset(self):
+        '''
+        Forget the dual potentials of the previous solve.
+        '''
+        self.dual = None
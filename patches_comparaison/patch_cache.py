@@ -0,0 +1,117 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+
+import numpy as np
+
+from unet3d.utils.patches import pad_data_for_patches, get_patches_from_padded_data
+
+
+class PatchCache:
+    """
+    On-disk store of the patches of an index list, extracted once from the hdf5 data file.
+    The patches, their truth and their (subject, corner) indices are saved as .npy files and memory-mapped, so that a
+    batch is a fancy-index into the arrays without any decompression.
+    The cache is keyed by the data file (path, size and modification time), the patch shape, the overlap, the selection
+    criterion and the index list itself: it is rebuilt as soon as one of them changes.
+    """
+    def __init__(self, path, data_file, index_list, patch_shape, patch_overlap=0, selection="all"):
+        '''
+        :param path: Directory where the cache is written.
+        :param data_file: Opened pytables data file the patches are taken from.
+        :param index_list: List of (subject, patch corner) tuples.
+        :param patch_shape: Shape of the patches.
+        :param patch_overlap: Overlap used to compute the index list.
+        :param selection: Name of the criterion used to select the patches (e.g. "skip_blank").
+        '''
+        self.path = path
+        self.patch_shape = tuple([int(dim) for dim in patch_shape])
+        self.key = get_cache_key(data_file, index_list, self.patch_shape, patch_overlap, selection)
+        if self.key != load_cache_key(path):
+            self.build(data_file, index_list)
+        self.data = np.load(os.path.join(path, "data.npy"), mmap_mode="r")
+        self.truth = np.load(os.path.join(path, "truth.npy"), mmap_mode="r")
+        self.index = np.load(os.path.join(path, "index.npy"))
+        self.affine = np.load(os.path.join(path, "affine.npy"))
+        self.positions = get_patch_position_map(self.index)
+
+    def build(self, data_file, index_list):
+        '''
+        Extract all the patches of the index list, reading each subject only once.
+        :param data_file:
+        :param index_list:
+        :return:
+        '''
+        print("Creating the patch cache in", self.path, ". This may take a while...")
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+        index = np.asarray([[subject] + list(corner) for subject, corner in index_list], dtype=np.int64).reshape(-1, 4)
+        n_channels = data_file.root.data.shape[1]
+        data = np.lib.format.open_memmap(os.path.join(self.path, "data.npy"), mode="w+", dtype=np.float32,
+                                         shape=(len(index), n_channels) + self.patch_shape)
+        truth = np.lib.format.open_memmap(os.path.join(self.path, "truth.npy"), mode="w+", dtype=np.uint8,
+                                          shape=(len(index), 1) + self.patch_shape)
+        subjects = np.unique(index[:, 0])
+        for i, subject in enumerate(subjects):
+            advance = "\rFilling the patch cache: " + str(round(i / len(subjects) * 100, 2)) + "%"
+            sys.stdout.write(advance)
+            sys.stdout.flush()
+            positions = np.where(index[:, 0] == subject)[0]
+            corners = index[positions, 1:]
+            subject_data, offset = pad_data_for_patches(data_file.root.data[subject], self.patch_shape, corners)
+            data[positions] = get_patches_from_padded_data(subject_data, self.patch_shape, corners + offset)
+            subject_truth, offset = pad_data_for_patches(data_file.root.truth[subject], self.patch_shape, corners)
+            truth[positions] = get_patches_from_padded_data(subject_truth, self.patch_shape, corners + offset)
+        data.flush()
+        truth.flush()
+        del data, truth
+        np.save(os.path.join(self.path, "index.npy"), index)
+        np.save(os.path.join(self.path, "affine.npy"), np.asarray(data_file.root.affine[:]))
+        # The key is written last: an interrupted build is never mistaken for a valid cache.
+        with open(os.path.join(self.path, "key.json"), "w") as opened_file:
+            json.dump(self.key, opened_file)
+        print("\nPatch cache created: ", len(index), "patches")
+
+    def get_positions(self, index_list):
+        return [self.positions[(int(subject), tuple(int(i) for i in corner))] for subject, corner in index_list]
+
+    def get_patches(self, positions):
+        '''
+        :param positions: Positions of the patches in the cache.
+        :return: data of shape (n, n_channels) + patch_shape, truth of shape (n, 1) + patch_shape and the affines.
+        '''
+        positions = np.asarray(positions, dtype=np.int64)
+        return (np.asarray(self.data[positions]), np.asarray(self.truth[positions]),
+                [self.affine[subject] for subject in self.index[positions, 0]])
+
+
+def get_patch_position_map(index):
+    '''
+    :param index: array of shape (n_patches, 4) containing the subject and the patch corner of each patch.
+    :return: a dictionary mapping (subject, corner) to the position of the patch.
+    '''
+    return {(int(row[0]), tuple(int(i) for i in row[1:])): position for position, row in enumerate(index)}
+
+
+def get_cache_key(data_file, index_list, patch_shape, patch_overlap, selection):
+    filename = os.path.abspath(data_file.filename)
+    file_stat = os.stat(filename)
+    index = np.asarray([[subject] + list(corner) for subject, corner in index_list], dtype=np.int64)
+    return {"data_file": filename,
+            "size": file_stat.st_size,
+            "mtime": file_stat.st_mtime,
+            "patch_shape": list(patch_shape),
+            "patch_overlap": int(patch_overlap),
+            "selection": str(selection),
+            "index": hashlib.sha1(index.tobytes()).hexdigest()}
+
+
+def load_cache_key(path):
+    key_file = os.path.join(path, "key.json")
+    if not os.path.exists(key_file):
+        return None
+    with open(key_file, "r") as opened_file:
+        return json.load(opened_file)
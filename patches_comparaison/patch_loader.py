@@ -0,0 +1,149 @@
+import os
+import random
+from multiprocessing import get_context, cpu_count
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import tables
+
+from unet3d.utils.patches import get_patch_from_storage
+from patches_comparaison.generator_jdot import add_data_mp
+
+_worker = {}
+
+
+class PatchLoader:
+    """
+    Long-lived pool of workers loading and augmenting patches.
+    The pool is created once (instead of once per batch): each worker opens the hdf5 files itself, only receives
+    (subject, patch corner) indices and writes the patches it prepared in shared memory, from which the batch is
+    stacked without pickling any array.
+    """
+    def __init__(self, data_files, n_channels, patch_shape, max_batch_size, number_of_threads=64, rng=None):
+        '''
+        :param data_files: Dictionary {key: path} of the hdf5 files the workers will read from.
+        :param n_channels: Number of modalities of the patches.
+        :param patch_shape: Shape of the patches.
+        :param max_batch_size: Number of patches that fit in the shared memory. Bigger requests are split.
+        :param number_of_threads: Maximum number of workers (capped by the number of CPUs).
+        :param rng: numpy RandomState drawing the seeds of the tasks. If None, the global random state of numpy is used.
+        '''
+        self.patch_shape = tuple([int(dim) for dim in patch_shape])
+        self.rng = np.random if rng is None else rng
+        self.max_batch_size = int(max_batch_size)
+        self.x_shape = (self.max_batch_size, n_channels) + self.patch_shape
+        self.y_shape = (self.max_batch_size, 1) + self.patch_shape
+        self.x_memory = SharedMemory(create=True, size=int(np.prod(self.x_shape)) * np.dtype(np.float32).itemsize)
+        self.y_memory = SharedMemory(create=True, size=int(np.prod(self.y_shape)) * np.dtype(np.uint8).itemsize)
+        self.x = np.ndarray(self.x_shape, dtype=np.float32, buffer=self.x_memory.buf)
+        self.y = np.ndarray(self.y_shape, dtype=np.uint8, buffer=self.y_memory.buf)
+        self.n_workers = max(1, min(int(number_of_threads), cpu_count()))
+        data_files = {key: os.path.abspath(path) for key, path in data_files.items()}
+        # The workers are spawned rather than forked so that they do not inherit the hdf5 (and keras) state of the
+        # training process.
+        self.pool = get_context("spawn").Pool(self.n_workers, initializer=_init_worker,
+                                              initargs=(data_files, self.x_memory.name, self.x_shape, self.y_memory.name, self.y_shape))
+
+    def load(self, file_key, index_list, augment=False, augment_flip=False, augment_distortion_factor=None,
+             skip_blank=False, permute=False):
+        '''
+        Load (and augment) the patches of the index list from one of the data files.
+        :param file_key: Key of the data file in the data_files dictionary.
+        :param index_list: List of (subject, patch corner) tuples.
+        :return: x of shape (n, n_channels) + patch_shape, y of shape (n, 1) + patch_shape, list of the affines.
+        Patches discarded by skip_blank are not returned.
+        '''
+        tasks = [(file_key, index, augment, augment_flip, augment_distortion_factor, skip_blank, permute)
+                 for index in index_list]
+        return self.run(_load_patch, tasks)
+
+    def augment(self, data, affine_list, index_list, augment=False, augment_flip=False, augment_distortion_factor=None,
+                skip_blank=False, permute=False):
+        '''
+        Augment patches that are already in memory.
+        :param data: Tuple (x, y) of the patches and their truth.
+        :return: x, y of the augmented patches
+        '''
+        x_list, y_list = [], []
+        for start in range(0, data[0].shape[0], self.max_batch_size):
+            stop = min(start + self.max_batch_size, data[0].shape[0])
+            self.x[:stop - start] = data[0][start:stop]
+            self.y[:stop - start] = data[1][start:stop]
+            tasks = [(affine_list[i], index_list[i], augment, augment_flip, augment_distortion_factor, skip_blank,
+                      permute) for i in range(start, stop)]
+            x, y, _ = self.run_on_slots(_augment_patch, tasks)
+            x_list.append(x)
+            y_list.append(y)
+        return np.concatenate(x_list), np.concatenate(y_list)
+
+    def run(self, function, tasks):
+        x_list, y_list, affine_list = [], [], []
+        for start in range(0, len(tasks), self.max_batch_size):
+            x, y, affines = self.run_on_slots(function, tasks[start:start + self.max_batch_size])
+            x_list.append(x)
+            y_list.append(y)
+            affine_list += affines
+        if len(x_list) == 0:
+            return np.empty((0,) + self.x_shape[1:], np.float32), np.empty((0,) + self.y_shape[1:], np.uint8), []
+        return np.concatenate(x_list), np.concatenate(y_list), affine_list
+
+    def run_on_slots(self, function, tasks):
+        '''
+        Run one task per slot of the shared memory. Each task gets its own seed so that the augmentation differs
+        between workers and is reproducible with the seed of self.rng.
+        '''
+        seeds = self.rng.randint(0, 2**31 - 1, size=len(tasks))
+        results = self.pool.starmap(function, [(slot, int(seed)) + tuple(task)
+                                               for slot, (task, seed) in enumerate(zip(tasks, seeds))])
+        kept = [slot for slot, is_kept, _ in results if is_kept]
+        affine_list = [affine for _, is_kept, affine in results if is_kept]
+        return np.array(self.x[kept]), np.array(self.y[kept]), affine_list
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        del self.x, self.y
+        self.x_memory.close()
+        self.x_memory.unlink()
+        self.y_memory.close()
+        self.y_memory.unlink()
+
+
+def _init_worker(data_files, x_name, x_shape, y_name, y_shape):
+    _worker["files"] = {key: tables.open_file(path, "r") for key, path in data_files.items()}
+    _worker["x_memory"] = SharedMemory(name=x_name)
+    _worker["y_memory"] = SharedMemory(name=y_name)
+    _worker["x"] = np.ndarray(x_shape, dtype=np.float32, buffer=_worker["x_memory"].buf)
+    _worker["y"] = np.ndarray(y_shape, dtype=np.uint8, buffer=_worker["y_memory"].buf)
+
+
+def _store_patch(slot, x_list, y_list):
+    if len(x_list) == 0:
+        return False
+    _worker["x"][slot] = x_list[0]
+    _worker["y"][slot] = y_list[0]
+    return True
+
+
+def _load_patch(slot, seed, file_key, index, augment, augment_flip, augment_distortion_factor, skip_blank, permute):
+    np.random.seed(seed)
+    random.seed(seed)
+    data_file = _worker["files"][file_key]
+    subject, patch_index = index
+    patch_shape = _worker["x"].shape[-3:]
+    data = get_patch_from_storage(data_file.root.data, subject, patch_shape, patch_index)
+    truth = get_patch_from_storage(data_file.root.truth, subject, patch_shape, patch_index)[0]
+    affine = data_file.root.affine[subject]
+    x_list, y_list = add_data_mp(data, truth, affine, index, augment, augment_flip, augment_distortion_factor,
+                                 patch_shape, skip_blank, permute)
+    return slot, _store_patch(slot, x_list, y_list), affine
+
+
+def _augment_patch(slot, seed, affine, index, augment, augment_flip, augment_distortion_factor, skip_blank, permute):
+    np.random.seed(seed)
+    random.seed(seed)
+    data = np.array(_worker["x"][slot])
+    truth = np.array(_worker["y"][slot, 0])
+    x_list, y_list = add_data_mp(data, truth, affine, index, augment, augment_flip, augment_distortion_factor,
+                                 data.shape[-3:], skip_blank, permute)
+    return slot, _store_patch(slot, x_list, y_list), affine
@@ -0,0 +1,95 @@
+import time
+import queue
+import itertools
+import threading
+
+
+class BatchPrefetcher:
+    """
+    Iterate over the batches of a generator while the next ones are prepared by a background thread.
+    The generator runs entirely in the background thread, so the batches come out in the order it produces them.
+    Only the loading (index selection, hdf5 reading, augmentation) should happen in the generator: the keras variables
+    must still be set by the thread iterating over the prefetcher.
+    The state read by the generator must not be changed while the thread runs: with max_batches, the generator can be
+    resumed by a new prefetcher once the consumer has changed that state.
+    """
+    def __init__(self, batches, depth=2, max_batches=None):
+        '''
+        :param batches: Generator of batches.
+        :param depth: Maximum number of batches prepared in advance. With 0 the batches are loaded on demand (no
+        overlap).
+        :param max_batches: If not None, the generator is not advanced past this number of batches.
+        '''
+        if max_batches is not None:
+            batches = itertools.islice(batches, max_batches)
+        self.batches = batches
+        self.depth = int(depth)
+        self.loading_time = 0.  # Time spent preparing the batches.
+        self.waiting_time = 0.  # Time the consumer spent waiting for a batch.
+        self.stop_event = threading.Event()
+        self.thread = None
+        if self.depth > 0:
+            self.queue = queue.Queue(maxsize=self.depth)
+            self.thread = threading.Thread(target=self.fill, daemon=True)
+            self.thread.start()
+
+    def fill(self):
+        try:
+            while not self.stop_event.is_set():
+                start = time.time()
+                try:
+                    batch = next(self.batches)
+                except StopIteration:
+                    break
+                self.loading_time += time.time() - start
+                self.put((False, batch))
+        except BaseException as error:
+            self.put((True, error))
+            return
+        self.put((True, None))
+
+    def put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.time()
+        if self.thread is None:
+            try:
+                batch = next(self.batches)
+            finally:
+                self.loading_time += time.time() - start
+                self.waiting_time += time.time() - start
+            return batch
+        is_last, item = self.queue.get()
+        self.waiting_time += time.time() - start
+        if is_last:
+            self.thread.join()
+            if item is not None:
+                raise item
+            raise StopIteration
+        return item
+
+    def get_overlap_ratio(self):
+        '''
+        :return: Fraction of the loading time that was hidden behind the computations of the consumer.
+        '''
+        if self.loading_time == 0:
+            return 0.
+        return max(0., 1. - self.waiting_time / self.loading_time)
+
+    def close(self):
+        '''
+        Stop the background thread. The batches that were not consumed are dropped.
+        '''
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -4,10 +4,11 @@ import sys
 
 sys.path.append('/udd/aackaouy/OT-DA/')
 
-from unet3d.data import write_data_to_file, open_data_file
+from unet3d.data import update_data_file, open_data_file
 from unet3d.model import isensee2017_model
 from unet3d.training import load_old_model, train_model
 from patches_comparaison.JDOT import JDOT
+from federated.normalization import NormalizationServer, harmonize_centers
 
 class Train_JDOT:
     """
@@ -27,49 +28,69 @@ class Train_JDOT:
             source_data_files, target_data_files, subject_ids_source, subject_ids_target = self.fetch_training_data_files(return_subject_ids=True)
 
             if not os.path.exists(self.config.source_data_file) or overwrite_data:
-                write_data_to_file(source_data_files, self.config.source_data_file, image_shape=self.config.image_shape,
-                               subject_ids=subject_ids_source)
+                update_data_file(source_data_files, self.config.source_data_file, image_shape=self.config.image_shape,
+                                 subject_ids=subject_ids_source, chunk_shape=self.config.chunk_shape,
+                                 complib=self.config.complib, complevel=self.config.complevel,
+                                 n_processes=self.config.ingestion_processes,
+                                 normalization=self.config.normalization)
             if not os.path.exists(self.config.target_data_file) or overwrite_data:
-                write_data_to_file(target_data_files, self.config.target_data_file, image_shape=self.config.image_shape,
-                               subject_ids=subject_ids_target)
+                update_data_file(target_data_files, self.config.target_data_file, image_shape=self.config.image_shape,
+                                 subject_ids=subject_ids_target, chunk_shape=self.config.chunk_shape,
+                                 complib=self.config.complib, complevel=self.config.complevel,
+                                 n_processes=self.config.ingestion_processes,
+                                 normalization=self.config.normalization)
         else:
             print("Reusing previously written data file. Set overwrite_data to True to overwrite this file.")
+        if self.config.normalization_server:
+            self.harmonize_data_files()
 
         source_data = open_data_file(self.config.source_data_file)
         target_data = open_data_file(self.config.target_data_file)
+        # The workers and shared memory of JDOT and the data files are released even if the training fails
+        try:
+            # instantiate new model, compile = False because the compilation is made in JDOT.py
 
+            model, context_output_name = isensee2017_model(input_shape=self.config.input_shape, n_labels=self.config.n_labels,
+                                          initial_learning_rate=self.config.initial_learning_rate,
+                                          n_base_filters=self.config.n_base_filters,
+                                          loss_function=self.config.loss_function,
+                                          shortcut=self.config.shortcut,
+                                          depth=self.config.depth,
+                                          compile=False)
+            # get training and testing generators
+            if not self.config.depth_jdot:
+                context_output_name = []
+            jd = JDOT(model, config=self.config, source_data=source_data, target_data=target_data, context_output_name=context_output_name)
+            try:
+                # m = jd.load_old_model(self.config.model_file)
+                # print(m)
+                if self.config.load_base_model:
+                    print("Loading trained model")
+                    jd.load_old_model(os.path.abspath("Data/saved_models/model_center_"+self.config.source_center)+".h5")
+                elif not self.config.overwrite_model:
+                    jd.load_old_model(self.config.model_file)
+                else:
+                    print("Creating new model, this will overwrite your old model")
+                jd.compile_model()
+                if self.config.train_jdot:
+                    jd.train_model(self.config.epochs)
+                else:
+                    jd.train_model_on_source(self.config.epochs)
+                jd.evaluate_model()
+            finally:
+                jd.close()
+        finally:
+            source_data.close()
+            target_data.close()
 
-        # instantiate new model, compile = False because the compilation is made in JDOT.py
-
-        model, context_output_name = isensee2017_model(input_shape=self.config.input_shape, n_labels=self.config.n_labels,
-                                      initial_learning_rate=self.config.initial_learning_rate,
-                                      n_base_filters=self.config.n_base_filters,
-                                      loss_function=self.config.loss_function,
-                                      shortcut=self.config.shortcut,
-                                      depth=self.config.depth,
-                                      compile=False)
-        # get training and testing generators
-        if not self.config.depth_jdot:
-            context_output_name = []
-        jd = JDOT(model, config=self.config, source_data=source_data, target_data=target_data, context_output_name=context_output_name)
-        # m = jd.load_old_model(self.config.model_file)
-        # print(m)
-        if self.config.load_base_model:
-            print("Loading trained model")
-            jd.load_old_model(os.path.abspath("Data/saved_models/model_center_"+self.config.source_center)+".h5")
-        elif not self.config.overwrite_model:
-            jd.load_old_model(self.config.model_file)
-        else:
-            print("Creating new model, this will overwrite your old model")
-        jd.compile_model()
-        if self.config.train_jdot:
-            jd.train_model(self.config.epochs)
-        else:
-            jd.train_model_on_source(self.config.epochs)
-        jd.evaluate_model()
-
-        source_data.close()
-        target_data.close()
+    def harmonize_data_files(self):
+        '''
+        The source and target centers publish the statistics of their data files on the normalization server, then
+        normalize them with the pooled statistics. No center reads the images of another one.
+        '''
+        server = NormalizationServer(self.config.normalization_server)
+        harmonize_centers(server, {get_center_name(self.config.source_center): self.config.source_data_file,
+                                   get_center_name(self.config.target_center): self.config.target_data_file})
 
     def fetch_training_data_files(self, return_subject_ids=False):
         '''
@@ -108,3 +129,7 @@ class Train_JDOT:
             return source_data_files, target_data_files, subject_ids_source, subject_ids_target
         else:
             return source_data_files, target_data_files
+
+
+def get_center_name(center):
+    return "_".join(center) if isinstance(center, (list, tuple)) else str(center)
@@ -0,0 +1,40 @@
+from unittest import TestCase
+
+import numpy as np
+
+from patches_comparaison.activation_cache import ActivationCache
+
+
+class TestActivationCache(TestCase):
+    def test_store_and_load(self):
+        cache = ActivationCache(6)
+        self.assertFalse(cache.contains([0], 0))
+        features = np.random.rand(2, 3, 2, 2, 2)
+        segmentation = np.random.rand(2, 1, 4, 4, 4)
+        cache.store([4, 1], [features, segmentation], 0)
+        self.assertTrue(cache.contains([1, 4], 1))
+        self.assertFalse(cache.contains([1, 2], 1))
+        cached_features, cached_segmentation = cache.load([1, 4])
+        self.assertTrue(np.allclose(cached_features, features[::-1]))
+        self.assertTrue(np.allclose(cached_segmentation, segmentation[::-1]))
+
+    def test_max_age(self):
+        cache = ActivationCache(4, max_age=2)
+        cache.store([0, 1], [np.random.rand(2, 1, 4, 4, 4)], 3)
+        cache.store([2], [np.random.rand(1, 1, 4, 4, 4)], 5)
+        self.assertTrue(np.array_equal(cache.ages([0, 2, 3], 5), [2, 0, -1]))
+        self.assertTrue(cache.contains([0, 2], 5))
+        self.assertFalse(cache.contains([0, 2], 6))
+        self.assertTrue(cache.contains([2], 6))
+        cache.store([0], [np.random.rand(1, 1, 4, 4, 4)], 6)
+        self.assertTrue(cache.contains([0, 2], 6))
+
+    def test_hits_of_next_epoch(self):
+        # Each patch is trained on once per epoch, in any order: all of them are hit during the next epoch
+        cache = ActivationCache(100, max_age=1)
+        for epoch in range(3):
+            order = np.random.permutation(100).reshape(25, 4)
+            hits = [cache.contains(positions, epoch) for positions in order]
+            self.assertEqual(sum(hits), 0 if epoch == 0 else 25)
+            for positions in order:
+                cache.store(positions, [np.random.rand(4, 1, 2, 2, 2)], epoch)
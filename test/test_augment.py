@@ -0,0 +1,162 @@
+import random
+from unittest import TestCase
+
+import numpy as np
+from nilearn.image import resample_to_img
+
+from unet3d.augment import (augment_data, augment_batch, distort_data, distort_image, get_image,
+                            generate_permutation_keys, permute_batch, permute_data, random_permutation_x_y,
+                            reverse_permute_data, reverse_permutation_key)
+
+
+def nilearn_distort(data, truth, affine, flip_axis=None, scale_factor=None):
+    data_list = [resample_to_img(distort_image(get_image(channel, affine), flip_axis=flip_axis,
+                                               scale_factor=scale_factor), get_image(channel, affine),
+                                 interpolation="continuous").get_data() for channel in data]
+    truth_image = get_image(truth, affine)
+    distorted_truth = resample_to_img(distort_image(truth_image, flip_axis=flip_axis, scale_factor=scale_factor),
+                                      truth_image, interpolation="nearest").get_data()
+    return np.asarray(data_list), distorted_truth
+
+
+def chained_permute_data(data, key):
+    data = np.copy(data)
+    (rotate_y, rotate_z), flip_x, flip_y, flip_z, transpose = key
+    if rotate_y != 0:
+        data = np.rot90(data, rotate_y, axes=(1, 3))
+    if rotate_z != 0:
+        data = np.rot90(data, rotate_z, axes=(2, 3))
+    if flip_x:
+        data = data[:, ::-1]
+    if flip_y:
+        data = data[:, :, ::-1]
+    if flip_z:
+        data = data[:, :, :, ::-1]
+    if transpose:
+        for i in range(data.shape[0]):
+            data[i] = data[i].T
+    return data
+
+
+def chained_reverse_permute_data(data, key):
+    key = reverse_permutation_key(key)
+    data = np.copy(data)
+    (rotate_y, rotate_z), flip_x, flip_y, flip_z, transpose = key
+    if transpose:
+        for i in range(data.shape[0]):
+            data[i] = data[i].T
+    if flip_z:
+        data = data[:, :, :, ::-1]
+    if flip_y:
+        data = data[:, :, ::-1]
+    if flip_x:
+        data = data[:, ::-1]
+    if rotate_z != 0:
+        data = np.rot90(data, rotate_z, axes=(2, 3))
+    if rotate_y != 0:
+        data = np.rot90(data, rotate_y, axes=(1, 3))
+    return data
+
+
+class TestDistortData(TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.data = random_state.rand(2, 12, 10, 9).astype(np.float32)
+        self.truth = (self.data[0] > 0.7).astype(np.uint8)
+        self.affine = np.diag([1.2, 1., 0.8, 1.])
+        self.affine[:3, 3] = [-3., 5., 1.]
+
+    def test_equivalent_to_nilearn(self):
+        random_state = np.random.RandomState(1)
+        for flip_axis, scale_factor in [(None, None), ([0, 2], None), (None, np.asarray([1.1, 0.9, 1.])),
+                                        ([1], random_state.normal(1, 0.25, 3))]:
+            data, truth = distort_data(self.data, self.truth, self.affine, flip_axis=flip_axis,
+                                       scale_factor=scale_factor)
+            expected_data, expected_truth = nilearn_distort(self.data, self.truth, self.affine, flip_axis=flip_axis,
+                                                            scale_factor=scale_factor)
+            np.testing.assert_allclose(data, expected_data, rtol=1e-5, atol=1e-5)
+            np.testing.assert_array_equal(truth, expected_truth)
+
+    def test_augment_data(self):
+        data, truth = augment_data(self.data, self.truth, self.affine, scale_deviation=0.25, flip=True)
+        self.assertEqual(data.shape, self.data.shape)
+        self.assertEqual(truth.shape, self.truth.shape)
+        self.assertEqual(truth.dtype, self.truth.dtype)
+        # The input arrays are left untouched
+        data, _ = augment_data(self.data, self.truth, self.affine, flip=False)
+        np.testing.assert_array_equal(data, self.data)
+        self.assertIsNot(data, self.data)
+
+
+class TestAugmentBatch(TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.data = random_state.rand(12, 2, 8, 8, 8).astype(np.float32)
+        self.truth = (self.data[:, :1] > 0.7).astype(np.uint8)
+        self.affine_list = [np.diag([1., 1.2, 0.9, 1.])] * len(self.data)
+
+    def test_permute_batch(self):
+        for key in generate_permutation_keys():
+            expected = np.asarray([permute_data(data, key) for data in self.data])
+            np.testing.assert_array_equal(permute_batch(self.data, key), expected)
+
+    def test_same_as_sample_augmentation(self):
+        for augment, scale_deviation, permute in [(True, None, True), (True, 0.25, False), (True, 0.25, True),
+                                                  (False, 0.25, True)]:
+            np.random.seed(3)
+            random.seed(3)
+            x, y = augment_batch(self.data, self.truth, self.affine_list, augment=augment, flip=True,
+                                 scale_deviation=scale_deviation, permute=permute)
+            np.random.seed(3)
+            random.seed(3)
+            for data, truth, affine, augmented_data, augmented_truth in zip(self.data, self.truth, self.affine_list,
+                                                                            x, y):
+                truth = truth[0]
+                if augment:
+                    data, truth = augment_data(data, truth, affine, flip=True, scale_deviation=scale_deviation)
+                truth = truth[np.newaxis]
+                if permute:
+                    data, truth = random_permutation_x_y(data, truth)
+                np.testing.assert_allclose(augmented_data, data, rtol=1e-6, atol=1e-6)
+                np.testing.assert_array_equal(augmented_truth, truth)
+        self.assertEqual(x.shape, self.data.shape)
+        self.assertEqual(y.dtype, self.truth.dtype)
+
+    def test_random_state(self):
+        np.random.seed(5)
+        random.seed(5)
+        expected_state = np.random.get_state()[1].copy(), random.getstate()
+        x, y = augment_batch(self.data, self.truth, self.affine_list, scale_deviation=0.25, permute=True,
+                             rng=np.random.RandomState(2))
+        # The global random states are not used
+        np.testing.assert_array_equal(np.random.get_state()[1], expected_state[0])
+        self.assertEqual(random.getstate(), expected_state[1])
+        other_x, other_y = augment_batch(self.data, self.truth, self.affine_list, scale_deviation=0.25, permute=True,
+                                         rng=np.random.RandomState(2))
+        np.testing.assert_array_equal(other_x, x)
+        np.testing.assert_array_equal(other_y, y)
+
+    def test_not_a_cube(self):
+        with self.assertRaises(ValueError):
+            augment_batch(self.data[..., :4], self.truth[..., :4], self.affine_list, permute=True)
+
+
+class TestPermutationTables(TestCase):
+    def test_same_as_chained_permutations(self):
+        data = np.random.RandomState(0).rand(2, 5, 5, 5)
+        for key in generate_permutation_keys():
+            permuted = permute_data(data, key)
+            np.testing.assert_array_equal(permuted, chained_permute_data(data, key))
+            np.testing.assert_array_equal(reverse_permute_data(permuted, key),
+                                          chained_reverse_permute_data(permuted, key))
+            np.testing.assert_array_equal(reverse_permute_data(permuted, key), data)
+
+    def test_views(self):
+        data = np.random.RandomState(0).rand(2, 4, 4, 4)
+        for key in generate_permutation_keys():
+            permuted = permute_data(data, key, copy=False)
+            self.assertTrue(np.shares_memory(permuted, data))
+            self.assertFalse(np.shares_memory(permute_data(data, key), data))
+            reversed_permutation = reverse_permute_data(permuted, key, copy=False)
+            self.assertTrue(np.shares_memory(reversed_permutation, data))
+            np.testing.assert_array_equal(reversed_permutation, data)
@@ -0,0 +1,44 @@
+from unittest import TestCase
+
+import numpy as np
+from scipy.spatial.distance import cdist
+
+from patches_comparaison.cost_matrix import CostMatrix
+
+
+class TestCostMatrix(TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.source = random_state.rand(12, 2, 4, 4, 4)
+        self.target = random_state.rand(12, 2, 4, 4, 4)
+        self.truth = (random_state.rand(12, 1, 4, 4, 4) > 0.7).astype(np.float64)
+        self.truth[0] = 0
+        self.prediction = random_state.rand(12, 1, 4, 4, 4)
+
+    def test_sqeuclidean(self):
+        expected = cdist(self.source.reshape(12, -1), self.target.reshape(12, -1), metric="sqeuclidean")
+        for float32, block_size in ((False, None), (True, None), (True, 5)):
+            cost = CostMatrix(float32=float32, block_size=block_size).pairwise(self.source, self.target,
+                                                                              "sqeuclidean")
+            self.assertTrue(np.allclose(cost, expected, rtol=1e-4))
+
+    def test_dice(self):
+        expected = cdist(self.truth.reshape(12, -1), self.prediction.reshape(12, -1), metric="dice")
+        for float32, block_size in ((False, None), (True, None), (True, 5)):
+            cost = CostMatrix(float32=float32, block_size=block_size).pairwise(self.truth, self.prediction, "dice")
+            self.assertTrue(np.allclose(cost, expected, rtol=1e-4))
+        empty = np.zeros((2, 8))
+        self.assertTrue(np.array_equal(CostMatrix().pairwise(empty, empty, "dice"), np.zeros((2, 2))))
+
+    def test_jdot_cost(self):
+        alpha, beta = 0.001, 0.0001
+        expected = alpha * cdist(self.source.reshape(12, -1), self.target.reshape(12, -1), metric="sqeuclidean") \
+            + beta * cdist(self.truth.reshape(12, -1), self.prediction.reshape(12, -1), metric="dice")
+        cost_matrix = CostMatrix()
+        cost = cost_matrix.jdot_cost(self.source, self.target, self.truth, self.prediction, alpha, beta,
+                                     distance="dice")
+        self.assertTrue(np.allclose(cost, expected, rtol=1e-4))
+        # The buffers are reused by the next step
+        next_cost = cost_matrix.jdot_cost(self.target, self.source, self.truth, self.prediction, alpha, beta,
+                                          distance="dice")
+        self.assertIs(cost, next_cost)
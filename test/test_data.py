@@ -0,0 +1,151 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import nibabel as nib
+import numpy as np
+import tables
+
+from unet3d.data import add_data_to_storage, create_data_file, open_data_file, get_data_layout, write_data_to_file, \
+    update_data_file
+from unet3d.generator import get_data_from_file
+from unet3d.utils.patches import get_patch_from_3d_data
+
+
+class TestDataFile(TestCase):
+    def setUp(self):
+        self.data_file_path = os.path.abspath("./temporary_layout_test_file.h5")
+        self.image_shape = (20, 18, 9)
+        self.n_channels = 2
+        self.data = np.random.rand(2, self.n_channels, *self.image_shape).astype(np.float32)
+        self.truth = (self.data[:, :1] > 0.8).astype(np.uint8)
+
+    def tearDown(self):
+        if os.path.exists(self.data_file_path):
+            os.remove(self.data_file_path)
+
+    def write(self, **kwargs):
+        data_file, data_storage, truth_storage, affine_storage = create_data_file(self.data_file_path, self.n_channels,
+                                                                                  len(self.data), self.image_shape,
+                                                                                  **kwargs)
+        for data, truth in zip(self.data, self.truth):
+            add_data_to_storage(data_storage, truth_storage, affine_storage, np.concatenate([data, truth]),
+                                affine=np.diag(np.ones(4)), n_channels=self.n_channels, truth_dtype=np.uint8)
+        data_file.close()
+        return open_data_file(self.data_file_path)
+
+    def test_chunk_layout(self):
+        data_file = self.write(chunk_shape=(8, 8, 16), complib="blosc:lz4", complevel=3)
+        self.assertEqual(data_file.root.data.chunkshape, (1, self.n_channels, 8, 8, 9))
+        self.assertEqual(data_file.root.truth.chunkshape, (1, 1, 8, 8, 9))
+        self.assertEqual(get_data_layout(data_file), {"chunk_shape": (8, 8, 9), "complib": "blosc:lz4",
+                                                      "complevel": 3})
+        for patch_index in [(0, 0, 0), (5, 9, 2), (-2, 15, 6)]:
+            x, y = get_data_from_file(data_file, (1, patch_index), patch_shape=(4, 4, 4))
+            np.testing.assert_array_equal(x, get_patch_from_3d_data(self.data[1], (4, 4, 4), np.asarray(patch_index)))
+            np.testing.assert_array_equal(y, get_patch_from_3d_data(self.truth[1, 0], (4, 4, 4),
+                                                                    np.asarray(patch_index)))
+        data_file.close()
+
+    def test_no_compression(self):
+        data_file = self.write(chunk_shape=(16, 16, 16), complib="none", complevel=0)
+        self.assertEqual(data_file.root.data.filters.complevel, 0)
+        self.assertEqual(get_data_layout(data_file)["complib"], "none")
+        np.testing.assert_array_equal(data_file.root.data[0], self.data[0])
+        data_file.close()
+
+    def test_unknown_compression(self):
+        with self.assertRaises(ValueError):
+            create_data_file(self.data_file_path, self.n_channels, 1, self.image_shape, complib="unknown")
+
+
+class TestWriteDataToFile(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.image_shape = (8, 8, 8)
+        self.training_data_files = []
+        for subject in range(3):
+            set_of_files = []
+            for name in ("t1", "flair", "truth"):
+                data = np.random.rand(12, 10, 9).astype(np.float32)
+                if name == "truth":
+                    data = (data > 0.8).astype(np.float32)
+                path = os.path.join(self.directory, str(subject) + "_" + name + ".nii.gz")
+                nib.save(nib.Nifti1Image(data, np.diag(np.ones(4))), path)
+                set_of_files.append(path)
+            self.training_data_files.append(tuple(set_of_files))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, path):
+        data_file = open_data_file(path)
+        arrays = data_file.root.data[:], data_file.root.truth[:], data_file.root.affine[:]
+        data_file.close()
+        return arrays
+
+    def test_parallel_ingestion(self):
+        serial = os.path.join(self.directory, "serial.h5")
+        parallel = os.path.join(self.directory, "parallel.h5")
+        write_data_to_file(self.training_data_files, serial, self.image_shape, crop=False, subject_ids=["a", "b", "c"])
+        write_data_to_file(self.training_data_files, parallel, self.image_shape, crop=False, n_processes=2)
+        for expected, array in zip(self.read(serial), self.read(parallel)):
+            np.testing.assert_array_equal(array, expected)
+
+    def test_resume(self):
+        expected_path = os.path.join(self.directory, "expected.h5")
+        path = os.path.join(self.directory, "resumed.h5")
+        write_data_to_file(self.training_data_files, expected_path, self.image_shape, crop=False, normalize=False)
+        write_data_to_file(self.training_data_files, path, self.image_shape, crop=False, normalize=False)
+        # Interruption while the second subject was written
+        with tables.open_file(path, mode="a") as data_file:
+            data_file.root.truth.truncate(1)
+            data_file.root.affine.truncate(1)
+            data_file.root.data.truncate(2)
+            data_file.root._v_attrs.complete = False
+        write_data_to_file(self.training_data_files, path, self.image_shape, crop=False, normalize=False, resume=True)
+        for expected, array in zip(self.read(expected_path), self.read(path)):
+            np.testing.assert_array_equal(array, expected)
+        # A complete file is reused
+        modification_time = os.path.getmtime(path)
+        write_data_to_file(self.training_data_files, path, self.image_shape, crop=False, normalize=False, resume=True)
+        self.assertEqual(os.path.getmtime(path), modification_time)
+
+    def test_resume_update(self):
+        expected_path = os.path.join(self.directory, "expected.h5")
+        path = os.path.join(self.directory, "resumed.h5")
+        write_data_to_file(self.training_data_files, expected_path, self.image_shape, crop=False, normalize=False)
+        update_data_file(self.training_data_files, path, self.image_shape, crop=False, normalize=False)
+        # Interruption of the first build while the third subject was written
+        manifest_path = os.path.join(self.directory, "resumed_manifest.json")
+        os.replace(manifest_path, os.path.join(self.directory, "resumed_manifest.pending.json"))
+        with tables.open_file(path, mode="a") as data_file:
+            for storage in (data_file.root.data, data_file.root.truth, data_file.root.affine):
+                storage.truncate(2)
+            data_file.root._v_attrs.complete = False
+            # The first subjects are not read again
+            data_file.root.data[0] = 0
+        update_data_file(self.training_data_files, path, self.image_shape, crop=False, normalize=False)
+        self.assertTrue(os.path.exists(manifest_path))
+        expected, array = self.read(expected_path)[0], self.read(path)[0]
+        self.assertFalse(np.any(array[0]))
+        np.testing.assert_array_equal(array[1:], expected[1:])
+
+    def test_update_data_file(self):
+        path = os.path.join(self.directory, "updated.h5")
+        update_data_file(self.training_data_files, path, self.image_shape, crop=False)
+        modification_time = os.path.getmtime(path)
+        update_data_file(self.training_data_files, path, self.image_shape, crop=False)
+        self.assertEqual(os.path.getmtime(path), modification_time)
+        # One subject changes: the others are copied from the previous data file
+        data = np.random.rand(12, 10, 9).astype(np.float32)
+        nib.save(nib.Nifti1Image(data, np.diag(np.ones(4))), self.training_data_files[1][0])
+        previous_data = self.read(path)[0]
+        update_data_file(self.training_data_files, path, self.image_shape, crop=False, subject_ids=["a", "b", "c"])
+        expected_path = os.path.join(self.directory, "expected.h5")
+        write_data_to_file(self.training_data_files, expected_path, self.image_shape, crop=False)
+        for expected, array in zip(self.read(expected_path), self.read(path)):
+            np.testing.assert_allclose(array, expected, rtol=1e-6)
+        np.testing.assert_array_equal(self.read(path)[0][[0, 2]], previous_data[[0, 2]])
+        self.assertFalse(np.array_equal(self.read(path)[0][1], previous_data[1]))
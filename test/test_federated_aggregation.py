@@ -0,0 +1,22 @@
+from unittest import TestCase
+
+import numpy as np
+
+from federated.aggregation import federated_average
+
+
+class TestFederatedAverage(TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.weights = [[random_state.rand(3, 3, 3, 2, 4).astype(np.float32), random_state.rand(4).astype(np.float32)]
+                        for _ in range(3)]
+
+    def test_weighted_by_patch_count(self):
+        average = federated_average(self.weights, [10, 30, 0])
+        for index in range(2):
+            np.testing.assert_allclose(average[index], 0.25 * self.weights[0][index] + 0.75 * self.weights[1][index],
+                                       rtol=1e-6)
+            self.assertEqual(average[index].dtype, np.float32)
+        # Without any patch, the centers have the same weight
+        np.testing.assert_allclose(federated_average(self.weights, [0, 0, 0])[1],
+                                   np.mean([weights[1] for weights in self.weights], axis=0), rtol=1e-6)
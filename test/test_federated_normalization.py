@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from unet3d.data import add_data_to_storage, create_data_file, open_data_file
+from unet3d.normalize import normalize_data_storage, get_normalization
+from federated.normalization import (NormalizationServer, get_center_summary, get_harmonized_statistics,
+                                     get_histogram_percentiles, harmonize_data_storage, harmonize_centers,
+                                     harmonize_data_file)
+
+
+class TestFederatedNormalization(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.image_shape = (16, 8, 6)
+        random_state = np.random.RandomState(0)
+        # Each center has its own intensity range
+        self.data = [(random_state.rand(2, 2, *self.image_shape) * scale + shift).astype(np.float32)
+                     for scale, shift in ((100, 0), (3, 10), (50, -20))]
+        self.data_files = [self.write(os.path.join(self.directory, "center_" + str(center) + ".h5"), data)
+                           for center, data in enumerate(self.data)]
+
+    def tearDown(self):
+        for data_file in self.data_files:
+            data_file.close()
+        shutil.rmtree(self.directory)
+
+    def write(self, path, data):
+        data_file, data_storage, truth_storage, affine_storage = create_data_file(path, 2, len(data),
+                                                                                  self.image_shape,
+                                                                                  chunk_shape=(4, 8, 6))
+        for subject in data:
+            add_data_to_storage(data_storage, truth_storage, affine_storage,
+                                np.concatenate([subject, np.zeros((1,) + self.image_shape)]),
+                                affine=np.diag(np.ones(4)), n_channels=2, truth_dtype=np.uint8)
+        return data_file
+
+    def test_pooled_normalization(self):
+        # A local normalization is undone before the summary and the harmonization
+        normalize_data_storage(self.data_files[1].root.data)
+        server = NormalizationServer(os.path.join(self.directory, "server"))
+        for center in range(2):
+            server.publish(center, get_center_summary(self.data_files[center].root.data))
+        statistics = get_harmonized_statistics(server.aggregate())
+        for data_file in self.data_files[:2]:
+            harmonize_data_storage(data_file.root.data, statistics)
+        # Same result as the dataset normalization of the images of both centers
+        pooled = self.write(os.path.join(self.directory, "pooled.h5"), np.concatenate(self.data[:2]))
+        normalize_data_storage(pooled.root.data, mode="dataset")
+        np.testing.assert_allclose(np.concatenate([self.data_files[0].root.data[:], self.data_files[1].root.data[:]]),
+                                   pooled.root.data[:], atol=1e-5)
+        pooled.close()
+
+    def test_incremental_aggregation(self):
+        server = NormalizationServer(os.path.join(self.directory, "server"))
+        for center in range(2):
+            server.publish(center, get_center_summary(self.data_files[center].root.data))
+        server.aggregate()
+        summary_time = os.path.getmtime(server.get_summary_path(0))
+        server.publish(2, get_center_summary(self.data_files[2].root.data))
+        aggregate = server.aggregate()
+        self.assertEqual(sorted(aggregate["centers"]), ["0", "1", "2"])
+        self.assertEqual(os.path.getmtime(server.get_summary_path(0)), summary_time)
+        # The incremental aggregate matches the aggregation of all the summaries at once
+        os.remove(server.aggregate_path)
+        expected = server.aggregate()
+        for key in ("count", "mean", "std", "min", "max"):
+            np.testing.assert_allclose(aggregate["statistics"][key], expected["statistics"][key], rtol=1e-9)
+        np.testing.assert_allclose(aggregate["histogram"], expected["histogram"], atol=1e-6)
+        data = np.concatenate(self.data).astype(np.float64)
+        np.testing.assert_allclose(aggregate["statistics"]["std"], data.std(axis=(0, 2, 3, 4)), rtol=1e-6)
+        # The pooled histograms give the percentiles of the union of the centers up to a bin
+        percentiles = get_histogram_percentiles(aggregate, [10, 50, 90])
+        bin_sizes = np.diff(np.asarray(aggregate["range"]), axis=1) / len(aggregate["histogram"][0])
+        np.testing.assert_allclose(percentiles, np.percentile(data, [10, 50, 90], axis=(0, 2, 3, 4)).T,
+                                   atol=2 * bin_sizes.max())
+
+    def test_repeated_harmonization(self):
+        paths = [data_file.filename for data_file in self.data_files]
+        for data_file in self.data_files:
+            data_file.close()
+        server = NormalizationServer(os.path.join(self.directory, "server"))
+        statistics = harmonize_centers(server, {"0": paths[0], "1": paths[1]})
+        harmonized = open_data_file(paths[0])
+        expected = harmonized.root.data[:]
+        harmonized.close()
+        modification_times = [os.path.getmtime(path) for path in paths[:2]]
+        # The summaries are not computed again from the harmonized data: the data files are kept as they are
+        self.assertEqual(harmonize_centers(server, {"0": paths[0], "1": paths[1]}), statistics)
+        self.assertEqual([os.path.getmtime(path) for path in paths[:2]], modification_times)
+        # A data file that did not contribute to the statistics is normalized with them
+        harmonize_data_file(paths[2], statistics)
+        self.data_files = [open_data_file(path) for path in paths]
+        scale, offset = get_normalization(statistics)
+        np.testing.assert_allclose(self.data_files[2].root.data[:],
+                                   self.data[2] * scale[:, np.newaxis, np.newaxis, np.newaxis]
+                                   + offset[:, np.newaxis, np.newaxis, np.newaxis], rtol=1e-5, atol=1e-5)
+        np.testing.assert_array_equal(self.data_files[0].root.data[:], expected)
@@ -0,0 +1,55 @@
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from federated.sketch import FeatureSketch, TargetSketch, SketchCoupling, SketchChannel, kmeans
+
+
+class TestSketch(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        random_state = np.random.RandomState(0)
+        # Four groups of patches in each domain, the target groups are shifted
+        self.centers = random_state.rand(4, 32).astype(np.float32) * 10
+        self.source_groups = np.repeat(np.arange(4), [100, 100, 100, 100])
+        self.target_groups = np.repeat(np.arange(4), [200, 100, 50, 50])
+        self.source = self.centers[self.source_groups] + random_state.randn(400, 32).astype(np.float32) * 0.1
+        self.target = self.centers[self.target_groups] + 0.5 + random_state.randn(400, 32).astype(np.float32) * 0.1
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_kmeans(self):
+        centroids, assignment = kmeans(self.target, 4, random_state=np.random.RandomState(1))
+        self.assertEqual(len(centroids), 4)
+        for group in range(4):
+            self.assertEqual(len(np.unique(assignment[self.target_groups == group])), 1)
+        np.testing.assert_allclose(centroids[assignment[0]], self.target[self.target_groups == 0].mean(axis=0),
+                                   rtol=1e-5)
+
+    def test_channel(self):
+        target_sketch = TargetSketch(self.target, size=8, projection_dim=16, seed=3)
+        channel = SketchChannel(self.directory)
+        n_bytes = channel.send("target", target_sketch.sketch, codec="float16")
+        self.assertLess(n_bytes, self.target.nbytes / 20)
+        sketch = channel.receive("target", timeout=0)
+        np.testing.assert_allclose(sketch.centroids, target_sketch.sketch.centroids, rtol=1e-3, atol=1e-2)
+        np.testing.assert_allclose(sketch.weights, target_sketch.sketch.weights, rtol=1e-6)
+        self.assertEqual((sketch.projection_dim, sketch.seed), (16, 3))
+        with self.assertRaises(TimeoutError):
+            channel.receive("source", timeout=0)
+
+    def test_coupling(self):
+        target_sketch = TargetSketch(self.target, size=4, projection_dim=16, seed=0)
+        sketch = FeatureSketch.from_bytes(target_sketch.sketch.to_bytes())
+        coupling = SketchCoupling(self.source, sketch, target_sketch.sample_members)
+        np.testing.assert_allclose(coupling.plan.sum(axis=1), 1. / 400)
+        np.testing.assert_allclose(coupling.plan.sum(axis=0), sketch.weights)
+        targets = coupling.sample_targets(np.arange(400), np.random.RandomState(0))
+        self.assertEqual(targets.shape, (400,))
+        # The mass of the target group 0 is larger than the source group 0: part of it goes to other source groups,
+        # but the source patches of the small target groups are coupled with them
+        for group in (2, 3):
+            self.assertGreater(np.mean(self.target_groups[targets[self.source_groups == group]] == group), 0.45)
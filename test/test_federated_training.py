@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import multiprocessing
+from types import SimpleNamespace
+from unittest import TestCase
+
+import numpy as np
+
+from federated.transport import DeltaEncoder, deserialize, load_payload, save_payload
+
+
+def import_training(test_case):
+    """
+    federated.training imports the Keras 2.2 training code: the tests using it are skipped when it cannot be imported.
+    """
+    try:
+        from federated import training
+    except (ImportError, AttributeError) as error:
+        test_case.skipTest("federated.training cannot be imported: " + str(error))
+    return training
+
+
+def square(value):
+    return value ** 2
+
+
+def train_center(task):
+    '''
+    Stand-in for the local training of a center: it starts its own workers, like the data loading of JDOT, and adds 1
+    to the global weights.
+    '''
+    config, global_file, update_file, first_round = task
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        pool.map(square, range(2))
+    global_weights = deserialize(load_payload(global_file))
+    weights = [array + 1 for array in global_weights]
+    n_bytes = save_payload(update_file, DeltaEncoder("none").encode(weights, global_weights))
+    return {"update_file": update_file, "bytes": n_bytes, "n_patches": 10, "dice": [0.5, np.nan, np.nan],
+            "seconds": 0.}
+
+
+class TestFederatedTraining(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round(self):
+        training = import_training(self)
+        config = SimpleNamespace(federated_dir=self.directory, federated_codec="none", federated_topk=0.01,
+                                 federated_centers=["01", "07"], federated_processes=2, federated_rounds=1,
+                                 data_set="miccai16", target_center=["08"])
+        coordinator = training.FederatedTraining(config)
+        weights = [np.zeros((3, 2), dtype=np.float32), np.arange(4, dtype=np.float32)]
+        new_weights = coordinator.train_round(0, weights, train_function=train_center)
+        for array, new_array in zip(weights, new_weights):
+            np.testing.assert_allclose(new_array, array + 1)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "round_0", "center_07.bin")))
+        center_config = coordinator.get_center_config("07")
+        self.assertTrue(center_config.source_data_file.endswith("miccai16_data_center_07.h5"))
+        self.assertTrue(center_config.target_data_file.endswith("miccai16_data_center_08.h5"))
+
+    def test_failed_center(self):
+        training = import_training(self)
+        with self.assertRaises(RuntimeError):
+            training.run_in_processes(square, [1, "a"], 2)
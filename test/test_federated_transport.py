@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from federated.transport import (CODECS, DeltaEncoder, serialize, deserialize, apply_delta, save_weights,
+                                 load_weights)
+
+
+class TestTransport(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        random_state = np.random.RandomState(0)
+        self.weights = [random_state.randn(3, 3, 3, 2, 8).astype(np.float32), random_state.randn(8).astype(np.float32),
+                        np.zeros((1, 1), dtype=np.float32)]
+        self.updates = [[(random_state.randn(*array.shape) * 0.01).astype(np.float32) for array in self.weights]
+                        for _ in range(30)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_serialization(self):
+        for codec, tolerance in (("none", 0), ("float16", 2e-3), ("int8", 2e-2)):
+            for expected, array in zip(self.weights, deserialize(serialize(self.weights, codec=codec))):
+                self.assertEqual(array.shape, expected.shape)
+                self.assertEqual(array.dtype, np.float32)
+                np.testing.assert_allclose(array, expected, atol=tolerance * np.abs(expected).max())
+        # Only the largest values are sent, in 8 bytes each
+        payload = serialize(self.weights, codec="topk", fraction=0.1)
+        decoded = deserialize(payload)
+        self.assertEqual(np.count_nonzero(decoded[0]), 44)
+        self.assertEqual(np.min(np.abs(decoded[0][decoded[0] != 0])),
+                         np.sort(np.abs(self.weights[0]).ravel())[-44])
+        self.assertLess(len(payload), len(serialize(self.weights)) / 4)
+        with self.assertRaises(ValueError):
+            serialize(self.weights, codec="unknown")
+        with self.assertRaises(ValueError):
+            deserialize(b"NOPE" + payload[4:])
+
+    def test_error_feedback(self):
+        # A sender sends its updates from the weights held by the receiver
+        errors = dict()
+        for error_feedback in (True, False):
+            encoder = DeltaEncoder("topk", fraction=0.2, error_feedback=error_feedback)
+            held, weights = self.weights, self.weights
+            for updates in self.updates:
+                weights = [array + update for array, update in zip(weights, updates)]
+                held = apply_delta(held, deserialize(encoder.encode([array + update for array, update
+                                                                     in zip(held, updates)], held)))
+            errors[error_feedback] = np.sqrt(sum(np.sum(np.square(a - b)) for a, b in zip(held, weights)))
+        self.assertLess(errors[True], errors[False] / 2)
+        # The weights held by the receiver plus what was not sent yet are the weights of the sender
+        for codec in CODECS:
+            encoder = DeltaEncoder(codec, fraction=0.2)
+            held = apply_delta(self.weights, deserialize(encoder.encode(weights, self.weights)))
+            for expected, array, residual in zip(weights, held, encoder.residual):
+                np.testing.assert_allclose(array + residual, expected, atol=1e-5)
+
+    def test_weights_file(self):
+        path = os.path.join(self.directory, "global.npz")
+        n_bytes = save_weights(path, self.weights)
+        self.assertEqual(n_bytes, os.path.getsize(path))
+        for expected, array in zip(self.weights, load_weights(path)):
+            np.testing.assert_array_equal(array, expected)
@@ -0,0 +1,46 @@
+from unittest import TestCase
+
+import numpy as np
+import ot
+from scipy import sparse
+
+from patches_comparaison.global_coupling import GlobalCoupling, get_nearest_neighbours, keep_top_k, pool_patches
+
+
+class TestGlobalCoupling(TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.source = random_state.rand(60, 6).astype(np.float32)
+        self.target = (random_state.rand(80, 6) + 0.3).astype(np.float32)
+
+    def test_nearest_neighbours(self):
+        indices, distances = get_nearest_neighbours(self.source, self.target, 5, block_size=16)
+        expected = np.argsort(ot.dist(self.source, self.target), axis=1)[:, :5]
+        self.assertTrue(np.array_equal(indices, expected))
+        self.assertTrue(np.all(np.diff(distances, axis=1) >= 0))
+
+    def test_full_support_matches_sinkhorn(self):
+        coupling = GlobalCoupling(self.source, self.target, k=80, reg=0.05, n_iter=2000, stop_threshold=1e-9,
+                                  block_size=16)
+        cost = ot.dist(self.source, self.target)
+        expected = ot.sinkhorn(ot.unif(60), ot.unif(80), cost / cost.max(), 0.05, numItermax=2000)
+        self.assertTrue(np.allclose(coupling.plan.toarray(), expected, atol=1e-7))
+
+    def test_sparse_plan(self):
+        coupling = GlobalCoupling(self.source, self.target, k=4, block_size=16)
+        self.assertTrue(np.all(np.diff(coupling.plan.indptr) <= 4))
+        targets = coupling.sample_targets(np.arange(60), np.random.RandomState(0))
+        for source, target in enumerate(targets):
+            self.assertGreater(coupling.plan[source, target], 0)
+
+    def test_keep_top_k(self):
+        plan = np.random.rand(5, 7)
+        kept = keep_top_k(sparse.csr_matrix(plan), 2).toarray()
+        for row, kept_row in zip(plan, kept):
+            self.assertEqual(set(np.nonzero(kept_row)[0]), set(np.argsort(row)[-2:]))
+
+    def test_pool_patches(self):
+        patches = np.random.rand(3, 2, 8, 8, 8)
+        embeddings = pool_patches(patches)
+        self.assertEqual(embeddings.shape, (3, 2 * 64))
+        self.assertAlmostEqual(embeddings[1, 0], patches[1, 0, :2, :2, :2].mean(), places=5)
@@ -0,0 +1,94 @@
+import os
+import shutil
+from unittest import TestCase
+
+import numpy as np
+
+from unet3d.data import add_data_to_storage, create_data_file, open_data_file
+from patches_comparaison.generator_jdot import batch_augment_data, create_patch_index_list, get_data_from_file
+from patches_comparaison.patch_cache import PatchCache
+from patches_comparaison.patch_loader import PatchLoader
+
+
+class TestJDOTGenerator(TestCase):
+    def setUp(self):
+        self.data_file_path = os.path.abspath("./temporary_jdot_data_test_file.h5")
+        self.cache_path = os.path.abspath("./temporary_jdot_patch_cache")
+        self.n_samples = 3
+        self.n_channels = 2
+        self.image_shape = (12, 10, 9)
+        self.patch_shape = (4, 4, 4)
+        data = np.random.rand(self.n_samples, self.n_channels, *self.image_shape).astype(np.float32)
+        truth = (data[:, :1] > 0.8).astype(np.uint8)
+        affine = np.diag(np.ones(4))
+        self.data_file, data_storage, truth_storage, affine_storage = create_data_file(self.data_file_path,
+                                                                                       self.n_channels,
+                                                                                       self.n_samples,
+                                                                                       self.image_shape)
+        for index in range(self.n_samples):
+            add_data_to_storage(data_storage, truth_storage, affine_storage,
+                                np.concatenate([data[index], truth[index]], axis=0), affine=affine * (index + 1),
+                                n_channels=self.n_channels, truth_dtype=np.uint8)
+        # reopened read-only, as during training, so that other processes can read it
+        self.data_file.close()
+        self.data_file = open_data_file(self.data_file_path)
+        self.index_list = create_patch_index_list([2, 0], self.image_shape, self.patch_shape, patch_overlap=1)
+
+    def tearDown(self):
+        self.data_file.close()
+        os.remove(self.data_file_path)
+        if os.path.exists(self.cache_path):
+            shutil.rmtree(self.cache_path)
+
+    def test_patch_cache(self):
+        cache = PatchCache(self.cache_path, self.data_file, self.index_list, self.patch_shape, patch_overlap=1)
+        selected = [self.index_list[i] for i in (5, 0, len(self.index_list) - 1)]
+        x, y, affine_list = cache.get_patches(cache.get_positions(selected))
+        for i, index in enumerate(selected):
+            data, truth = get_data_from_file(self.data_file, index, patch_shape=self.patch_shape)
+            self.assertTrue(np.array_equal(x[i], data))
+            self.assertTrue(np.array_equal(y[i, 0], truth))
+            self.assertTrue(np.array_equal(affine_list[i], self.data_file.root.affine[index[0]]))
+
+    def test_patch_cache_invalidation(self):
+        cache = PatchCache(self.cache_path, self.data_file, self.index_list, self.patch_shape, patch_overlap=1)
+        reused = PatchCache(self.cache_path, self.data_file, self.index_list, self.patch_shape, patch_overlap=1)
+        self.assertEqual(cache.key, reused.key)
+        changed = PatchCache(self.cache_path, self.data_file, self.index_list[:4], self.patch_shape, patch_overlap=1,
+                             selection="skip_blank")
+        self.assertNotEqual(cache.key, changed.key)
+        self.assertEqual(changed.data.shape[0], 4)
+
+    def test_patch_loader(self):
+        loader = PatchLoader({"source": self.data_file_path}, self.n_channels, self.patch_shape, max_batch_size=4,
+                             number_of_threads=2)
+        try:
+            x, y, affine_list = loader.load("source", self.index_list[:10])
+            augmented_x, augmented_y = loader.augment((x, y), affine_list, self.index_list[:10], augment=True,
+                                                      augment_flip=True, permute=True)
+        finally:
+            loader.close()
+        self.assertEqual(x.shape, (10, self.n_channels) + self.patch_shape)
+        self.assertEqual(augmented_x.shape, x.shape)
+        for i, index in enumerate(self.index_list[:10]):
+            data, truth = get_data_from_file(self.data_file, index, patch_shape=self.patch_shape)
+            self.assertTrue(np.array_equal(x[i], data))
+            self.assertTrue(np.array_equal(y[i, 0], truth))
+            self.assertTrue(np.array_equal(affine_list[i], self.data_file.root.affine[index[0]]))
+            self.assertAlmostEqual(np.sum(augmented_x[i]), np.sum(data), places=2)
+
+    def test_batch_augment_skip_blank(self):
+        np.random.seed(0)
+        x = np.random.rand(6, self.n_channels, *self.patch_shape).astype(np.float32)
+        y = np.zeros((6, 1) + self.patch_shape, dtype=np.uint8)
+        # The lesions are single voxels in a corner, the scaling moves them out of the patches
+        y[:, 0, 0, 0, 0] = 1
+        y[3] = 0
+        augmented_x, augmented_y = batch_augment_data((x, y), [np.diag(np.ones(4))] * 6, augment=True,
+                                                      augment_distortion_factor=0.3, skip_blank=True)
+        # The batch keeps its size, the patches made blank are replaced by the patches before augmentation
+        self.assertEqual(augmented_x.shape, x.shape)
+        self.assertEqual(augmented_y.shape, y.shape)
+        blank = ~np.any(augmented_y.reshape(6, -1) != 0, axis=1)
+        self.assertEqual(list(np.flatnonzero(blank)), [3])
+        self.assertTrue(np.any(np.all(augmented_x == x, axis=(1, 2, 3, 4))[np.arange(6) != 3]))
@@ -0,0 +1,66 @@
+import os
+from unittest import TestCase
+
+import numpy as np
+
+from unet3d.data import add_data_to_storage, create_data_file
+from unet3d.normalize import ChannelMoments, normalize_data, normalize_data_storage, get_normalization_parameters
+
+
+class TestNormalizeDataStorage(TestCase):
+    def setUp(self):
+        self.data_file_path = os.path.abspath("./temporary_normalize_test_file.h5")
+        self.image_shape = (40, 12, 10)
+        random_state = np.random.RandomState(0)
+        # The channels and the subjects have different intensity ranges
+        self.data = (random_state.rand(4, 2, *self.image_shape) * np.asarray([[100], [3]])[:, :, np.newaxis, np.newaxis]
+                     + np.arange(4)[:, np.newaxis, np.newaxis, np.newaxis, np.newaxis] * 10).astype(np.float32)
+        self.data_file, self.data_storage, truth_storage, affine_storage = create_data_file(
+            self.data_file_path, 2, len(self.data), self.image_shape, chunk_shape=(8, 12, 10))
+        for data in self.data:
+            add_data_to_storage(self.data_storage, truth_storage, affine_storage,
+                                np.concatenate([data, np.zeros((1,) + self.image_shape)]), affine=np.diag(np.ones(4)),
+                                n_channels=2, truth_dtype=np.uint8)
+
+    def tearDown(self):
+        self.data_file.close()
+        os.remove(self.data_file_path)
+
+    def test_channel_moments(self):
+        moments = ChannelMoments(2)
+        for start in range(0, 40, 7):
+            moments.update(self.data[0][:, start:start + 7])
+        np.testing.assert_allclose(moments.mean, self.data[0].mean(axis=(1, 2, 3)), rtol=1e-6)
+        np.testing.assert_allclose(moments.std, self.data[0].std(axis=(1, 2, 3), dtype=np.float64), rtol=1e-6)
+        np.testing.assert_array_equal(moments.min, self.data[0].min(axis=(1, 2, 3)))
+        np.testing.assert_array_equal(moments.max, self.data[0].max(axis=(1, 2, 3)))
+
+    def test_subject_normalization(self):
+        normalize_data_storage(self.data_storage)
+        for index, data in enumerate(self.data):
+            data = data.copy()
+            expected = normalize_data(data, data.mean(axis=(1, 2, 3)), data.std(axis=(1, 2, 3)))
+            np.testing.assert_allclose(self.data_storage[index], expected, atol=1e-5)
+        parameters = get_normalization_parameters(self.data_storage)
+        self.assertEqual(parameters["mode"], "subject")
+        self.assertEqual(parameters["scale"].shape, (4, 2))
+
+    def test_dataset_and_center_normalization(self):
+        normalize_data_storage(self.data_storage, mode="center", groups=["01", "01", "07", "07"])
+        self.assertEqual(sorted(get_normalization_parameters(self.data_storage)["statistics"]), ["01", "07"])
+        for center, indices in (("01", slice(0, 2)), ("07", slice(2, 4))):
+            data = self.data[indices].astype(np.float64)
+            mean, std = data.mean(axis=(0, 2, 3, 4)), data.std(axis=(0, 2, 3, 4))
+            normalized = (data - mean[:, np.newaxis, np.newaxis, np.newaxis]) / std[:, np.newaxis, np.newaxis,
+                                                                                     np.newaxis]
+            expected = (normalized - normalized.min()) / (normalized.max() - normalized.min())
+            np.testing.assert_allclose(self.data_storage[indices], expected, atol=1e-5)
+        with self.assertRaises(ValueError):
+            normalize_data_storage(self.data_storage, mode="center")
+
+    def test_dataset_normalization(self):
+        normalize_data_storage(self.data_storage, mode="dataset")
+        normalized = np.asarray(self.data_storage[:])
+        self.assertAlmostEqual(normalized.min(), 0, places=5)
+        self.assertAlmostEqual(normalized.max(), 1, places=5)
+        self.assertEqual(list(get_normalization_parameters(self.data_storage)["statistics"]), ["dataset"])
@@ -0,0 +1,44 @@
+from unittest import TestCase
+
+import numpy as np
+import ot
+
+from patches_comparaison.ot_solver import OTSolver, OT_SOLVERS
+
+
+class TestOTSolver(TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.source = random_state.rand(32, 8)
+        self.target = random_state.rand(32, 8) + 0.5
+        self.cost = ot.dist(self.source, self.target)
+
+    def test_emd(self):
+        gamma = OTSolver("emd").solve(self.cost)
+        self.assertTrue(np.allclose(gamma, ot.emd(ot.unif(32), ot.unif(32), self.cost)))
+
+    def test_marginals(self):
+        for method in ("sinkhorn", "sinkhorn_log", "sinkhorn_stabilized"):
+            for float32 in (False, True):
+                gamma = OTSolver(method, reg=0.05, float32=float32).solve(self.cost)
+                self.assertEqual(gamma.dtype, np.float32 if float32 else np.float64)
+                self.assertTrue(np.allclose(gamma.sum(axis=0), ot.unif(32), atol=1e-4), method)
+                self.assertTrue(np.allclose(gamma.sum(axis=1), ot.unif(32), atol=1e-4), method)
+
+    def test_unbalanced(self):
+        gamma = OTSolver("sinkhorn_unbalanced", reg=0.05, reg_m=1.).solve(self.cost)
+        self.assertEqual(gamma.shape, (32, 32))
+        self.assertTrue(np.all(gamma >= 0))
+
+    def test_warm_start(self):
+        for method in OT_SOLVERS[1:]:
+            solver = OTSolver(method, reg=0.01, warm_start=True)
+            gamma = solver.solve(self.cost)
+            cold_iterations = solver.n_iterations
+            warm_gamma = solver.solve(self.cost)
+            self.assertLess(solver.n_iterations, cold_iterations, method)
+            self.assertTrue(np.allclose(gamma, warm_gamma, atol=1e-4), method)
+
+    def test_unknown_solver(self):
+        with self.assertRaises(ValueError):
+            OTSolver("exact")
@@ -0,0 +1,117 @@
+import os
+from unittest import TestCase
+
+import numpy as np
+
+from unet3d.data import add_data_to_storage, create_data_file, open_data_file
+from unet3d.generator import get_data_from_file, create_patch_index_list
+from unet3d.utils.patches import get_patch_from_3d_data
+from unet3d.utils.patch_statistics import (PatchIndex, VolumeIndex, compute_patch_statistics, get_patch_levels,
+                                           select_patches_with_ground_truth, select_patches_with_intensity_ceil)
+
+
+class TestPatchStatistics(TestCase):
+    def setUp(self):
+        self.data_file_path = os.path.abspath("./temporary_patch_statistics_test_file.h5")
+        self.index_path = os.path.abspath("./temporary_patch_statistics_test_file_patch_index.h5")
+        n_samples, self.n_channels = 3, 2
+        self.image_shape = (14, 11, 9)
+        self.patch_shape = (4, 5, 4)
+        random_state = np.random.RandomState(0)
+        data = random_state.rand(n_samples, self.n_channels, *self.image_shape).astype(np.float32)
+        data[:, :, :3] = 0
+        truth = (data[:, :1] > 0.95).astype(np.uint8)
+        data_file, data_storage, truth_storage, affine_storage = create_data_file(self.data_file_path,
+                                                                                  self.n_channels, n_samples,
+                                                                                  self.image_shape)
+        for index in range(n_samples):
+            add_data_to_storage(data_storage, truth_storage, affine_storage,
+                                np.concatenate([data[index], truth[index]], axis=0), affine=np.diag(np.ones(4)),
+                                n_channels=self.n_channels, truth_dtype=np.uint8)
+        data_file.close()
+        self.data_file = open_data_file(self.data_file_path)
+        # The overlap makes the first and last patches go out of the image
+        self.index_list = create_patch_index_list([2, 0, 1], self.image_shape, self.patch_shape, patch_overlap=2)
+
+    def tearDown(self):
+        self.data_file.close()
+        os.remove(self.data_file_path)
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+
+    def test_statistics(self):
+        statistics = compute_patch_statistics(self.data_file, self.index_list, self.patch_shape)
+        self.assertEqual(len(statistics), len(self.index_list))
+        for row, index in zip(statistics, self.index_list):
+            data, truth = get_data_from_file(self.data_file, index, patch_shape=self.patch_shape)
+            self.assertEqual(row["lesion_count"], np.count_nonzero(truth))
+            np.testing.assert_allclose(row["mean"], data.reshape(self.n_channels, -1).mean(axis=1), rtol=1e-5,
+                                       atol=1e-6)
+            np.testing.assert_array_equal(row["max"], data.reshape(self.n_channels, -1).max(axis=1))
+            self.assertAlmostEqual(row["foreground_fraction"], np.mean(data[0] > 0), places=6)
+
+    def test_selection(self):
+        statistics = compute_patch_statistics(self.data_file, self.index_list, self.patch_shape)
+        with_truth, above_ceil = [], []
+        for index in self.index_list:
+            data, truth = get_data_from_file(self.data_file, index, patch_shape=self.patch_shape)
+            if np.mean(truth) != 0:
+                with_truth.append(index)
+            if np.max(data[0]) > 0.5:
+                above_ceil.append(index)
+        self.assertEqual(select_patches_with_ground_truth(self.index_list, statistics), with_truth)
+        self.assertEqual(select_patches_with_intensity_ceil(self.index_list, statistics, 0.5), above_ceil)
+
+    def test_patch_index(self):
+        patch_index = PatchIndex(self.data_file)
+        self.assertEqual(patch_index.path, self.index_path)
+        expected = compute_patch_statistics(self.data_file, self.index_list, self.patch_shape)
+        statistics = compute_patch_statistics(self.data_file, self.index_list, self.patch_shape, patch_index)
+        np.testing.assert_array_equal(statistics["lesion_count"], expected["lesion_count"])
+        np.testing.assert_array_equal(statistics["max"], expected["max"])
+        np.testing.assert_allclose(statistics["mean"], expected["mean"], rtol=1e-6)
+        patch_index.close()
+        # The index is reused, then rebuilt when the data file changes
+        modification_time = os.path.getmtime(self.index_path)
+        PatchIndex(self.data_file).close()
+        self.assertEqual(os.path.getmtime(self.index_path), modification_time)
+        PatchIndex(self.data_file, max_level=2).close()
+        self.assertNotEqual(os.path.getmtime(self.index_path), modification_time)
+        # With a patch shape, a single level of the sparse table is stored
+        patch_index = PatchIndex(self.data_file, patch_shape=self.patch_shape)
+        statistics = compute_patch_statistics(self.data_file, self.index_list, self.patch_shape, patch_index)
+        self.assertEqual(patch_index.get_volume_index(0).maxima.shape[0], 1)
+        np.testing.assert_array_equal(statistics["max"], expected["max"])
+        patch_index.close()
+
+    def test_box_queries(self):
+        random_state = np.random.RandomState(1)
+        data = random_state.rand(2, *self.image_shape).astype(np.float32)
+        truth = (random_state.rand(*self.image_shape) > 0.9).astype(np.uint8)
+        for max_level in (0, 1, 3):
+            volume_index = VolumeIndex.from_volume(data, truth, max_level=max_level)
+            for patch_shape in [(1, 1, 1), (3, 7, 2), (8, 8, 8), (14, 11, 9)]:
+                corners = np.stack([random_state.randint(-2, size - 1, 20) for size in self.image_shape], axis=1)
+                sums = volume_index.sums(corners, patch_shape)
+                maxima = volume_index.maxima_of_boxes(corners, patch_shape)
+                for corner, box_sums, box_maxima in zip(corners, sums, maxima):
+                    box = get_patch_from_3d_data(data, patch_shape, corner.copy())
+                    box_truth = get_patch_from_3d_data(truth, patch_shape, corner.copy())
+                    np.testing.assert_allclose(box_sums[:2], box.reshape(2, -1).sum(axis=1), rtol=1e-6)
+                    self.assertEqual(round(box_sums[2]), np.count_nonzero(box_truth))
+                    np.testing.assert_array_equal(box_maxima, box.reshape(2, -1).max(axis=1))
+
+    def test_patch_levels(self):
+        random_state = np.random.RandomState(2)
+        data = random_state.rand(2, *self.image_shape).astype(np.float32)
+        truth = (random_state.rand(*self.image_shape) > 0.9).astype(np.uint8)
+        for patch_shape in [(1, 1, 1), (3, 7, 2), (8, 8, 8), (5, 16, 12), (14, 11, 9)]:
+            volume_index = VolumeIndex.from_volume(data, truth, levels=get_patch_levels(patch_shape))
+            # The boxes clipped by the image use the same level
+            corners = np.stack([random_state.randint(-size, size + 2, 20) for size in self.image_shape], axis=1)
+            maxima = volume_index.maxima_of_boxes(corners, patch_shape)
+            for corner, box_maxima in zip(corners, maxima):
+                box = get_patch_from_3d_data(data, patch_shape, corner.copy())
+                np.testing.assert_array_equal(box_maxima, box.reshape(2, -1).max(axis=1))
+        with self.assertRaises(ValueError):
+            volume_index.maxima_of_boxes([[3, 3, 3]], (4, 4, 4))
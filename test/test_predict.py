@@ -3,7 +3,56 @@ import numpy as np
 
 from unittest import TestCase
 
-from unet3d.utils.patches import compute_patch_indices, get_patch_from_3d_data, reconstruct_from_patches
+from unet3d.utils.patches import (PatchAccumulator, compute_patch_indices, get_patch_from_3d_data,
+                                  get_patches_from_padded_data, pad_data_for_patches, reconstruct_from_patches)
+
+
+def import_prediction(test_case):
+    """
+    unet3d.prediction imports the Keras 2.2 training code: the tests using it are skipped when it cannot be imported.
+    """
+    try:
+        from unet3d import prediction
+    except (ImportError, AttributeError) as error:
+        test_case.skipTest("unet3d.prediction cannot be imported: " + str(error))
+    return prediction
+
+
+def masked_reconstruct_from_patches(patches, patch_indices, data_shape, default_value=0):
+    """
+    Previous implementation of reconstruct_from_patches, with a full volume mask and copy per patch.
+    """
+    data = np.ones(data_shape) * default_value
+    image_shape = data_shape[-3:]
+    count = np.zeros(data_shape, dtype=int)
+    for patch, index in zip(patches, patch_indices):
+        index = np.copy(index)
+        image_patch_shape = patch.shape[-3:]
+        if np.any(index < 0):
+            fix_patch = np.asarray((index < 0) * np.abs(index), dtype=int)
+            patch = patch[..., fix_patch[0]:, fix_patch[1]:, fix_patch[2]:]
+            index[index < 0] = 0
+        if np.any((index + image_patch_shape) >= image_shape):
+            fix_patch = np.asarray(image_patch_shape - (((index + image_patch_shape) >= image_shape)
+                                                        * ((index + image_patch_shape) - image_shape)), dtype=int)
+            patch = patch[..., :fix_patch[0], :fix_patch[1], :fix_patch[2]]
+        patch_index = np.zeros(data_shape, dtype=bool)
+        patch_index[...,
+                    index[0]:index[0]+patch.shape[-3],
+                    index[1]:index[1]+patch.shape[-2],
+                    index[2]:index[2]+patch.shape[-1]] = True
+        patch_data = np.zeros(data_shape)
+        patch_data[patch_index] = patch.flatten()
+
+        new_data_index = np.logical_and(patch_index, np.logical_not(count > 0))
+        data[new_data_index] = patch_data[new_data_index]
+
+        averaged_data_index = np.logical_and(patch_index, count > 0)
+        if np.any(averaged_data_index):
+            data[averaged_data_index] = (data[averaged_data_index] * count[averaged_data_index]
+                                         + patch_data[averaged_data_index]) / (count[averaged_data_index] + 1)
+        count[patch_index] += 1
+    return data
 
 
 class TestPrediction(TestCase):
@@ -66,3 +115,148 @@ class TestPrediction(TestCase):
         # noinspection PyTypeChecker
         self.assertTrue(np.all(data == reconstruced_data))
 
+
+    def test_reconstruct_matches_masked_reconstruction(self):
+        image_shape = (30, 27, 33)
+        data = np.random.rand(2, *image_shape)
+        patch_shape = (8, 8, 8)
+        patch_indices = compute_patch_indices(image_shape, patch_shape, 3)
+        patches = [get_patch_from_3d_data(data, patch_shape, index) + np.random.rand(*patch_shape)
+                   for index in patch_indices]
+        expected = masked_reconstruct_from_patches(patches, patch_indices, data.shape)
+        reconstruced_data = reconstruct_from_patches(patches, patch_indices, data.shape)
+        self.assertTrue(np.array_equal(expected, reconstruced_data))
+
+    def test_reconstruct_with_blending(self):
+        image_shape = (40, 40, 40)
+        data = np.random.rand(*image_shape)
+        patch_shape = (16, 16, 16)
+        patch_indices = compute_patch_indices(image_shape, patch_shape, 8)
+        patches = [get_patch_from_3d_data(data, patch_shape, index) for index in patch_indices]
+        for blending in ("gaussian", "cosine"):
+            reconstruced_data = reconstruct_from_patches(patches, patch_indices, image_shape, blending=blending)
+            self.assertTrue(np.allclose(data, reconstruced_data))
+
+    def test_streamed_reconstruction(self):
+        # The padding, batching and accumulation of patch_wise_prediction, without the model
+        data = np.random.rand(2, 20, 18, 23)
+        patch_shape = (8, 8, 8)
+        for overlap, blending in ((0, None), (4, None), (4, "gaussian")):
+            patch_indices = compute_patch_indices(data.shape[-3:], patch_shape, overlap)
+            patches = [get_patch_from_3d_data(data, patch_shape, index) for index in patch_indices]
+            expected = reconstruct_from_patches(patches, patch_indices, data.shape, blending=blending)
+            padded_data, offset = pad_data_for_patches(data, patch_shape, patch_indices)
+            accumulator = PatchAccumulator(data.shape, patch_shape=patch_shape, blending=blending)
+            for start in range(0, len(patch_indices), 7):
+                batch_indices = patch_indices[start:start + 7]
+                batch = get_patches_from_padded_data(padded_data, patch_shape, batch_indices + offset)
+                self.assertTrue(np.array_equal(batch, np.asarray(patches[start:start + 7])))
+                accumulator.add_patches(batch, batch_indices)
+            self.assertTrue(np.allclose(expected, accumulator.get_data()))
+
+    def test_patch_wise_prediction(self):
+        patch_wise_prediction = import_prediction(self).patch_wise_prediction
+        model = FakeModel(input_shape=(None, 2, 8, 8, 8), output_shape=(None, 1, 8, 8, 8))
+        data = np.random.rand(1, 2, 20, 18, 23)
+        for overlap in (0, 4):
+            patch_indices = compute_patch_indices(data.shape[-3:], (8, 8, 8), overlap)
+            patches = [model.predict(get_patch_from_3d_data(data[0], (8, 8, 8), index)[np.newaxis])[0]
+                       for index in patch_indices]
+            expected = reconstruct_from_patches(patches, patch_indices, (1,) + data.shape[-3:])
+            prediction = patch_wise_prediction(model, data, overlap=overlap, batch_size=7)
+            self.assertTrue(np.array_equal(expected, prediction))
+
+
+    def test_predict_with_permutations(self):
+        from unet3d.augment import generate_permutation_keys, permute_data, reverse_permute_data
+        predict = import_prediction(self).predict
+        data = np.random.rand(3, 2, 6, 6, 6)
+        # Summing the channels does not depend on the orientation of the patch
+        model = FakeModel(input_shape=(None, 2, 6, 6, 6), output_shape=(None, 1, 6, 6, 6))
+        self.assertTrue(np.allclose(predict(model, data, permute=True), model.predict(data)))
+        model = WeightedModel(input_shape=(None, 2, 6, 6, 6), output_shape=(None, 1, 6, 6, 6))
+        for permute, n_keys in (("flip", 8), (True, 48), ("all", 48)):
+            keys = [key for key in generate_permutation_keys() if permute != "flip" or key[0] == (0, 0) and not key[4]]
+            self.assertEqual(len(keys), n_keys)
+            expected = np.mean([[reverse_permute_data(model.predict(permute_data(sample, key)[np.newaxis])[0], key)
+                                 for sample in data] for key in keys], axis=0)
+            for max_samples in (None, 7):
+                self.assertTrue(np.allclose(predict(model, data, permute=permute, max_samples=max_samples), expected))
+        with self.assertRaises(ValueError):
+            predict(model, data, permute="rotations")
+
+
+    def test_predict_subjects(self):
+        module = import_prediction(self)
+        patch_wise_prediction, predict_subjects = module.patch_wise_prediction, module.predict_subjects
+        model = CountingModel(input_shape=(None, 2, 8, 8, 8), output_shape=(None, 1, 8, 8, 8))
+        subjects = [("a", np.random.rand(2, 20, 18, 23)), ("b", np.random.rand(2, 8, 8, 8)),
+                    ("c", np.random.rand(2, 9, 17, 12))]
+        read = []
+
+        def read_subjects():
+            for key, data in subjects:
+                read.append(key)
+                yield key, data
+
+        predictions = predict_subjects(model, read_subjects(), batch_size=16, overlap=2)
+        key, prediction = next(predictions)
+        # The first subject is returned before the last one is read
+        self.assertEqual(key, "a")
+        self.assertNotIn("c", read)
+        predictions = [(key, prediction)] + list(predictions)
+        self.assertEqual([key for key, _ in predictions], ["a", "b", "c"])
+        for (_, data), (_, prediction) in zip(subjects, predictions):
+            expected = patch_wise_prediction(FakeModel(model.input.shape, model.output.shape), data[np.newaxis],
+                                             overlap=2, batch_size=3)
+            self.assertTrue(np.allclose(expected, prediction))
+        # All the batches but the last one are full
+        self.assertTrue(all([size == 16 for size in model.batch_sizes[:-1]]))
+
+    def test_prediction_batch_size(self):
+        get_prediction_batch_size = import_prediction(self).get_prediction_batch_size
+        model = FakeModel(input_shape=(None, 2, 8, 8, 8), output_shape=(None, 1, 8, 8, 8))
+        model.layers = [FakeLayer((None, 2, 8, 8, 8)), FakeLayer((None, 4, 8, 8, 8)), FakeLayer((None, 1, 8, 8, 8))]
+        self.assertEqual(get_prediction_batch_size(model, memory_budget=4 * 7 * 512 * 10), 10)
+        self.assertEqual(get_prediction_batch_size(model, memory_budget=4 * 7 * 512 * 80, permute="flip"), 10)
+        self.assertEqual(get_prediction_batch_size(model, memory_budget=1), 1)
+
+
+class FakeModel(object):
+    """
+    Stands in for a keras model: the prediction is the sum of the input channels.
+    """
+    def __init__(self, input_shape, output_shape):
+        self.input = FakeTensor(input_shape)
+        self.output = FakeTensor(output_shape)
+
+    def predict(self, data):
+        return np.sum(data, axis=1, keepdims=True)
+
+
+class WeightedModel(FakeModel):
+    """
+    The prediction depends on the orientation of the patch.
+    """
+    def predict(self, data):
+        return np.sum(data * np.arange(data.shape[-3])[:, np.newaxis, np.newaxis], axis=1, keepdims=True)
+
+
+class CountingModel(FakeModel):
+    def __init__(self, input_shape, output_shape):
+        super(CountingModel, self).__init__(input_shape, output_shape)
+        self.batch_sizes = []
+
+    def predict(self, data):
+        self.batch_sizes.append(len(data))
+        return super(CountingModel, self).predict(data)
+
+
+class FakeLayer(object):
+    def __init__(self, output_shape):
+        self.output_shape = output_shape
+
+
+class FakeTensor(object):
+    def __init__(self, shape):
+        self.shape = shape
@@ -0,0 +1,64 @@
+import time
+import random
+from unittest import TestCase
+
+from patches_comparaison.prefetch import BatchPrefetcher
+
+
+def generate_batches(n_batches, seed, loading_time=0.):
+    rng = random.Random(seed)
+    for _ in range(n_batches):
+        time.sleep(loading_time)
+        yield rng.random()
+
+
+def failing_batches():
+    yield 1
+    raise ValueError("loading failed")
+
+
+class TestBatchPrefetcher(TestCase):
+    def test_order(self):
+        expected = list(generate_batches(20, seed=3))
+        for depth in (0, 1, 4):
+            prefetcher = BatchPrefetcher(generate_batches(20, seed=3), depth=depth)
+            self.assertEqual(list(prefetcher), expected)
+            prefetcher.close()
+
+    def test_error_is_raised_by_the_consumer(self):
+        prefetcher = BatchPrefetcher(failing_batches(), depth=2)
+        self.assertEqual(next(prefetcher), 1)
+        with self.assertRaises(ValueError):
+            next(prefetcher)
+        prefetcher.close()
+
+    def test_overlap_ratio(self):
+        prefetcher = BatchPrefetcher(generate_batches(5, seed=0, loading_time=0.05), depth=2)
+        for _ in prefetcher:
+            time.sleep(0.1)
+        prefetcher.close()
+        self.assertGreater(prefetcher.get_overlap_ratio(), 0.5)
+
+        prefetcher = BatchPrefetcher(generate_batches(5, seed=0, loading_time=0.05), depth=0)
+        for _ in prefetcher:
+            time.sleep(0.1)
+        self.assertEqual(prefetcher.get_overlap_ratio(), 0.)
+
+    def test_close_before_the_end(self):
+        prefetcher = BatchPrefetcher(generate_batches(100, seed=0, loading_time=0.01), depth=2)
+        next(prefetcher)
+        prefetcher.close()
+        self.assertIsNone(prefetcher.thread)
+
+    def test_max_batches(self):
+        expected = list(generate_batches(20, seed=3))
+        batches = generate_batches(20, seed=3)
+        received = []
+        for max_batches in (3, 3, 100):
+            prefetcher = BatchPrefetcher(batches, depth=4, max_batches=max_batches)
+            segment = list(prefetcher)
+            prefetcher.close()
+            # The generator stopped at the end of the segment, the next prefetcher resumes it
+            self.assertEqual(segment, expected[len(received):len(received) + max_batches])
+            received += segment
+        self.assertEqual(received, expected)
@@ -4,11 +4,12 @@ import sys
 
 sys.path.append('/udd/aackaouy/OT-DA/')
 
-from unet3d.data import write_data_to_file, open_data_file
+from unet3d.data import update_data_file, open_data_file
 from unet3d.generator import get_training_and_validation_generators, get_validation_split
 from unet3d.model import isensee2017_model
 from unet3d.training import load_old_model, train_model
 from unet3d.utils.utils import pickle_dump
+from federated.normalization import NormalizationServer, get_harmonized_statistics, harmonize_data_file
 
 class Test:
     def __init__(self, conf):
@@ -43,8 +44,16 @@ class Test:
         # convert input images into an hdf5 file
         if overwrite_data or not os.path.exists(self.config.data_file):
             testing_files, subject_ids = self.fetch_testing_data_files(return_subject_ids=True)
-            write_data_to_file(testing_files, self.config.data_file, image_shape=self.config.image_shape,
-                               subject_ids=subject_ids)
+            update_data_file(testing_files, self.config.data_file, image_shape=self.config.image_shape,
+                             subject_ids=subject_ids, chunk_shape=self.config.chunk_shape,
+                             complib=self.config.complib, complevel=self.config.complevel,
+                             n_processes=self.config.ingestion_processes,
+                             normalization=self.config.normalization)
+        if self.config.normalization_server:
+            # The testing subjects are normalized with the statistics pooled by the training centers, without
+            # contributing to them
+            statistics = get_harmonized_statistics(NormalizationServer(self.config.normalization_server).aggregate())
+            harmonize_data_file(self.config.data_file, statistics)
         data_file_opened = open_data_file(self.config.data_file)
         testing_split, _ = get_validation_split(data_file_opened, data_split=0, overwrite_data=self.config.overwrite_data,
                                                  training_file=self.config.training_file, validation_file=self.config.validation_file)
@@ -30,4 +30,6 @@ class Predict:
                              hdf5_file=self.config.data_file,
                              output_label_map=True,
                              overlap=self.config.validation_patch_overlap,
-                             output_dir=prediction_dir)
+                             output_dir=prediction_dir,
+                             batch_size=self.config.prediction_batch_size,
+                             memory_budget=self.config.prediction_memory_budget)
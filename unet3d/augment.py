@@ -1,6 +1,7 @@
 import numpy as np
 import nibabel as nib
 from nilearn.image import new_img_like, resample_to_img
+from scipy.ndimage import affine_transform
 import random
 import itertools
 
@@ -23,20 +24,20 @@ def flip_image(image, axis):
     return new_img_like(image, data=new_data)
 
 
-def random_flip_dimensions(n_dimensions):
+def random_flip_dimensions(n_dimensions, rng=np.random):
     axis = list()
     for dim in range(n_dimensions):
-        if random_boolean():
+        if random_boolean(rng):
             axis.append(dim)
     return axis
 
 
-def random_scale_factor(n_dim=3, mean=1, std=0.25):
-    return np.random.normal(mean, std, n_dim)
+def random_scale_factor(n_dim=3, mean=1, std=0.25, rng=np.random):
+    return rng.normal(mean, std, n_dim)
 
 
-def random_boolean():
-    return np.random.choice([True, False])
+def random_boolean(rng=np.random):
+    return rng.choice([True, False])
 
 
 def distort_image(image, flip_axis=None, scale_factor=None):
@@ -57,17 +58,128 @@ def augment_data(data, truth, affine, scale_deviation=None, flip=True):
         flip_axis = random_flip_dimensions(n_dim)
     else:
         flip_axis = None
-    data_list = list()
-    for data_index in range(data.shape[0]):
-        image = get_image(data[data_index], affine)
-        data_list.append(resample_to_img(distort_image(image, flip_axis=flip_axis,
-                                                       scale_factor=scale_factor), image,
-                                         interpolation="continuous").get_data())
-    data = np.asarray(data_list)
-    truth_image = get_image(truth, affine)
-    truth_data = resample_to_img(distort_image(truth_image, flip_axis=flip_axis, scale_factor=scale_factor),
-                                 truth_image, interpolation="nearest").get_data()
-    return data, truth_data
+    return distort_data(data, truth, affine, flip_axis=flip_axis, scale_factor=scale_factor)
+
+
+def get_scale_transform(shape, affine, scale_factor):
+    """
+    Voxel to voxel transform of the resampling of an image scaled by scale_image onto the original image, as computed
+    by nilearn resample_to_img.
+    :return: matrix (diagonal as a vector when it is diagonal) and offset of scipy.ndimage.affine_transform
+    """
+    scale_factor = np.asarray(scale_factor)
+    scaled_affine = np.copy(affine)
+    scaled_affine[:3, :3] = affine[:3, :3] * scale_factor
+    scaled_affine[:, 3][:3] = affine[:, 3][:3] + (np.asarray(shape) * np.diag(affine)[:3] * (1 - scale_factor)) / 2
+    transform = np.dot(np.linalg.inv(scaled_affine), affine)
+    matrix, offset = transform[:3, :3], transform[:3, 3]
+    if np.all(np.diag(np.diag(matrix)) == matrix):
+        # affine_transform uses a faster algorithm with a diagonal matrix
+        matrix = np.diag(matrix)
+    return matrix, offset
+
+
+def scale_data(data, truth, affine, scale_factor):
+    """
+    Resampling of the scaled modalities with cubic splines and of the scaled truth with the nearest neighbour, with the
+    transform computed once.
+    :param data: Array of shape (n_modalities, x, y, z).
+    :param truth: Array of shape (x, y, z).
+    """
+    matrix, offset = get_scale_transform(truth.shape, affine, scale_factor)
+    # One call per modality: a call on the 4D array would also interpolate along the modalities
+    scaled = np.empty(data.shape, dtype=data.dtype)
+    for index in range(data.shape[0]):
+        affine_transform(data[index], matrix, offset=offset, output=scaled[index], order=3, cval=0)
+    return scaled, affine_transform(truth, matrix, offset=offset, order=0, cval=0)
+
+
+def distort_data(data, truth, affine, flip_axis=None, scale_factor=None):
+    """
+    Same transform as distort_image followed by resample_to_img, on the arrays.
+    :param data: Array of shape (n_modalities, x, y, z).
+    :param truth: Array of shape (x, y, z).
+    :param affine: Affine of the images.
+    :param flip_axis: Spatial axes to flip.
+    :param scale_factor: Scale factor of each spatial axis, None to only flip.
+    """
+    if flip_axis:
+        data = np.flip(data, axis=tuple(np.asarray(flip_axis) + 1))
+        truth = np.flip(truth, axis=tuple(flip_axis))
+    if scale_factor is None:
+        return np.copy(data), np.copy(truth)
+    return scale_data(data, truth, affine, scale_factor)
+
+
+def group_samples(keys):
+    """
+    :return: Dictionary {key: positions of the samples with this key}
+    """
+    groups = dict()
+    for position, key in enumerate(keys):
+        groups.setdefault(key, []).append(position)
+    return groups
+
+
+def augment_batch(data, truth, affine_list, augment=True, flip=True, scale_deviation=None, permute=False, rng=None):
+    """
+    Same augmentation as augment_data followed by random_permutation_x_y for every sample of a batch, with the random
+    values drawn in the same order. The samples sharing the same flip or the same permutation are transformed together,
+    only the scaling (whose factors are drawn from a continuous distribution) is applied sample by sample.
+    :param data: Array of shape (n_samples, n_modalities, x, y, z).
+    :param truth: Array of shape (n_samples, 1, x, y, z).
+    :param affine_list: Affine of each sample.
+    :param augment: If False, the samples are only permuted.
+    :param flip: Randomly flip the axes of the samples.
+    :param scale_deviation: Standard deviation of the scale factors. None, False or 0 to not scale the samples.
+    :param permute: Apply one of the 48 symmetries of the cube to each sample (the samples must be cubes).
+    :param rng: numpy RandomState drawing the random values. If None, the global random states of numpy and random are
+    used.
+    :return: The augmented data and truth, in new arrays of the same shapes.
+    """
+    if permute and (data.shape[-3] != data.shape[-2] or data.shape[-2] != data.shape[-1]):
+        raise ValueError("To utilize permutations, data array must be in 3D cube shape with all dimensions having "
+                         "the same length.")
+    n_dim = data.ndim - 2
+    random_state = np.random if rng is None else rng
+    flip_axes, scale_factors, permutation_keys = [], [], []
+    for _ in range(data.shape[0]):
+        scale_factor, flip_axis = None, ()
+        if augment and scale_deviation:
+            scale_factor = random_scale_factor(n_dim, std=scale_deviation, rng=random_state)
+        if augment and flip:
+            flip_axis = tuple(random_flip_dimensions(n_dim, rng=random_state))
+        flip_axes.append(flip_axis)
+        scale_factors.append(scale_factor)
+        permutation_keys.append(random_permutation_key(rng) if permute else None)
+
+    augmented_data, augmented_truth = np.empty_like(data), np.empty_like(truth)
+    for position, scale_factor in enumerate(scale_factors):
+        if scale_factor is not None:
+            augmented_data[position], augmented_truth[position, 0] = distort_data(
+                data[position], truth[position, 0], affine_list[position], flip_axis=flip_axes[position],
+                scale_factor=scale_factor)
+            if permutation_keys[position] is not None:
+                augmented_data[position] = permute_data(augmented_data[position], permutation_keys[position],
+                                                        copy=False)
+                augmented_truth[position] = permute_data(augmented_truth[position], permutation_keys[position],
+                                                         copy=False)
+    # Without scaling, the flip and the permutation of the samples sharing both are applied with one copy
+    not_scaled = [position for position, scale_factor in enumerate(scale_factors) if scale_factor is None]
+    for (flip_axis, key), positions in group_samples([(flip_axes[position], permutation_keys[position])
+                                                      for position in not_scaled]).items():
+        positions = [not_scaled[position] for position in positions]
+        augmented_data[positions] = transform_batch(data[positions], flip_axis, key)
+        augmented_truth[positions] = transform_batch(truth[positions], flip_axis, key)
+    return augmented_data, augmented_truth
+
+
+def transform_batch(data, flip_axis, key):
+    if flip_axis:
+        data = np.flip(data, axis=tuple(np.asarray(flip_axis) + 2))
+    if key is not None:
+        data = permute_batch(data, key)
+    return data
 
 
 def get_image(data, affine, nib_class=nib.Nifti1Image):
@@ -93,15 +205,19 @@ def generate_permutation_keys():
         itertools.combinations_with_replacement(range(2), 2), range(2), range(2), range(2), range(2)))
 
 
-def random_permutation_key():
+def random_permutation_key(rng=None):
     """
     Generates and randomly selects a permutation key. See the documentation for the
     "generate_permutation_keys" function.
+    :param rng: numpy RandomState drawing the key. If None, the global random state of random is used.
     """
-    return random.choice(list(generate_permutation_keys()))
+    keys = list(generate_permutation_keys())
+    if rng is None:
+        return random.choice(keys)
+    return keys[rng.randint(len(keys))]
 
 
-def permute_data(data, key):
+def permute_data(data, key, copy=True):
     """
     Permutes the given data according to the specification of the given key. Input data
     must be of shape (n_modalities, x, y, z).
@@ -111,24 +227,68 @@ def permute_data(data, key):
     As an example, ((0, 1), 0, 1, 0, 1) represents a permutation in which the data is
     rotated 90 degrees around the z-axis, then reversed on the y-axis, and then
     transposed.
+
+    :param copy: If False, a view of data is returned.
     """
-    data = np.copy(data)
-    (rotate_y, rotate_z), flip_x, flip_y, flip_z, transpose = key
+    permuted = permute_batch(data[np.newaxis], key)[0]
+    if copy:
+        return np.copy(permuted)
+    return permuted
+
+
+def permute_batch(data, key):
+    """
+    Same permutation as permute_data for all the samples of data, of shape (n_samples, n_modalities, x, y, z).
+    :return: A view of data
+    """
+    axes, flips = PERMUTATION_TABLES[key]
+    return apply_permutation_table(data, axes, flips)
+
 
+def apply_permutation_table(data, axes, flips):
+    """
+    :param data: Array of shape (n_samples, n_modalities, x, y, z).
+    :param axes: Spatial axis of data read along each spatial axis of the result.
+    :param flips: Whether each spatial axis of the result is read backwards.
+    :return: A view of data
+    """
+    data = np.transpose(data, (0, 1) + tuple(axis + 2 for axis in axes))
+    return data[(slice(None), slice(None)) + tuple(slice(None, None, -1) if flip else slice(None) for flip in flips)]
+
+
+def get_permutation_table(key):
+    """
+    Axes and flips of apply_permutation_table equivalent to the rotations, flips and transpose of a permutation key.
+    They are read on the permuted voxel coordinates of a 2x2x2 cube.
+    """
+    (rotate_y, rotate_z), flip_x, flip_y, flip_z, transpose = key
+    coordinates = np.indices((2, 2, 2))
     if rotate_y != 0:
-        data = np.rot90(data, rotate_y, axes=(1, 3))
+        coordinates = np.rot90(coordinates, rotate_y, axes=(1, 3))
     if rotate_z != 0:
-        data = np.rot90(data, rotate_z, axes=(2, 3))
+        coordinates = np.rot90(coordinates, rotate_z, axes=(2, 3))
     if flip_x:
-        data = data[:, ::-1]
+        coordinates = coordinates[:, ::-1]
     if flip_y:
-        data = data[:, :, ::-1]
+        coordinates = coordinates[:, :, ::-1]
     if flip_z:
-        data = data[:, :, :, ::-1]
+        coordinates = coordinates[:, :, :, ::-1]
     if transpose:
-        for i in range(data.shape[0]):
-            data[i] = data[i].T
-    return data
+        coordinates = np.transpose(coordinates, (0, 3, 2, 1))
+    axes, flips = [], []
+    for step in np.eye(3, dtype=int):
+        difference = coordinates[(slice(None),) + tuple(step)] - coordinates[:, 0, 0, 0]
+        axes.append(int(np.flatnonzero(difference)[0]))
+        flips.append(bool(difference[axes[-1]] < 0))
+    return tuple(axes), tuple(flips)
+
+
+def get_reverse_permutation_table(axes, flips):
+    reverse_axes, reverse_flips = [0] * len(axes), [False] * len(axes)
+    for axis, (original_axis, flip) in enumerate(zip(axes, flips)):
+        reverse_axes[original_axis] = axis
+        reverse_flips[original_axis] = flip
+    return tuple(reverse_axes), tuple(reverse_flips)
 
 
 def random_permutation_x_y(x_data, y_data):
@@ -142,27 +302,31 @@ def random_permutation_x_y(x_data, y_data):
     return permute_data(x_data, key), permute_data(y_data, key)
 
 
-def reverse_permute_data(data, key):
-    key = reverse_permutation_key(key)
-    data = np.copy(data)
-    (rotate_y, rotate_z), flip_x, flip_y, flip_z, transpose = key
+def reverse_permute_data(data, key, copy=True):
+    """
+    Inverse of permute_data.
+    :param copy: If False, a view of data is returned.
+    """
+    permuted = reverse_permute_batch(data[np.newaxis], key)[0]
+    if copy:
+        return np.copy(permuted)
+    return permuted
 
-    if transpose:
-        for i in range(data.shape[0]):
-            data[i] = data[i].T
-    if flip_z:
-        data = data[:, :, :, ::-1]
-    if flip_y:
-        data = data[:, :, ::-1]
-    if flip_x:
-        data = data[:, ::-1]
-    if rotate_z != 0:
-        data = np.rot90(data, rotate_z, axes=(2, 3))
-    if rotate_y != 0:
-        data = np.rot90(data, rotate_y, axes=(1, 3))
-    return data
+
+def reverse_permute_batch(data, key):
+    """
+    Same as reverse_permute_data for all the samples of data, of shape (n_samples, n_modalities, x, y, z).
+    :return: A view of data
+    """
+    axes, flips = REVERSE_PERMUTATION_TABLES[key]
+    return apply_permutation_table(data, axes, flips)
 
 
 def reverse_permutation_key(key):
     rotation = tuple([-rotate for rotate in key[0]])
     return rotation, key[1], key[2], key[3], key[4]
+
+
+# The 48 symmetries as one transpose and one reversal of some axes, computed once
+PERMUTATION_TABLES = {key: get_permutation_table(key) for key in generate_permutation_keys()}
+REVERSE_PERMUTATION_TABLES = {key: get_reverse_permutation_table(*table) for key, table in PERMUTATION_TABLES.items()}
@@ -1,36 +1,115 @@
 import os
+import json
+import hashlib
+from multiprocessing import get_context
 
 import numpy as np
 import tables
 
-from .normalize import normalize_data_storage, reslice_image_set
+from .normalize import (normalize_data_storage, reslice_image_set, get_normalization_parameters,
+                        denormalize_subject)
 
 
-def create_data_file(out_file, n_channels, n_samples, image_shape):
-    hdf5_file = tables.open_file(out_file, mode='w')
-    filters = tables.Filters(complevel=5, complib='blosc')
+def create_data_file(out_file, n_channels, n_samples, image_shape, chunk_shape=None, complib="blosc", complevel=5):
+    """
+    Creates the hdf5 file and its data, truth and affine arrays.
+    :param chunk_shape: Spatial shape of the hdf5 chunks of the data and truth arrays, e.g. (16, 16, 16). Reading a
+    patch then only decompresses the chunks it intersects. If None, PyTables chooses the chunks.
+    :param complib: Compression library ("blosc", "blosc:lz4", "blosc:zstd", "zlib"... or "none").
+    :param complevel: Compression level (0 to 9).
+    :return: hdf5 file, data storage, truth storage, affine storage
+    """
+    filters = get_filters(complib, complevel)
     data_shape = tuple([0, n_channels] + list(image_shape))
     truth_shape = tuple([0, 1] + list(image_shape))
+    data_chunks, truth_chunks = None, None
+    if chunk_shape is not None:
+        chunk_shape = tuple([int(min(dim, image_dim)) for dim, image_dim in zip(chunk_shape, image_shape)])
+        data_chunks = (1, n_channels) + chunk_shape
+        truth_chunks = (1, 1) + chunk_shape
+    hdf5_file = tables.open_file(out_file, mode='w')
     data_storage = hdf5_file.create_earray(hdf5_file.root, 'data', tables.Float32Atom(), shape=data_shape,
-                                           filters=filters, expectedrows=n_samples)
+                                           filters=filters, expectedrows=n_samples, chunkshape=data_chunks)
     truth_storage = hdf5_file.create_earray(hdf5_file.root, 'truth', tables.UInt8Atom(), shape=truth_shape,
-                                            filters=filters, expectedrows=n_samples)
+                                            filters=filters, expectedrows=n_samples, chunkshape=truth_chunks)
     affine_storage = hdf5_file.create_earray(hdf5_file.root, 'affine', tables.Float32Atom(), shape=(0, 4, 4),
                                              filters=filters, expectedrows=n_samples)
+    # The layout is recorded so that readers know which chunks a patch intersects
+    hdf5_file.root._v_attrs.chunk_shape = list(data_storage.chunkshape[2:])
+    hdf5_file.root._v_attrs.complib = str(complib) if filters.complevel else "none"
+    hdf5_file.root._v_attrs.complevel = filters.complevel
     return hdf5_file, data_storage, truth_storage, affine_storage
 
 
+def get_filters(complib="blosc", complevel=5):
+    if complib is None or complib == "none" or complevel == 0:
+        return tables.Filters(complevel=0)
+    if complib not in tables.filters.all_complibs:
+        raise ValueError("Unknown compression library " + str(complib) + ", choose one of "
+                         + str(tables.filters.all_complibs) + " or none.")
+    return tables.Filters(complevel=complevel, complib=complib)
+
+
+def get_data_layout(data_file):
+    """
+    Layout of the data array of a data file: the spatial shape of its chunks and its compression. Files written before
+    the layout was recorded are described from the array itself.
+    :return: dictionary with the keys chunk_shape, complib and complevel
+    """
+    attributes = data_file.root._v_attrs
+    if "chunk_shape" in attributes:
+        return {"chunk_shape": tuple(int(dim) for dim in attributes.chunk_shape),
+                "complib": attributes.complib,
+                "complevel": int(attributes.complevel)}
+    filters = data_file.root.data.filters
+    return {"chunk_shape": tuple(int(dim) for dim in data_file.root.data.chunkshape[2:]),
+            "complib": filters.complib if filters.complevel else "none",
+            "complevel": int(filters.complevel)}
+
+
 def write_image_data_to_file(image_files, data_storage, truth_storage, image_shape, n_channels, affine_storage,
-                             truth_dtype=np.uint8, crop=True):
-    for i, set_of_files in enumerate(image_files):
+                             truth_dtype=np.uint8, crop=True, n_processes=1, start=0):
+    """
+    Reads, crops and resamples the subjects and appends them to the storages, in the order of image_files.
+    :param n_processes: Number of processes reading the subjects. The subjects are read in parallel and written by
+    this process only, as soon as all the previous subjects are written. None for one process per CPU.
+    :param start: Index of the first subject to write, the previous ones are already in the storages.
+    """
+    tasks = [(set_of_files, image_shape, crop) for set_of_files in image_files[start:]]
+    for i, (subject_data, affine) in enumerate(read_subjects(tasks, n_processes), start):
         advance = "Reading files: " + str(i/len(image_files)*100) + "%"
         print(advance)
-        images = reslice_image_set(set_of_files, image_shape, label_indices=len(set_of_files) - 1, crop=crop)
-        subject_data = [image.get_data() for image in images]
-        add_data_to_storage(data_storage, truth_storage, affine_storage, subject_data, images[0].affine, n_channels,truth_dtype)
+        add_data_to_storage(data_storage, truth_storage, affine_storage, subject_data, affine, n_channels,
+                            truth_dtype)
+        # Flushed for each subject: if the ingestion is interrupted, the written subjects are kept
+        data_storage._v_file.flush()
     return data_storage, truth_storage
 
 
+def read_subjects(tasks, n_processes=1):
+    """
+    Yields the images and affine of each subject, in the order of the tasks.
+    :param tasks: List of (set of files, image shape, crop) tuples.
+    :param n_processes: Number of reading processes, None for one per CPU.
+    """
+    if n_processes == 1:
+        for task in tasks:
+            yield read_subject_images(task)
+        return
+    pool = get_context("spawn").Pool(n_processes)
+    try:
+        for subject in pool.imap(read_subject_images, tasks):
+            yield subject
+    finally:
+        pool.terminate()
+
+
+def read_subject_images(task):
+    set_of_files, image_shape, crop = task
+    images = reslice_image_set(set_of_files, image_shape, label_indices=len(set_of_files) - 1, crop=crop)
+    return [image.get_data() for image in images], images[0].affine
+
+
 def add_data_to_storage(data_storage, truth_storage, affine_storage, subject_data, affine, n_channels, truth_dtype):
     data_storage.append(np.asarray(subject_data[:n_channels])[np.newaxis])
     truth_storage.append(np.asarray(subject_data[n_channels], dtype=truth_dtype)[np.newaxis][np.newaxis])
@@ -38,7 +117,8 @@ def add_data_to_storage(data_storage, truth_storage, affine_storage, subject_dat
 
 
 def write_data_to_file(training_data_files, out_file, image_shape, truth_dtype=np.uint8, subject_ids=None,
-                       normalize=True, crop=True):
+                       normalize=True, crop=True, chunk_shape=None, complib="blosc", complevel=5, n_processes=1,
+                       resume=False, normalization="subject"):
     """
     Takes in a set of training images and writes these images to an hdf5 file.
     :param training_data_files: List of tuples containing the training data files. The modalities should be listed in
@@ -48,6 +128,14 @@ def write_data_to_file(training_data_files, out_file, image_shape, truth_dtype=n
     :param out_file: Where the hdf5 file will be written to.
     :param image_shape: Shape of the images that will be saved to the hdf5 file.
     :param truth_dtype: Default is 8-bit unsigned integer. 
+    :param chunk_shape: Spatial shape of the hdf5 chunks (see create_data_file).
+    :param complib: Compression library (see create_data_file).
+    :param complevel: Compression level.
+    :param n_processes: Number of processes reading the images (see write_image_data_to_file).
+    :param resume: If True and out_file was written from the same input files, its subjects are reused: a complete
+    file is returned as is, an interrupted ingestion continues after the last written subject.
+    :param normalization: Statistics of the normalization: "subject", "dataset" or "center" (the centers are taken
+    from the subject ids, see normalize_data_storage).
     :return: Location of the hdf5 file with the image data written to it. 
     """
     n_samples = len(training_data_files)
@@ -55,25 +143,217 @@ def write_data_to_file(training_data_files, out_file, image_shape, truth_dtype=n
 
     print("Number of images: ", n_samples)
     print("Number of modalities: ", n_channels)
-    try:
-        hdf5_file, data_storage, truth_storage, affine_storage = create_data_file(out_file,
-                                                                                  n_channels=n_channels,
-                                                                                  n_samples=n_samples,
-                                                                                  image_shape=image_shape)
-    except Exception as e:
-        # If something goes wrong, delete the incomplete data file
-        os.remove(out_file)
-        raise e
+    start = 0
+    if resume and os.path.exists(out_file):
+        hdf5_file, start = open_incomplete_data_file(out_file, training_data_files, n_channels, image_shape)
+        if hdf5_file is None and start == n_samples:
+            print("Reusing the complete data file", out_file)
+            return out_file
+    if start == 0:
+        try:
+            hdf5_file, data_storage, truth_storage, affine_storage = create_data_file(out_file,
+                                                                                      n_channels=n_channels,
+                                                                                      n_samples=n_samples,
+                                                                                      image_shape=image_shape,
+                                                                                      chunk_shape=chunk_shape,
+                                                                                      complib=complib,
+                                                                                      complevel=complevel)
+        except Exception as e:
+            # If something goes wrong, delete the incomplete data file
+            os.remove(out_file)
+            raise e
+        # The input files are recorded so that an interrupted ingestion can be resumed
+        hdf5_file.root._v_attrs.input_files = json.dumps([list(set_of_files) for set_of_files in training_data_files])
+        hdf5_file.root._v_attrs.complete = False
+        if subject_ids:
+            hdf5_file.create_array(hdf5_file.root, 'subject_ids', obj=subject_ids)
+    else:
+        print("Resuming the data file", out_file, "after", start, "subjects")
+        data_storage, truth_storage, affine_storage = hdf5_file.root.data, hdf5_file.root.truth, hdf5_file.root.affine
 
     write_image_data_to_file(training_data_files, data_storage, truth_storage, image_shape,
-                             truth_dtype=truth_dtype, n_channels=n_channels, affine_storage=affine_storage, crop=crop)
+                             truth_dtype=truth_dtype, n_channels=n_channels, affine_storage=affine_storage, crop=crop,
+                             n_processes=n_processes, start=start)
+    if normalize:
+        # A normalization cannot be resumed, the subjects normalized before an interruption would be normalized twice
+        hdf5_file.root._v_attrs.normalizing = True
+        normalize_data_storage(data_storage, mode=normalization, groups=get_subject_centers(subject_ids))
+    hdf5_file.root._v_attrs.complete = True
+    hdf5_file.close()
+    return out_file
+
+
+def open_incomplete_data_file(out_file, training_data_files, n_channels, image_shape):
+    """
+    Opens a data file written from the same input files by an interrupted ingestion, and removes the rows of the
+    subject that was being written.
+    :return: The opened file and the number of subjects already written. (None, n_samples) if the file is complete,
+    (None, 0) if it cannot be resumed.
+    """
+    input_files = [list(set_of_files) for set_of_files in training_data_files]
+    with tables.open_file(out_file, mode="r") as hdf5_file:
+        attributes = hdf5_file.root._v_attrs
+        if ("input_files" not in attributes or json.loads(attributes.input_files) != input_files
+                or tuple(hdf5_file.root.data.shape[1:]) != tuple([n_channels] + list(image_shape))
+                or ("normalizing" in attributes and not attributes.complete)):
+            return None, 0
+        if attributes.complete:
+            return None, len(input_files)
+        n_written = min(hdf5_file.root.data.nrows, hdf5_file.root.truth.nrows, hdf5_file.root.affine.nrows)
+    if n_written == 0:
+        return None, 0
+    hdf5_file = tables.open_file(out_file, mode="a")
+    for storage in (hdf5_file.root.data, hdf5_file.root.truth, hdf5_file.root.affine):
+        storage.truncate(n_written)
+    return hdf5_file, n_written
+
+
+def update_data_file(training_data_files, out_file, image_shape, truth_dtype=np.uint8, subject_ids=None,
+                     normalize=True, crop=True, chunk_shape=None, complib="blosc", complevel=5, n_processes=1,
+                     normalization="subject"):
+    """
+    Writes the data file like write_data_to_file, but reuses the subjects of the previous build: a manifest next to
+    the data file records the path, size and modification time of the input files of each subject, and the
+    preprocessing parameters. Only the subjects whose input files changed are read again. If nothing changed, the data
+    file is kept as is, and an interrupted full rebuild of the same input files is resumed.
+    The parameters are the same as write_data_to_file.
+    :return: Location of the hdf5 file.
+    """
+    manifest = get_manifest(training_data_files, subject_ids, image_shape=image_shape, truth_dtype=truth_dtype,
+                            normalize=normalize, crop=crop, chunk_shape=chunk_shape, complib=complib,
+                            complevel=complevel, normalization=normalization)
+    manifest_path = get_manifest_path(out_file)
+    previous_manifest = load_manifest(manifest_path) if os.path.exists(out_file) else None
+    if previous_manifest == manifest:
+        print("The input files did not change, reusing the data file", out_file)
+        return out_file
+    # The rows of the previous data file that can be reused, by subject hash
+    reusable = dict()
+    if previous_manifest is not None and previous_manifest["parameters"] == manifest["parameters"]:
+        reusable = {subject["hash"]: row for row, subject in enumerate(previous_manifest["subjects"])}
+    hashes = [subject["hash"] for subject in manifest["subjects"]]
+    # The manifest is removed first: if the build is interrupted, the data file is not mistaken for a valid one
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    if not any(subject_hash in reusable for subject_hash in hashes):
+        # The manifest of a full rebuild is kept aside while it runs: an interrupted rebuild of the same inputs is
+        # resumed instead of starting over
+        pending_path = get_pending_manifest_path(out_file)
+        resume = os.path.exists(out_file) and load_manifest(pending_path) == manifest
+        save_manifest(manifest, pending_path)
+        write_data_to_file(training_data_files, out_file, image_shape, truth_dtype=truth_dtype,
+                           subject_ids=subject_ids, normalize=normalize, crop=crop, chunk_shape=chunk_shape,
+                           complib=complib, complevel=complevel, n_processes=n_processes, resume=resume,
+                           normalization=normalization)
+        os.replace(pending_path, manifest_path)
+        return out_file
+
+    changed = [set_of_files for set_of_files, subject_hash in zip(training_data_files, hashes)
+               if subject_hash not in reusable]
+    print("Reusing", len(hashes) - len(changed), "subjects of", out_file, "and reading", len(changed), "subjects")
+    # The data file is written next to the previous one, which is replaced at the end
+    temporary_file = out_file + ".tmp"
+    previous_file = open_data_file(out_file)
+    n_channels = len(training_data_files[0]) - 1
+    hdf5_file, data_storage, truth_storage, affine_storage = create_data_file(temporary_file, n_channels,
+                                                                              len(training_data_files), image_shape,
+                                                                              chunk_shape=chunk_shape, complib=complib,
+                                                                              complevel=complevel)
+    new_subjects = read_subjects([(set_of_files, image_shape, crop) for set_of_files in changed], n_processes)
+    new_indices = []
+    reused_rows = dict()
+    for index, subject_hash in enumerate(hashes):
+        if subject_hash in reusable:
+            row = reusable[subject_hash]
+            reused_rows[index] = row
+            data_storage.append(previous_file.root.data[row][np.newaxis])
+            truth_storage.append(previous_file.root.truth[row][np.newaxis])
+            affine_storage.append(previous_file.root.affine[row][np.newaxis])
+        else:
+            subject_data, affine = next(new_subjects)
+            add_data_to_storage(data_storage, truth_storage, affine_storage, subject_data, affine, n_channels,
+                                truth_dtype)
+            new_indices.append(index)
+    new_subjects.close()
+    previous_normalization = get_normalization_parameters(previous_file.root.data) if normalize else None
+    previous_file.close()
     if subject_ids:
         hdf5_file.create_array(hdf5_file.root, 'subject_ids', obj=subject_ids)
-    if normalize:
-        normalize_data_storage(data_storage)
+    if normalize and normalization == "subject" and previous_normalization["mode"] == "subject":
+        # The subjects are normalized independently, the reused ones keep their normalization
+        scales = np.full((len(hashes), n_channels), np.nan)
+        offsets = np.full((len(hashes), n_channels), np.nan)
+        statistics = dict()
+        for index, row in reused_rows.items():
+            scales[index] = previous_normalization["scale"][row]
+            offsets[index] = previous_normalization["offset"][row]
+            statistics[str(index)] = previous_normalization["statistics"][str(row)]
+        data_storage.attrs.normalization = json.dumps({"mode": "subject", "statistics": statistics})
+        data_storage.attrs.normalization_scale = scales
+        data_storage.attrs.normalization_offset = offsets
+        normalize_data_storage(data_storage, indices=new_indices)
+    elif normalize:
+        # The statistics are shared between subjects, or the previous file was harmonized with other centers (see
+        # federated.normalization): the reused subjects are restored and normalized again
+        for index, row in reused_rows.items():
+            denormalize_subject(data_storage, index, previous_normalization["scale"][row],
+                                previous_normalization["offset"][row])
+        normalize_data_storage(data_storage, mode=normalization, groups=get_subject_centers(subject_ids))
+    hdf5_file.root._v_attrs.input_files = json.dumps([list(set_of_files) for set_of_files in training_data_files])
+    hdf5_file.root._v_attrs.complete = True
     hdf5_file.close()
+    os.replace(temporary_file, out_file)
+    save_manifest(manifest, manifest_path)
     return out_file
 
 
+def get_subject_centers(subject_ids):
+    """
+    Center of each subject, read from the subject id like in Train_JDOT.fetch_training_data_files (MICCAI16 layout).
+    """
+    if not subject_ids:
+        return None
+    return [str(subject_id)[-9:-7] for subject_id in subject_ids]
+
+
+def get_manifest(training_data_files, subject_ids=None, **parameters):
+    """
+    Description of the inputs of a data file: the preprocessing parameters, and for each subject its input files
+    (path, size and modification time) and a hash of them.
+    """
+    parameters = {key: (list(value) if isinstance(value, tuple) else value) for key, value in parameters.items()}
+    parameters["truth_dtype"] = np.dtype(parameters.get("truth_dtype", np.uint8)).name
+    subjects = []
+    for index, set_of_files in enumerate(training_data_files):
+        files = []
+        for path in set_of_files:
+            file_stat = os.stat(path)
+            files.append({"path": os.path.abspath(path), "size": file_stat.st_size, "mtime": file_stat.st_mtime})
+        subjects.append({"subject_id": str(subject_ids[index]) if subject_ids else None,
+                         "files": files,
+                         "hash": hashlib.sha1(json.dumps(files, sort_keys=True).encode()).hexdigest()})
+    return {"parameters": parameters, "subjects": subjects}
+
+
+def get_manifest_path(out_file):
+    return os.path.splitext(os.path.abspath(out_file))[0] + "_manifest.json"
+
+
+def get_pending_manifest_path(out_file):
+    return os.path.splitext(os.path.abspath(out_file))[0] + "_manifest.pending.json"
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as opened_file:
+        return json.load(opened_file)
+
+
+def save_manifest(manifest, path):
+    with open(path, "w") as opened_file:
+        json.dump(manifest, opened_file, indent=1)
+
+
 def open_data_file(filename, readwrite="r"):
     return tables.open_file(filename, readwrite)
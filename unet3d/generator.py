@@ -6,7 +6,8 @@ import itertools
 import numpy as np
 
 from .utils import pickle_dump, pickle_load
-from .utils.patches import compute_patch_indices, get_random_nd_index, get_patch_from_3d_data
+from .utils.patches import compute_patch_indices, get_random_nd_index, get_patch_from_storage
+from .utils.patch_statistics import compute_patch_statistics, select_patches_with_ground_truth
 from .augment import augment_data, random_permutation_x_y
 import sys
 
@@ -119,18 +120,9 @@ def load_index_patches_with_gt(file_name):
     return pickle_load(file_name)
 
 
-def get_patches_with_ground_truth(index_list, data_file, patch_shape):
-    new_index_list = []
-    initial_length = len(index_list)
-    while len(index_list) > 0:
-        advance = "\r Writing indexes with GT :" + str((initial_length - len(index_list))/initial_length*100 )+ "%"
-        sys.stdout.write(advance)
-        sys.stdout.flush()
-        index = index_list.pop()
-        data, truth = get_data_from_file(data_file, index, patch_shape=patch_shape)
-        if np.mean(truth) != 0:
-            new_index_list += [index]
-    return new_index_list
+def get_patches_with_ground_truth(index_list, data_file, patch_shape, patch_index=None):
+    statistics = compute_patch_statistics(data_file, index_list, patch_shape, patch_index)
+    return select_patches_with_ground_truth(index_list, statistics)
 
 
 def get_number_of_steps(n_samples, batch_size):
@@ -275,13 +267,10 @@ def get_number_of_patches(data_file, index_list, patch_shape=None, patch_overlap
     if patch_shape:
         index_list = create_patch_index_list(index_list, data_file.root.data.shape[-3:], patch_shape, patch_overlap,
                                              patch_start_offset)
-        count = 0
-        for index in index_list:
-            x_list = list()
-            y_list = list()
-            add_data(x_list, y_list, data_file, index, skip_blank=skip_blank, patch_shape=patch_shape)
-            if len(x_list) > 0:
-                count += 1
+        if skip_blank:
+            count = len(get_patches_with_ground_truth(index_list, data_file, patch_shape))
+        else:
+            count = len(index_list)
 
         print(count)
         return count
@@ -344,9 +333,9 @@ def add_data(x_list, y_list, data_file, index, augment=False, augment_flip=False
 def get_data_from_file(data_file, index, patch_shape=None):
     if patch_shape:
         index, patch_index = index
-        data, truth = get_data_from_file(data_file, index, patch_shape=None)
-        x = get_patch_from_3d_data(data, patch_shape, patch_index)
-        y = get_patch_from_3d_data(truth, patch_shape, patch_index)
+        # Only the chunks of the file intersecting the patch are read
+        x = get_patch_from_storage(data_file.root.data, index, patch_shape, patch_index)
+        y = get_patch_from_storage(data_file.root.truth, index, patch_shape, patch_index)[0]
     else:
         x, y = data_file.root.data[index], data_file.root.truth[index, 0]
     return x, y
@@ -1,4 +1,5 @@
 import os
+import json
 
 import numpy as np
 from nilearn.image import new_img_like
@@ -72,23 +73,181 @@ def normalize_data(data, mean, std):
     return data
 
 
-def normalize_data_storage(data_storage):
-    means = list()
-    stds = list()
-    for index in range(data_storage.shape[0]):
-        data = data_storage[index]
-        mean = data.mean(axis=(1, 2, 3))
-        std = data.std(axis=(1, 2, 3))
-        data_storage[index] = normalize_data(data_storage[index], mean, std)
-
-    # for index in range(data_storage.shape[0]):
-    #     data = data_storage[index]
-    #     means.append(data.mean(axis=(1, 2, 3)))
-    #     stds.append(data.std(axis=(1, 2, 3)))
-    # mean = np.asarray(means).mean(axis=0)
-    # std = np.asarray(stds).mean(axis=0)
-    # for index in range(data_storage.shape[0]):
-    #     data_storage[index] = normalize_data(data_storage[index], mean, std)
+class ChannelMoments:
+    """
+    Number of voxels, mean, sum of squared deviations from the mean, minimum and maximum of each channel, accumulated
+    chunk by chunk. The moments of two sets of voxels are merged with the pairwise formula of Chan et al., which stays
+    accurate when the chunks have very different means.
+    """
+    def __init__(self, n_channels):
+        self.count = 0
+        self.mean = np.zeros(n_channels)
+        self.m2 = np.zeros(n_channels)
+        self.min = np.full(n_channels, np.inf)
+        self.max = np.full(n_channels, -np.inf)
+
+    def update(self, data):
+        '''
+        :param data: Chunk of shape (n_channels, ...).
+        '''
+        data = np.asarray(data, dtype=np.float64).reshape(data.shape[0], -1)
+        chunk = ChannelMoments(data.shape[0])
+        chunk.count = data.shape[1]
+        chunk.mean = data.mean(axis=1)
+        chunk.m2 = np.square(data - chunk.mean[:, np.newaxis]).sum(axis=1)
+        chunk.min = data.min(axis=1)
+        chunk.max = data.max(axis=1)
+        self.merge(chunk)
+
+    def merge(self, other):
+        count = self.count + other.count
+        if count == 0:
+            return self
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + np.square(delta) * self.count * other.count / count
+        self.count = count
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        return self
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+    def get_statistics(self):
+        return {"count": int(self.count), "mean": self.mean.tolist(), "std": self.std.tolist(),
+                "min": self.min.tolist(), "max": self.max.tolist()}
+
+    @classmethod
+    def from_statistics(cls, statistics):
+        """
+        Inverse of get_statistics, to merge the moments of sets of voxels that are not available anymore.
+        """
+        moments = cls(len(statistics["mean"]))
+        moments.count = statistics["count"]
+        moments.mean = np.asarray(statistics["mean"], dtype=np.float64)
+        moments.m2 = np.square(np.asarray(statistics["std"], dtype=np.float64)) * moments.count
+        moments.min = np.asarray(statistics["min"], dtype=np.float64)
+        moments.max = np.asarray(statistics["max"], dtype=np.float64)
+        return moments
+
+
+def get_normalization(statistics):
+    """
+    The normalization of normalize_data, (data - mean) / std rescaled between 0 and 1, written as
+    data * scale + offset. The bounds of the rescaling follow from the minimum and maximum of each channel.
+    :param statistics: Dictionary with the mean, std, min and max of each channel (see ChannelMoments).
+    :return: scale, offset: arrays with one value per channel
+    """
+    mean = np.asarray(statistics["mean"], dtype=np.float64)
+    std = np.asarray(statistics["std"], dtype=np.float64)
+    std[std == 0] = 1
+    normalized_min = ((np.asarray(statistics["min"]) - mean) / std).min()
+    normalized_max = ((np.asarray(statistics["max"]) - mean) / std).max()
+    extent = normalized_max - normalized_min if normalized_max > normalized_min else 1
+    scale = 1 / (std * extent)
+    offset = (-mean / std - normalized_min) / extent
+    return scale, offset
+
+
+def get_slabs(data_storage):
+    """
+    Slabs along the first image axis, aligned on the hdf5 chunks, in which a subject is read and written.
+    """
+    size = data_storage.shape[2]
+    chunk_size = data_storage.chunkshape[2] if getattr(data_storage, "chunkshape", None) else size
+    step = chunk_size * max(1, 16 // chunk_size)
+    return [slice(start, min(start + step, size)) for start in range(0, size, step)]
+
+
+def get_subject_moments(data_storage, index):
+    moments = ChannelMoments(data_storage.shape[1])
+    for slab in get_slabs(data_storage):
+        moments.update(data_storage[index, :, slab])
+    return moments
+
+
+def apply_normalization(data_storage, index, scale, offset):
+    """
+    Replaces the subject by data * scale + offset, slab by slab.
+    """
+    shape = (-1, 1, 1, 1)
+    for slab in get_slabs(data_storage):
+        data = np.asarray(data_storage[index, :, slab], dtype=np.float64)
+        data_storage[index, :, slab] = data * scale.reshape(shape) + offset.reshape(shape)
+
+
+def denormalize_subject(data_storage, index, scale, offset):
+    """
+    Inverse of apply_normalization, to normalize a subject again with other statistics.
+    """
+    apply_normalization(data_storage, index, 1 / scale, -offset / scale)
+
+
+def normalize_data_storage(data_storage, indices=None, mode="subject", groups=None):
+    """
+    Normalizes the subjects of the storage in place: (data - mean) / std, rescaled between 0 and 1. The statistics are
+    computed in a single pass over each subject and the subject is then transformed slab by slab.
+    The statistics of each normalization group and the transform of each subject are saved in the attributes of the
+    storage (see get_normalization_parameters).
+    :param indices: Indices of the subjects to normalize (default: all of them). With the subject mode, the other
+    subjects keep their normalization.
+    :param mode: "subject" (statistics of each subject), "dataset" (statistics of all the subjects of the storage) or
+    "center" (statistics of the subjects of each group).
+    :param groups: Group (e.g. center) of each subject of the storage, for the center mode.
+    """
+    n_subjects = data_storage.shape[0]
+    if mode == "subject":
+        subject_groups = [str(index) for index in range(n_subjects)]
+    elif mode == "dataset":
+        subject_groups = ["dataset"] * n_subjects
+    elif mode == "center":
+        if groups is None or len(groups) != n_subjects:
+            raise ValueError("The center normalization needs the group of each of the " + str(n_subjects)
+                             + " subjects.")
+        subject_groups = [str(group) for group in groups]
+    else:
+        raise ValueError("Unknown normalization mode " + str(mode) + ", choose subject, dataset or center.")
+    if indices is None or mode != "subject":
+        indices = range(n_subjects)
+
+    moments = dict()
+    for index in indices:
+        moments.setdefault(subject_groups[index], ChannelMoments(data_storage.shape[1])).merge(
+            get_subject_moments(data_storage, index))
+    statistics = {group: group_moments.get_statistics() for group, group_moments in moments.items()}
+
+    attributes = data_storage.attrs
+    shape = (n_subjects, data_storage.shape[1])
+    if mode == "subject" and "normalization_scale" in attributes and attributes.normalization_scale.shape == shape:
+        scales, offsets = attributes.normalization_scale.copy(), attributes.normalization_offset.copy()
+        all_statistics = json.loads(attributes.normalization)["statistics"]
+    else:
+        scales, offsets = np.full(shape, np.nan), np.full(shape, np.nan)
+        all_statistics = dict()
+    all_statistics.update(statistics)
+    for index in indices:
+        scales[index], offsets[index] = get_normalization(statistics[subject_groups[index]])
+        apply_normalization(data_storage, index, scales[index], offsets[index])
+    attributes.normalization = json.dumps({"mode": mode, "groups": subject_groups, "statistics": all_statistics})
+    attributes.normalization_scale = scales
+    attributes.normalization_offset = offsets
     return data_storage
 
 
+def get_normalization_parameters(data_storage):
+    """
+    :return: The normalization mode, the statistics of each group, and the scale and offset of each subject (arrays
+    of shape (n_subjects, n_channels)). None if the storage was not normalized with normalize_data_storage.
+    """
+    attributes = data_storage.attrs
+    if "normalization" not in attributes:
+        return None
+    normalization = json.loads(attributes.normalization)
+    return {"mode": normalization["mode"],
+            "groups": normalization["groups"],
+            "statistics": normalization["statistics"],
+            "scale": np.asarray(attributes.normalization_scale),
+            "offset": np.asarray(attributes.normalization_offset)}
+
@@ -1,4 +1,5 @@
 import os
+import collections
 
 import nibabel as nib
 import numpy as np
@@ -6,41 +7,142 @@ import tables
 
 from unet3d.training import load_old_model
 from unet3d.utils import pickle_load
-from unet3d.utils.patches import reconstruct_from_patches, get_patch_from_3d_data, compute_patch_indices
-from unet3d.augment import permute_data, generate_permutation_keys, reverse_permute_data
+from unet3d.utils.patches import (PatchAccumulator, compute_patch_indices, pad_data_for_patches,
+                                  get_patches_from_padded_data)
+from unet3d.augment import permute_batch, generate_permutation_keys, reverse_permute_batch
 
 
-def patch_wise_prediction(model, data, overlap=0, batch_size=10, permute=False):
+def patch_wise_prediction(model, data, overlap=0, batch_size=10, permute=False, blending=None):
     """
-    :param batch_size:
+    Predicts the data patch by patch. The volume is padded once, each batch is stacked from views of the padded volume
+    and the predicted patches are folded into the output volume as soon as they are predicted, so that only the
+    volume and one batch are held in memory.
+    :param batch_size: Number of patches per model.predict call, None to fit the memory budget of
+    get_prediction_batch_size.
     :param model:
     :param data:
     :param overlap:
+    :param blending: None to average overlapping patches, "gaussian" or "cosine" to weight them (see
+    reconstruct_from_patches).
     :return:
     """
-    patch_shape = tuple([int(dim) for dim in model.input.shape[-3:]])
-    predictions = list()
-    print("Patch_shape prediction:", patch_shape)
+    print("Patch_shape prediction:", get_patch_shape(model))
     print("Overlap_ :", overlap)
-    indices = compute_patch_indices(data.shape[-3:], patch_size=patch_shape, overlap=overlap)
-    batch = list()
-    i = 0
-    while i < len(indices):
-        while len(batch) < batch_size and i < len(indices):
-            patch = get_patch_from_3d_data(data[0], patch_shape=patch_shape, patch_index=indices[i])
-            batch.append(patch)
-            i += 1
-        prediction = predict(model, np.asarray(batch), permute=permute)
-        batch = list()
+    _, prediction = next(predict_subjects(model, [(None, data[0])], batch_size=batch_size, overlap=overlap,
+                                          permute=permute, blending=blending))
+    return prediction
+
+
+def get_patch_shape(model):
+    return tuple([int(dim) for dim in model.input.shape[-3:]])
+
+
+def get_output_channels(model):
+    if isinstance(model.output, list):
+        return int(model.output[-1].shape[1])
+    return int(model.output.shape[1])
+
+
+def get_prediction_batch_size(model, memory_budget=2 ** 30, permute=False):
+    """
+    Largest number of patches whose input, layer outputs and prediction, in float32, fit in the memory budget. With
+    test-time augmentation, each permuted copy of a patch counts as a patch.
+    :param memory_budget: Memory budget in bytes.
+    """
+    n_values = 0
+    for layer in model.layers:
+        output_shapes = layer.output_shape if isinstance(layer.output_shape, list) else [layer.output_shape]
+        n_values += sum([int(np.prod(shape[1:])) for shape in output_shapes])
+    n_permutations = len(get_test_time_permutation_keys(permute)) if permute else 1
+    return max(1, int(memory_budget // (4 * n_values * n_permutations)))
+
+
+class SubjectPatches(object):
+    """
+    Patches of one subject to predict, and the accumulator of its predicted patches.
+    """
+    def __init__(self, key, data, patch_shape, output_channels, overlap=0, blending=None):
+        '''
+        :param key: Key identifying the subject.
+        :param data: Image of shape (n_modalities, x, y, z).
+        '''
+        self.key = key
+        self.patch_shape = patch_shape
+        if tuple(data.shape[-3:]) == patch_shape:
+            self.indices = np.zeros((1, 3), dtype=int)
+        else:
+            self.indices = compute_patch_indices(data.shape[-3:], patch_size=patch_shape, overlap=overlap)
+        self.padded_data, self.offset = pad_data_for_patches(data, patch_shape, self.indices)
+        self.accumulator = PatchAccumulator([output_channels] + list(data.shape[-3:]), patch_shape=patch_shape,
+                                            blending=blending)
+        self.n_scheduled = 0
+        self.n_predicted = 0
+
+    def schedule(self, n_patches):
+        '''
+        :return: The indices of the next n_patches patches (fewer if fewer remain)
+        '''
+        indices = self.indices[self.n_scheduled:self.n_scheduled + n_patches]
+        self.n_scheduled += len(indices)
+        return indices
+
+    def get_patches(self, indices):
+        return get_patches_from_padded_data(self.padded_data, self.patch_shape, indices + self.offset)
+
+    def add_predictions(self, predictions, indices):
+        self.accumulator.add_patches(predictions, indices)
+        self.n_predicted += len(indices)
+
+    def is_scheduled(self):
+        return self.n_scheduled == len(self.indices)
+
+    def is_complete(self):
+        return self.n_predicted == len(self.indices)
+
+
+def predict_subjects(model, subjects, batch_size=None, overlap=0, permute=False, blending=None,
+                     memory_budget=2 ** 30):
+    """
+    Predicts several subjects patch by patch, with batches of a fixed size pooled across the subjects. The subjects are
+    read from the iterable when the batch needs their patches, and each prediction is returned as soon as all its
+    patches are predicted, so that only the subjects of the current batch are held in memory.
+    :param subjects: Iterable of (key, data) with data of shape (n_modalities, x, y, z).
+    :param batch_size: Number of patches per model.predict call. None to fit the memory budget.
+    :param memory_budget: Memory budget in bytes, see get_prediction_batch_size.
+    :return: Generator of (key, prediction of shape (n_labels, x, y, z)), in the order of the subjects.
+    """
+    patch_shape = get_patch_shape(model)
+    output_channels = get_output_channels(model)
+    if not batch_size:
+        batch_size = get_prediction_batch_size(model, memory_budget=memory_budget, permute=permute)
+    subjects = iter(subjects)
+    scheduled = collections.deque()
+    while True:
+        routes = []
+        n_patches = 0
+        while n_patches < batch_size:
+            if len(scheduled) == 0 or scheduled[-1].is_scheduled():
+                subject = next(subjects, None)
+                if subject is None:
+                    break
+                scheduled.append(SubjectPatches(subject[0], subject[1], patch_shape, output_channels,
+                                                overlap=overlap, blending=blending))
+            indices = scheduled[-1].schedule(batch_size - n_patches)
+            routes.append((scheduled[-1], indices))
+            n_patches += len(indices)
+        if n_patches == 0:
+            return
+        batch = np.concatenate([subject_patches.get_patches(indices) for subject_patches, indices in routes])
+        prediction = predict(model, batch, permute=permute)
         if isinstance(prediction, list):
             prediction = prediction[-1]
-        for predicted_patch in prediction:
-            predictions.append(predicted_patch)
-    if isinstance(model.output, list):
-        output_shape = [int(model.output[-1].shape[1])] + list(data.shape[-3:])
-    else:
-        output_shape = [int(model.output.shape[1])] + list(data.shape[-3:])
-    return reconstruct_from_patches(predictions, patch_indices=indices, data_shape=output_shape)
+        start = 0
+        for subject_patches, indices in routes:
+            subject_patches.add_predictions(prediction[start:start + len(indices)], indices)
+            start += len(indices)
+        while len(scheduled) > 0 and scheduled[0].is_complete():
+            subject_patches = scheduled.popleft()
+            yield subject_patches.key, subject_patches.accumulator.get_data()
 
 
 def get_prediction_labels(prediction, threshold=0.5, labels=None):
@@ -123,23 +225,38 @@ def run_validation_case(data_index, output_dir, model, data_file, training_modal
     :param data_file:
     :param model:
     """
+    test_data = write_validation_case_inputs(data_index, output_dir, data_file, training_modalities,
+                                             save_image=save_image)[np.newaxis]
+    patch_shape = get_patch_shape(model)
+    if patch_shape == test_data.shape[-3:]:
+        prediction = predict(model, test_data, permute=permute)
+    else:
+        prediction = patch_wise_prediction(model=model, data=test_data, overlap=overlap, permute=permute)[np.newaxis]
+    write_validation_case_prediction(prediction, data_file.root.affine[data_index], output_dir,
+                                     output_label_map=output_label_map, threshold=threshold, labels=labels)
+
+
+def write_validation_case_inputs(data_index, output_dir, data_file, training_modalities, save_image=False):
+    """
+    Writes the truth (and the modalities if save_image is True) of a test case.
+    :return: The data of the test case, of shape (n_modalities, x, y, z)
+    """
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     affine = data_file.root.affine[data_index]
-    test_data = np.asarray([data_file.root.data[data_index]])
+    test_data = np.asarray(data_file.root.data[data_index])
     for i, modality in enumerate(training_modalities):
         if save_image:
-            image = nib.Nifti1Image(test_data[0, i], affine)
+            image = nib.Nifti1Image(test_data[i], affine)
             image.to_filename(os.path.join(output_dir, "data_{0}.nii.gz".format(modality)))
 
     test_truth = nib.Nifti1Image(data_file.root.truth[data_index][0], affine)
     test_truth.to_filename(os.path.join(output_dir, "truth.nii.gz"))
+    return test_data
 
-    patch_shape = tuple([int(dim) for dim in model.input.shape[-3:]])
-    if patch_shape == test_data.shape[-3:]:
-        prediction = predict(model, test_data, permute=permute)
-    else:
-        prediction = patch_wise_prediction(model=model, data=test_data, overlap=overlap, permute=permute)[np.newaxis]
+
+def write_validation_case_prediction(prediction, affine, output_dir, output_label_map=False, threshold=0.5,
+                                     labels=None):
     prediction_image = prediction_to_image(prediction, affine, label_map=output_label_map, threshold=threshold,
                                            labels=labels)
     if isinstance(prediction_image, list):
@@ -149,37 +266,96 @@ def run_validation_case(data_index, output_dir, model, data_file, training_modal
         prediction_image.to_filename(os.path.join(output_dir, "prediction.nii.gz"))
 
 
+def get_case_directory(data_file, index, output_dir):
+    if 'subject_ids' in data_file.root:
+        return os.path.join(output_dir, data_file.root.subject_ids[index].decode('utf-8'))
+    return os.path.join(output_dir, "validation_case_{}".format(index))
+
+
+def predict_validation_cases(model, data_file, validation_indices, training_modalities, output_label_map=False,
+                             output_dir=".", threshold=0.5, labels=None, overlap=16, permute=False, save_image=False,
+                             batch_size=None, memory_budget=2 ** 30):
+    """
+    Runs the test cases with batches of patches pooled across the cases (see predict_subjects). The prediction of each
+    case is written as soon as all its patches are predicted.
+    :param batch_size: Number of patches per model.predict call. None to fit the memory budget.
+    :param memory_budget: Memory budget of the prediction in bytes, see get_prediction_batch_size.
+    """
+    def read_cases():
+        for index in validation_indices:
+            yield index, write_validation_case_inputs(index, get_case_directory(data_file, index, output_dir),
+                                                      data_file, training_modalities, save_image=save_image)
+
+    cases = predict_subjects(model, read_cases(), batch_size=batch_size, overlap=overlap, permute=permute,
+                             memory_budget=memory_budget)
+    for i, (index, prediction) in enumerate(cases, 1):
+        write_validation_case_prediction(prediction[np.newaxis], data_file.root.affine[index],
+                                         get_case_directory(data_file, index, output_dir),
+                                         output_label_map=output_label_map, threshold=threshold, labels=labels)
+        print("Running validation case: ", round(i/len(validation_indices)*100, 2), "%")
+
+
 def run_validation_cases(validation_keys_file, model_file, training_modalities, labels, hdf5_file,
-                         output_label_map=False, output_dir=".", threshold=0.5, overlap=16, permute=False):
+                         output_label_map=False, output_dir=".", threshold=0.5, overlap=16, permute=False,
+                         batch_size=None, memory_budget=2 ** 30):
     validation_indices = pickle_load(validation_keys_file)
     model = load_old_model(model_file)
     data_file = tables.open_file(hdf5_file, "r")
-    for i, index in enumerate(validation_indices):
-        actual = round(i/len(validation_indices)*100, 2)
-        print("Running validation case: ", actual,"%")
-        if 'subject_ids' in data_file.root:
-            case_directory = os.path.join(output_dir, data_file.root.subject_ids[index].decode('utf-8'))
-        else:
-            case_directory = os.path.join(output_dir, "validation_case_{}".format(index))
-        run_validation_case(data_index=index, output_dir=case_directory, model=model, data_file=data_file,
-                            training_modalities=training_modalities, output_label_map=output_label_map, labels=labels,
-                            threshold=threshold, overlap=overlap, permute=permute)
+    predict_validation_cases(model, data_file, validation_indices, training_modalities,
+                             output_label_map=output_label_map, output_dir=output_dir, threshold=threshold,
+                             labels=labels, overlap=overlap, permute=permute, batch_size=batch_size,
+                             memory_budget=memory_budget)
     data_file.close()
 
 
-def predict(model, data, permute=False):
+def predict(model, data, permute=False, max_samples=None):
+    """
+    :param permute: Test-time augmentation: False, "flip" to average the predictions of the 8 flips of the axes, True
+    or "all" to average the predictions of the 48 symmetries of the cube (the data must be cubes).
+    :param max_samples: See predict_with_permutations.
+    """
     if permute:
-        predictions = list()
-        for batch_index in range(data.shape[0]):
-            predictions.append(predict_with_permutations(model, data[batch_index]))
-        return np.asarray(predictions)
+        return predict_with_permutations(model, data, get_test_time_permutation_keys(permute), max_samples=max_samples)
     else:
         return model.predict(data)
 
 
-def predict_with_permutations(model, data):
-    predictions = list()
-    for permutation_key in generate_permutation_keys():
-        temp_data = permute_data(data, permutation_key)[np.newaxis]
-        predictions.append(reverse_permute_data(model.predict(temp_data)[0], permutation_key))
-    return np.mean(predictions, axis=0)
+def get_test_time_permutation_keys(permute):
+    keys = generate_permutation_keys()
+    if permute == "flip":
+        keys = [key for key in keys if key[0] == (0, 0) and not key[4]]
+    elif permute is not True and permute != "all":
+        raise ValueError("Unknown test-time augmentation: " + str(permute))
+    # The identity comes first
+    return sorted(keys)
+
+
+def predict_with_permutations(model, data, permutation_keys=None, max_samples=None):
+    """
+    The permutations of all the samples of the batch are stacked and predicted with one model.predict call. The
+    predictions are reversed one permutation at a time for the whole batch, and averaged with a running mean.
+    :param data: Batch of shape (n_samples, n_modalities, x, y, z).
+    :param permutation_keys: Permutations to average (default: the 48 symmetries of the cube).
+    :param max_samples: Maximum number of permuted samples per model.predict call. None stacks all the permutations.
+    :return: The averaged prediction of each sample
+    """
+    if permutation_keys is None:
+        permutation_keys = get_test_time_permutation_keys("all")
+    if max_samples:
+        keys_per_call = max(1, max_samples // len(data))
+    else:
+        keys_per_call = len(permutation_keys)
+    mean, count = None, 0
+    for start in range(0, len(permutation_keys), keys_per_call):
+        keys = permutation_keys[start:start + keys_per_call]
+        predictions = model.predict(np.concatenate([permute_batch(data, key) for key in keys]))
+        if isinstance(predictions, list):
+            predictions = predictions[-1]
+        predictions = predictions.reshape((len(keys), len(data)) + predictions.shape[1:])
+        for key, prediction in zip(keys, predictions):
+            count += 1
+            if mean is None:
+                mean = np.array(reverse_permute_batch(prediction, key))
+            else:
+                mean += (reverse_permute_batch(prediction, key) - mean) / count
+    return mean
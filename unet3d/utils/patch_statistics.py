@@ -0,0 +1,302 @@
+import os
+import json
+import itertools
+
+import numpy as np
+import tables
+
+
+def get_statistics_dtype(n_channels):
+    return np.dtype([("lesion_count", np.int64), ("foreground_fraction", np.float32),
+                     ("mean", np.float32, (n_channels,)), ("max", np.float32, (n_channels,))])
+
+
+def get_integral_volume(data, dtype=np.float64):
+    '''
+    Cumulative sum over the last three axes, padded with a leading row of zeros on each of them.
+    '''
+    integral = np.zeros(data.shape[:-3] + tuple(np.asarray(data.shape[-3:]) + 1), dtype=dtype)
+    integral[..., 1:, 1:, 1:] = data
+    for axis in (-3, -2, -1):
+        np.cumsum(integral, axis=axis, out=integral)
+    return integral
+
+
+def get_sparse_table(data, levels):
+    '''
+    Maxima over cubes of side 2^level: table[i, ..., x, y, z] is the maximum of data over
+    [x - pad, x - pad + 2^level) x [y - pad, y - pad + 2^level) x [z - pad, z - pad + 2^level), clipped to the image,
+    with level = levels[i] and pad = 2^max(levels) - 1. The cubes starting before the image cover the boxes clipped at
+    the start of an axis, like the cubes clipped at its end.
+    Only the requested levels are kept, the others are computed one at a time.
+    :param data: Array of shape (n_channels, x, y, z).
+    :param levels: Increasing list of levels.
+    :return: Array of shape (len(levels), n_channels, x + pad, y + pad, z + pad)
+    '''
+    pad = 2 ** levels[-1] - 1
+    maxima = np.pad(data, [(0, 0)] + [(pad, 0)] * 3, mode="edge")
+    table = np.empty((len(levels),) + maxima.shape, dtype=data.dtype)
+    for level in range(levels[-1] + 1):
+        if level > 0:
+            half = 2 ** (level - 1)
+            for axis in (-3, -2, -1):
+                size = maxima.shape[axis]
+                shifted = np.take(maxima, np.minimum(np.arange(size) + half, size - 1), axis=axis)
+                np.maximum(maxima, shifted, out=maxima)
+        if level in levels:
+            table[levels.index(level)] = maxima
+    return table
+
+
+def get_patch_levels(patch_shape, max_level=4):
+    '''
+    The boxes of a patch shape are covered by cubes of a single level: the largest side that fits in the patch. The
+    boxes clipped by the image use the same level, since they touch its border.
+    '''
+    return [min(int(np.floor(np.log2(np.min(patch_shape)))), max_level)]
+
+
+def get_edge_segments(start, stop, size):
+    '''
+    A box of an edge padded axis is its in-bounds range, plus the first and last voxels of the image repeated once per
+    padded voxel. The three segments are returned with their weights, the weight of a missing segment is 0.
+    :param start: Start of the boxes along the axis, shape (n,).
+    :param stop: Stop of the boxes along the axis, shape (n,).
+    :param size: Size of the image along the axis.
+    :return: List of 3 (start, stop, weight) tuples of arrays of shape (n,)
+    '''
+    clipped_start = np.clip(start, 0, size - 1)
+    clipped_stop = np.clip(stop, 1, size)
+    in_bounds = ((stop > 0) & (start < size)).astype(float)
+    n_before = np.maximum(np.minimum(stop, 0) - start, 0).astype(float)
+    n_after = np.maximum(stop - np.maximum(start, size), 0).astype(float)
+    return [(clipped_start, clipped_stop, in_bounds),
+            (np.zeros_like(start), np.ones_like(start), n_before),
+            (np.full_like(start, size - 1), np.full_like(start, size), n_after)]
+
+
+def get_box_sums(integral, segments):
+    '''
+    :param integral: Integral volumes, see get_integral_volume.
+    :param segments: Edge segments of the boxes along each axis, see get_edge_segments.
+    :return: Sums of each channel over the boxes, shape (n, n_channels)
+    '''
+    sums = np.zeros((len(segments[0][0][0]), integral.shape[0]))
+    for (x_start, x_stop, x_weight), (y_start, y_stop, y_weight), (z_start, z_stop, z_weight) in \
+            itertools.product(*segments):
+        weight = x_weight * y_weight * z_weight
+        if not np.any(weight):
+            continue
+        box_sums = 0
+        for x, y, z in itertools.product(*[((start, -1), (stop, 1)) for start, stop in
+                                           ((x_start, x_stop), (y_start, y_stop), (z_start, z_stop))]):
+            box_sums = box_sums + x[1] * y[1] * z[1] * integral[:, x[0], y[0], z[0]]
+        sums += weight[:, np.newaxis] * box_sums.T
+    return sums
+
+
+class VolumeIndex:
+    """
+    Integral volumes and sparse table of maxima of one subject. The sum of any box is read from the 8 corners of the
+    integral volumes, its maximum from at most a few overlapping cubes of the sparse table, without rescanning the
+    voxels. Boxes going out of the image are treated as if the image was edge padded, like get_patch_from_3d_data.
+    """
+    def __init__(self, integral, counts, maxima, levels):
+        '''
+        :param integral: Integral volumes of the modalities, shape (n_channels, x + 1, y + 1, z + 1).
+        :param counts: Integral volumes of the lesion mask and of the foreground mask, as integers.
+        :param maxima: Sparse table of the modalities, see get_sparse_table.
+        :param levels: Levels of the sparse table.
+        '''
+        self.integral = integral
+        self.counts = counts
+        self.maxima = maxima
+        self.levels = list(levels)
+        self.n_channels = maxima.shape[1]
+        self.image_shape = np.asarray(integral.shape[-3:]) - 1
+
+    @classmethod
+    def from_volume(cls, data, truth, max_level=4, levels=None):
+        '''
+        :param data: Image of shape (n_channels, x, y, z).
+        :param truth: Ground truth of shape (x, y, z).
+        :param max_level: The largest cube of the sparse table has a side of 2^max_level.
+        :param levels: Levels of the sparse table (default: all the levels up to max_level). The maxima of the boxes
+        too small for the lowest level cannot be computed.
+        '''
+        if levels is None:
+            levels = list(range(max_level + 1))
+        # The background of the images is their minimum value
+        foreground = data[0] > data[0].min()
+        integral = get_integral_volume(data)
+        counts = get_integral_volume(np.stack([truth != 0, foreground]).astype(np.int32), dtype=np.int32)
+        return cls(integral, counts, get_sparse_table(np.asarray(data, dtype=np.float32), sorted(levels)), levels)
+
+    def sums(self, corners, patch_shape):
+        '''
+        :param corners: Corner indices of the boxes, shape (n, 3).
+        :param patch_shape: Shape of the boxes.
+        :return: Sums of each modality, of the lesion mask and of the foreground mask over the boxes, shape
+        (n, n_channels + 2)
+        '''
+        corners = np.asarray(corners, dtype=int).reshape(-1, 3)
+        stops = corners + np.asarray(patch_shape, dtype=int)
+        segments = [get_edge_segments(corners[:, axis], stops[:, axis], self.image_shape[axis]) for axis in range(3)]
+        return np.concatenate([get_box_sums(self.integral, segments), get_box_sums(self.counts, segments)], axis=1)
+
+    def maxima_of_boxes(self, corners, patch_shape):
+        '''
+        The in-bounds part of each box is covered by cubes of the sparse table, of the largest stored side that fits
+        in the box. Along the axes where the box touches the border of the image, the cubes may go out of the image.
+        The edge padding does not change the maximum.
+        :return: Maxima of each modality over the boxes, shape (n, n_channels)
+        '''
+        corners = np.asarray(corners, dtype=int).reshape(-1, 3)
+        starts = np.clip(corners, 0, self.image_shape - 1)
+        stops = np.clip(corners + np.asarray(patch_shape, dtype=int), 1, self.image_shape)
+        at_start = starts == 0
+        at_end = stops == self.image_shape
+        # Only the axes where the box is inside the image bound the side of the cubes
+        lengths = np.where(at_start | at_end, np.iinfo(int).max, stops - starts).min(axis=1)
+        wanted = np.floor(np.log2(lengths)).astype(int)
+        positions = np.searchsorted(self.levels, wanted, side="right") - 1
+        if np.any(positions < 0):
+            raise ValueError("The boxes are too small for the levels of the sparse table: {}".format(self.levels))
+        sides = 2 ** np.asarray(self.levels)[positions][:, np.newaxis]
+        starts = np.where(at_start, np.minimum(starts, stops - sides), starts)
+        stops = np.where(at_end, np.maximum(stops, starts + sides), stops)
+        n_cubes = np.ceil((stops - starts) / sides).astype(int).max(axis=0)
+        pad = 2 ** self.levels[-1] - 1
+        maxima = np.full((len(corners), self.n_channels), -np.inf, dtype=self.maxima.dtype)
+        for offsets in itertools.product(*[range(n) for n in n_cubes]):
+            # The last cube of each axis is aligned on the end of the box, cubes may overlap
+            cube_starts = np.minimum(starts + np.asarray(offsets) * sides, stops - sides) + pad
+            cube_maxima = self.maxima[positions, :, cube_starts[:, 0], cube_starts[:, 1], cube_starts[:, 2]]
+            np.maximum(maxima, cube_maxima, out=maxima)
+        return maxima
+
+    def statistics(self, corners, patch_shape):
+        '''
+        :return: Structured array with one row per box, see get_statistics_dtype.
+        '''
+        n_voxels = float(np.prod(patch_shape))
+        sums = self.sums(corners, patch_shape)
+        statistics = np.empty(len(sums), dtype=get_statistics_dtype(self.n_channels))
+        statistics["mean"] = sums[:, :self.n_channels] / n_voxels
+        statistics["lesion_count"] = np.rint(sums[:, self.n_channels])
+        statistics["foreground_fraction"] = sums[:, self.n_channels + 1] / n_voxels
+        statistics["max"] = self.maxima_of_boxes(corners, patch_shape)
+        return statistics
+
+
+class PatchIndex:
+    """
+    VolumeIndex of every subject of a data file, stored in an hdf5 file next to it. It is built once and answers the
+    statistics queries for any overlap, and for any patch shape if it is built without one. It is rebuilt when the data
+    file changes.
+    """
+    def __init__(self, data_file, path=None, max_level=4, patch_shape=None):
+        '''
+        :param data_file: Opened pytables data file.
+        :param path: Path of the index file (default: the data file name followed by _patch_index.h5).
+        :param max_level: The largest cube of the sparse table has a side of 2^max_level.
+        :param patch_shape: If not None, the sparse table only keeps the level used by the patches of this shape (see
+        get_patch_levels) and the index only answers the queries for patches at least as large.
+        '''
+        self.path = path or get_patch_index_path(data_file)
+        levels = list(range(max_level + 1)) if patch_shape is None else get_patch_levels(patch_shape, max_level)
+        self.key = get_patch_index_key(data_file, levels)
+        if self.key != load_patch_index_key(self.path):
+            self.build(data_file, levels)
+        self.index_file = tables.open_file(self.path, mode="r")
+        self.subject = None
+        self.volume_index = None
+
+    def build(self, data_file, levels):
+        print("Creating the patch index", self.path, ". This may take a while...")
+        filters = tables.Filters(complevel=5, complib='blosc')
+        n_subjects = data_file.root.data.shape[0]
+        with tables.open_file(self.path, mode="w") as index_file:
+            for subject in range(n_subjects):
+                volume_index = VolumeIndex.from_volume(data_file.root.data[subject], data_file.root.truth[subject, 0],
+                                                       levels=levels)
+                group = index_file.create_group(index_file.root, "subject_" + str(subject))
+                index_file.create_carray(group, "integral", obj=volume_index.integral, filters=filters)
+                index_file.create_carray(group, "counts", obj=volume_index.counts, filters=filters)
+                index_file.create_carray(group, "maxima", obj=volume_index.maxima, filters=filters)
+            # The key is written last: an interrupted build is never mistaken for a valid index.
+            index_file.root._v_attrs.key = json.dumps(self.key)
+
+    def get_volume_index(self, subject):
+        '''
+        The arrays of the last queried subject are kept in memory.
+        '''
+        if self.subject != subject:
+            group = self.index_file.get_node(self.index_file.root, "subject_" + str(subject))
+            self.volume_index = VolumeIndex(group.integral[:], group.counts[:], group.maxima[:], self.key["levels"])
+            self.subject = subject
+        return self.volume_index
+
+    def close(self):
+        self.index_file.close()
+
+
+def get_patch_index_path(data_file):
+    return os.path.splitext(os.path.abspath(data_file.filename))[0] + "_patch_index.h5"
+
+
+def get_patch_index_key(data_file, levels):
+    filename = os.path.abspath(data_file.filename)
+    file_stat = os.stat(filename)
+    return {"data_file": filename,
+            "size": file_stat.st_size,
+            "mtime": file_stat.st_mtime,
+            "shape": [int(dim) for dim in data_file.root.data.shape],
+            "levels": [int(level) for level in levels]}
+
+
+def load_patch_index_key(path):
+    if not os.path.exists(path):
+        return None
+    with tables.open_file(path, mode="r") as index_file:
+        if "key" not in index_file.root._v_attrs:
+            return None
+        return json.loads(index_file.root._v_attrs.key)
+
+
+def compute_patch_statistics(data_file, index_list, patch_shape, patch_index=None):
+    '''
+    Statistics of all the patches of an index list, loading each subject only once.
+    :param data_file: pytables data file.
+    :param index_list: List of (subject index, patch corner) as returned by create_patch_index_list.
+    :param patch_shape: Shape of the patches.
+    :param patch_index: PatchIndex of the data file. If None, the subjects are read from the data file.
+    :return: Structured array aligned with index_list, with the fields lesion_count, foreground_fraction, and the
+    mean and max of each modality.
+    '''
+    statistics = np.empty(len(index_list), dtype=get_statistics_dtype(data_file.root.data.shape[1]))
+    if len(index_list) == 0:
+        return statistics
+    subjects = np.asarray([index for index, _ in index_list])
+    corners = np.asarray([patch_index for _, patch_index in index_list], dtype=int)
+    for subject in np.unique(subjects):
+        positions = np.flatnonzero(subjects == subject)
+        if patch_index is not None:
+            volume_index = patch_index.get_volume_index(subject)
+        else:
+            volume_index = VolumeIndex.from_volume(data_file.root.data[subject], data_file.root.truth[subject, 0],
+                                                   levels=get_patch_levels(patch_shape))
+        statistics[positions] = volume_index.statistics(corners[positions], patch_shape)
+    return statistics
+
+
+def select_patches(index_list, mask):
+    return [index for index, keep in zip(index_list, mask) if keep]
+
+
+def select_patches_with_ground_truth(index_list, statistics):
+    return select_patches(index_list, statistics["lesion_count"] > 0)
+
+
+def select_patches_with_intensity_ceil(index_list, statistics, ceil, modality=0):
+    return select_patches(index_list, statistics["max"][:, modality] > ceil)
@@ -58,6 +58,29 @@ def get_patch_from_3d_data(data, patch_shape, patch_index):
                 patch_index[2]:patch_index[2]+patch_shape[2]]
 
 
+def get_patch_from_storage(storage, index, patch_shape, patch_index):
+    """
+    Returns a patch of one sample of a (n_samples, n_channels, x, y, z) storage, reading only the region covered by
+    the patch. This avoids loading the whole image when the storage is an hdf5 array.
+    :param storage: pytables (or numpy) array of shape (n_samples, n_channels, x, y, z).
+    :param index: index of the sample in the storage.
+    :param patch_shape: shape/size of the patch.
+    :param patch_index: corner index of the patch.
+    :return: numpy array of shape (n_channels,) + patch_shape, padded like get_patch_from_3d_data.
+    """
+    patch_index = np.asarray(patch_index, dtype=int)
+    patch_shape = np.asarray(patch_shape, dtype=int)
+    image_shape = np.asarray(storage.shape[-3:])
+    start = np.maximum(patch_index, 0)
+    stop = np.minimum(patch_index + patch_shape, image_shape)
+    data = storage[index, :, start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]]
+    pad_before = start - patch_index
+    pad_after = patch_index + patch_shape - stop
+    if np.any(pad_before > 0) or np.any(pad_after > 0):
+        data = np.pad(data, [[0, 0]] + np.stack([pad_before, pad_after], axis=1).tolist(), mode="edge")
+    return data
+
+
 def fix_out_of_bound_patch_attempt(data, patch_shape, patch_index, ndim=3):
     """
     Pads the data and alters the patch index so that a patch will be correct.
@@ -77,7 +100,123 @@ def fix_out_of_bound_patch_attempt(data, patch_shape, patch_index, ndim=3):
     return data, patch_index
 
 
-def reconstruct_from_patches(patches, patch_indices, data_shape, default_value=0):
+def pad_data_for_patches(data, patch_shape, patch_indices):
+    """
+    Pads the data once so that all the given patches lie inside of it. The padding mode is the same as the one used by
+    get_patch_from_3d_data, so the patches taken from the padded data are identical.
+    :param data: numpy array with the image dimensions as its last three dimensions.
+    :param patch_shape: shape/size of the patches.
+    :param patch_indices: corner indices of the patches.
+    :return: padded data, offset to add to the patch indices to get their position in the padded data
+    """
+    patch_indices = np.asarray(patch_indices, dtype=int).reshape(-1, 3)
+    image_shape = np.asarray(data.shape[-3:])
+    pad_before = np.maximum(-patch_indices.min(axis=0), 0)
+    pad_after = np.maximum(patch_indices.max(axis=0) + np.asarray(patch_shape) - image_shape, 0)
+    if np.any(pad_before > 0) or np.any(pad_after > 0):
+        pad_args = [[0, 0]] * (data.ndim - 3) + np.stack([pad_before, pad_after], axis=1).tolist()
+        data = np.pad(data, pad_args, mode="edge")
+    return data, pad_before
+
+
+def get_patches_from_padded_data(data, patch_shape, patch_indices):
+    """
+    Stacks the patches of a batch taken as views of data padded with pad_data_for_patches.
+    :param data: padded numpy array.
+    :param patch_shape: shape/size of the patches.
+    :param patch_indices: corner indices of the patches in the padded data.
+    :return: numpy array of shape (n_patches, ...) + patch_shape
+    """
+    return np.stack([data[..., index[0]:index[0]+patch_shape[0], index[1]:index[1]+patch_shape[1],
+                          index[2]:index[2]+patch_shape[2]] for index in patch_indices])
+
+
+def get_patch_weights(patch_shape, blending=None, sigma_scale=0.125):
+    """
+    Returns the weights used to blend overlapping patches together.
+    :param patch_shape: Shape of the patch.
+    :param blending: None for a plain average, "gaussian" or "cosine" to down-weight the borders of each patch.
+    :param sigma_scale: Standard deviation of the gaussian window as a fraction of the patch size.
+    :return: numpy array of the patch shape containing the (strictly positive) weight of each voxel.
+    """
+    patch_shape = tuple([int(dim) for dim in patch_shape])
+    if blending is None:
+        return np.ones(patch_shape)
+    windows = list()
+    for dim in patch_shape:
+        position = np.arange(dim) + 0.5
+        if blending == "gaussian":
+            sigma = dim * sigma_scale
+            window = np.exp(-0.5 * ((position - dim / 2.) / sigma) ** 2)
+        elif blending == "cosine":
+            window = 0.5 * (1 - np.cos(2 * np.pi * position / dim))
+        else:
+            raise ValueError("Unknown blending mode: {0}".format(blending))
+        windows.append(window / window.max())
+    weights = windows[0][:, np.newaxis, np.newaxis] * windows[1][np.newaxis, :, np.newaxis] \
+        * windows[2][np.newaxis, np.newaxis, :]
+    # Keep the weights away from 0 so that voxels only covered by patch borders are still defined.
+    return np.maximum(weights, np.finfo(np.float32).eps)
+
+
+class PatchAccumulator(object):
+    """
+    Stitches patches into a preallocated volume. Each patch is folded into the volume as soon as it is added so that
+    only the volume and its weights are kept in memory.
+    Without blending, the update (data * count + patch) / (count + 1) is the one the masked implementation used so the
+    resulting averages are identical.
+    """
+    def __init__(self, data_shape, patch_shape=None, default_value=0, blending=None, sigma_scale=0.125):
+        self.data_shape = tuple([int(dim) for dim in data_shape])
+        self.image_shape = np.asarray(self.data_shape[-3:])
+        self.data = np.ones(self.data_shape) * default_value
+        self.weights = np.zeros(self.data_shape[-3:])
+        self.blending = blending
+        self.sigma_scale = sigma_scale
+        self.patch_weights = None
+        if blending is not None and patch_shape is not None:
+            self.patch_weights = get_patch_weights(patch_shape, blending=blending, sigma_scale=sigma_scale)
+
+    def add_patch(self, patch, index):
+        """
+        Adds a patch to the volume.
+        :param patch: numpy array with the patch shape as its last three dimensions.
+        :param index: corner index of the patch (may lie outside of the volume).
+        """
+        index = np.asarray(index, dtype=int)
+        patch_shape = np.asarray(patch.shape[-3:])
+        start = np.maximum(index, 0)
+        stop = np.minimum(index + patch_shape, self.image_shape)
+        if np.any(stop <= start):
+            return
+        patch_start = start - index
+        patch_stop = stop - index
+        patch = patch[..., patch_start[0]:patch_stop[0], patch_start[1]:patch_stop[1], patch_start[2]:patch_stop[2]]
+        image_slice = (slice(start[0], stop[0]), slice(start[1], stop[1]), slice(start[2], stop[2]))
+        weights = self.weights[image_slice]
+        data = self.data[(Ellipsis,) + image_slice]
+        if self.blending is None:
+            self.data[(Ellipsis,) + image_slice] = (data * weights + patch) / (weights + 1)
+            self.weights[image_slice] += 1
+        else:
+            if self.patch_weights is None or self.patch_weights.shape != tuple(patch_shape):
+                self.patch_weights = get_patch_weights(patch_shape, blending=self.blending,
+                                                       sigma_scale=self.sigma_scale)
+            patch_weights = self.patch_weights[patch_start[0]:patch_stop[0], patch_start[1]:patch_stop[1],
+                                               patch_start[2]:patch_stop[2]]
+            new_weights = weights + patch_weights
+            self.data[(Ellipsis,) + image_slice] = (data * weights + patch * patch_weights) / new_weights
+            self.weights[image_slice] = new_weights
+
+    def add_patches(self, patches, patch_indices):
+        for patch, index in zip(patches, patch_indices):
+            self.add_patch(patch, index)
+
+    def get_data(self):
+        return self.data
+
+
+def reconstruct_from_patches(patches, patch_indices, data_shape, default_value=0, blending=None):
     """
     Reconstructs an array of the original shape from the lists of patches and corresponding patch indices. Overlapping
     patches are averaged.
@@ -86,34 +225,10 @@ def reconstruct_from_patches(patches, patch_indices, data_shape, default_value=0
     :param data_shape: Shape of the array from which the patches were extracted.
     :param default_value: The default value of the resulting data. if the patch coverage is complete, this value will
     be overwritten.
+    :param blending: None to average overlapping patches, "gaussian" or "cosine" to weight each patch by a window that
+    decreases towards its borders.
     :return: numpy array containing the data reconstructed by the patches.
     """
-    data = np.ones(data_shape) * default_value
-    image_shape = data_shape[-3:]
-    count = np.zeros(data_shape, dtype=np.int)
-    for patch, index in zip(patches, patch_indices):
-        image_patch_shape = patch.shape[-3:]
-        if np.any(index < 0):
-            fix_patch = np.asarray((index < 0) * np.abs(index), dtype=np.int)
-            patch = patch[..., fix_patch[0]:, fix_patch[1]:, fix_patch[2]:]
-            index[index < 0] = 0
-        if np.any((index + image_patch_shape) >= image_shape):
-            fix_patch = np.asarray(image_patch_shape - (((index + image_patch_shape) >= image_shape)
-                                                        * ((index + image_patch_shape) - image_shape)), dtype=np.int)
-            patch = patch[..., :fix_patch[0], :fix_patch[1], :fix_patch[2]]
-        patch_index = np.zeros(data_shape, dtype=np.bool)
-        patch_index[...,
-                    index[0]:index[0]+patch.shape[-3],
-                    index[1]:index[1]+patch.shape[-2],
-                    index[2]:index[2]+patch.shape[-1]] = True
-        patch_data = np.zeros(data_shape)
-        patch_data[patch_index] = patch.flatten()
-
-        new_data_index = np.logical_and(patch_index, np.logical_not(count > 0))
-        data[new_data_index] = patch_data[new_data_index]
-
-        averaged_data_index = np.logical_and(patch_index, count > 0)
-        if np.any(averaged_data_index):
-            data[averaged_data_index] = (data[averaged_data_index] * count[averaged_data_index] + patch_data[averaged_data_index]) / (count[averaged_data_index] + 1)
-        count[patch_index] += 1
-    return data
+    accumulator = PatchAccumulator(data_shape, default_value=default_value, blending=blending)
+    accumulator.add_patches(patches, patch_indices)
+    return accumulator.get_data()
@@ -1,6 +1,6 @@
 import pickle
 import os
-import collections
+import collections.abc
 
 import nibabel as nib
 import numpy as np
@@ -36,7 +36,7 @@ def read_image_files(image_files, image_shape=None, crop=None, label_indices=Non
     """
     if label_indices is None:
         label_indices = []
-    elif not isinstance(label_indices, collections.Iterable) or isinstance(label_indices, str):
+    elif not isinstance(label_indices, collections.abc.Iterable) or isinstance(label_indices, str):
         label_indices = [label_indices]
     image_list = list()
     for index, image_file in enumerate(image_files):